@@ -0,0 +1,108 @@
+# app/batch.py
+from __future__ import annotations
+import os, json, time
+from typing import Any, Dict, List
+
+from app.gpt import _client
+from app.db import add_log
+from app import metrics
+
+# Пакетные chat.completions через OpenAI Batch API:
+# JSONL с запросами → files.create → batches.create → опрос статуса →
+# разбор output-файла. Ответы приходят в пределах completion_window (до 24 ч),
+# дешевле и вне поминутных лимитов — годится для ночной генерации.
+# Тот же интерфейс (files/batches) реализует FakeOpenAI из bench/fakes.py.
+#
+# run() ждёт пакет на месте (для скриптов и бенча); планировщик так делать
+# не должен — там submit() + check() на каждом тике (см. planner.poll_batch_jobs).
+#
+#   GEN_BATCH_POLL_SEC=30        — как часто спрашивать статус
+#   GEN_BATCH_TIMEOUT_SEC=86400  — сколько ждать, прежде чем сдаться
+
+ENDPOINT = "/v1/chat/completions"
+_FINAL = ("completed", "failed", "expired", "cancelled")
+
+def request(custom_id: str, model: str, messages: List[Dict[str, str]], **params: Any) -> dict:
+    """Одна строка входного JSONL."""
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINT,
+            "body": {"model": model, "messages": messages, **params}}
+
+def submit(requests: List[dict]) -> str:
+    data = "\n".join(json.dumps(r, ensure_ascii=False) for r in requests).encode("utf-8")
+    f = _client().files.create(file=("batch.jsonl", data), purpose="batch")
+    b = _client().batches.create(input_file_id=f.id, endpoint=ENDPOINT, completion_window="24h")
+    return b.id
+
+def wait(batch_id: str, poll: float | None = None, timeout: float | None = None):
+    poll = float(os.getenv("GEN_BATCH_POLL_SEC", "30")) if poll is None else poll
+    timeout = float(os.getenv("GEN_BATCH_TIMEOUT_SEC", "86400")) if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        b = _client().batches.retrieve(batch_id)
+        if b.status in _FINAL:
+            return b
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"batch {batch_id} still {b.status} after {timeout:.0f}s")
+        time.sleep(poll)
+
+def _read_jsonl(file_id: str | None) -> List[dict]:
+    if not file_id:
+        return []
+    text = _client().files.content(file_id).text
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def results(b) -> Dict[str, str | None]:
+    """custom_id → текст ответа; None — запрос упал внутри пакета."""
+    out: Dict[str, str | None] = {}
+    for line in _read_jsonl(getattr(b, "output_file_id", None)):
+        resp = line.get("response") or {}
+        body = resp.get("body") or {}
+        if resp.get("status_code") == 200 and body.get("choices"):
+            out[line["custom_id"]] = body["choices"][0]["message"].get("content") or ""
+            usage = body.get("usage") or {}
+            for kind in ("prompt", "completion"):
+                if usage.get(f"{kind}_tokens"):
+                    metrics.inc("openai_tokens_total", usage[f"{kind}_tokens"],
+                                op="batch", model=body.get("model", ""), kind=kind)
+        else:
+            out[line["custom_id"]] = None
+    for line in _read_jsonl(getattr(b, "error_file_id", None)):
+        out.setdefault(line["custom_id"], None)
+    return out
+
+def _collect(b, custom_ids: List[str] | None, t0: float | None = None) -> Dict[str, str | None]:
+    res = results(b)
+    ids = custom_ids if custom_ids is not None else list(res)
+    failed = 0
+    for cid in ids:
+        if res.setdefault(cid, None) is None:
+            failed += 1
+    if t0 is not None:
+        metrics.observe("openai_batch_seconds", time.monotonic() - t0)
+    metrics.inc("openai_batch_requests_total", len(ids) - failed, result="ok")
+    metrics.inc("openai_batch_requests_total", failed, result="failed")
+    msg = f"[BATCH] {b.id} {b.status}: {len(ids) - failed} ok, {failed} failed"
+    print(msg)
+    add_log(msg)
+    return res
+
+def check(batch_id: str, custom_ids: List[str] | None = None) -> Dict[str, str | None] | None:
+    """
+    Не блокируясь: None — пакет ещё в работе, иначе ответы по custom_id
+    (для переданных custom_ids недостающие — None).
+    """
+    b = _client().batches.retrieve(batch_id)
+    if b.status not in _FINAL:
+        return None
+    return _collect(b, custom_ids)
+
+def run(requests: List[dict]) -> Dict[str, str | None]:
+    """Отправить пакет, дождаться и вернуть ответы по custom_id (для всех запросов)."""
+    if not requests:
+        return {}
+    t0 = time.monotonic()
+    batch_id = submit(requests)
+    msg = f"[BATCH] submitted {batch_id}: {len(requests)} requests"
+    print(msg)
+    add_log(msg)
+    return _collect(wait(batch_id), [r["custom_id"] for r in requests], t0)
@@ -0,0 +1,134 @@
+# app/bm25.py
+from __future__ import annotations
+import os, re, json, hashlib
+from typing import Any, Dict, List, Tuple
+import numpy as np
+
+# Лексический индекс книги (BM25) для retriever.
+# Строится при импорте чанков (embeddings) и хранится в таблице bm25_index,
+# чтобы поиск по словам не требовал ни эмбеддингов, ни перечитывания текста.
+#
+# Нормализация: нижний регистр, ё→е (как _norm_key в generator), слова
+# из букв/цифр, стоп-слова выброшены, окончания срезаны простым стеммером.
+# Вклад каждого слова в каждый чанк считается при загрузке, поэтому запрос —
+# это пара сложений numpy-массивов на слово.
+#
+#   BM25_K1=1.5, BM25_B=0.75 — стандартные параметры
+
+_WORD_RE = re.compile(r"[a-zа-я0-9]+")
+
+_STOP = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по
+только ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если
+уже или ни быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей
+может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз
+тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом
+один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец
+два об другой хоть после над больше тот через эти нас про всего них какая много
+разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой
+им более всегда конечно всю между это эта эти the a an of to in and or is are
+""".split())
+
+# длинные окончания раньше коротких; основа не короче 3 букв
+_ENDINGS = tuple(sorted("""
+ование ования ением ениям ениях ений ение ения остью ость ости
+ами ями ого его ому ему ыми ими ией ется ются ится ятся ать ять ить еть уть
+ешь ишь ете ите ала ила ела ыла али или ели ыли ало ило ело
+ий ый ой ая яя ое ее ые ие ых их ую юю ом ем ам ям ах ях ов ев ей ью ия ии
+а я о е ы и у ю ь
+""".split(), key=len, reverse=True))
+
+def _stem(w: str) -> str:
+    if len(w) <= 4 or not ("а" <= w[0] <= "я"):
+        return w
+    for end in _ENDINGS:
+        if w.endswith(end) and len(w) - len(end) >= 3:
+            return w[:-len(end)]
+    return w
+
+def tokenize(text: str) -> List[str]:
+    s = (text or "").lower().replace("ё", "е")
+    return [_stem(w) for w in _WORD_RE.findall(s) if w not in _STOP]
+
+def version(chunk_ids: List[int], texts: List[str]) -> str:
+    """Отпечаток набора чанков книги: меняется при любой перезаливке/правке текста.
+    Единственное определение версии — им помечаются bm25_index и summaries."""
+    if not chunk_ids:
+        return ""
+    parts = ",".join(f"{cid}:{hashlib.md5(t.encode('utf-8')).hexdigest()}" for cid, t in zip(chunk_ids, texts))
+    return hashlib.md5(parts.encode("utf-8")).hexdigest()
+
+def build(texts: List[str]) -> Dict[str, Any]:
+    """Постинги: слово → [[номера чанков], [частоты]] + длины чанков в словах."""
+    postings: Dict[str, Tuple[List[int], List[int]]] = {}
+    dl: List[int] = []
+    for row, text in enumerate(texts):
+        tf: Dict[str, int] = {}
+        toks = tokenize(text)
+        for t in toks:
+            tf[t] = tf.get(t, 0) + 1
+        dl.append(len(toks))
+        for t, n in tf.items():
+            p = postings.get(t)
+            if p is None:
+                p = postings[t] = ([], [])
+            p[0].append(row)
+            p[1].append(n)
+    return {"dl": dl, "postings": {t: [r, f] for t, (r, f) in postings.items()}}
+
+class Index:
+    """BM25 одной книги: для каждого слова — номера чанков и готовый вклад в оценку."""
+    __slots__ = ("n", "terms")
+
+    def __init__(self, data: Dict[str, Any]):
+        k1 = float(os.getenv("BM25_K1", "1.5"))
+        b = float(os.getenv("BM25_B", "0.75"))
+        dl = np.asarray(data.get("dl") or [], dtype=np.float32)
+        self.n = int(dl.shape[0])
+        avgdl = float(dl.mean()) if self.n and dl.mean() > 0 else 1.0
+        norm = k1 * (1 - b + b * dl / avgdl)
+        self.terms: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for t, (rows, tfs) in (data.get("postings") or {}).items():
+            rows = np.asarray(rows, dtype=np.int64)
+            tfs = np.asarray(tfs, dtype=np.float32)
+            df = rows.shape[0]
+            idf = np.log(1 + (self.n - df + 0.5) / (df + 0.5))
+            self.terms[t] = (rows, (idf * tfs * (k1 + 1) / (tfs + norm[rows])).astype(np.float32))
+
+    def scores(self, query: str) -> np.ndarray:
+        out = np.zeros(self.n, dtype=np.float32)
+        for t in set(tokenize(query)):
+            hit = self.terms.get(t)
+            if hit is not None:
+                out[hit[0]] += hit[1]
+        return out
+
+# ---------- хранение ----------
+def save(cur, book_id: str, ver: str, data: Dict[str, Any]) -> None:
+    cur.execute(
+        """
+        INSERT INTO bm25_index(book_id, chunks_version, data)
+        VALUES (%s, %s, %s::jsonb)
+        ON CONFLICT (book_id) DO UPDATE
+          SET chunks_version = EXCLUDED.chunks_version, data = EXCLUDED.data, built_at = NOW()
+        """,
+        (book_id, ver, json.dumps(data, ensure_ascii=False, separators=(",", ":"))),
+    )
+
+def load(cur, book_id: str, ver: str) -> Dict[str, Any] | None:
+    """Сохранённый индекс, если он построен по той же версии чанков."""
+    cur.execute("SELECT chunks_version, data FROM bm25_index WHERE book_id=%s;", (book_id,))
+    row = cur.fetchone()
+    if not row or row[0] != ver:
+        return None
+    return json.loads(row[1]) if isinstance(row[1], str) else row[1]
+
+def rebuild(cur, book_id: str) -> Dict[str, Any]:
+    """Перестроить и сохранить индекс по чанкам в БД (после импорта)."""
+    cur.execute("SELECT chunk_id, text FROM chunks WHERE book_id=%s ORDER BY chunk_id ASC;", (book_id,))
+    rows = cur.fetchall()
+    ids = [r[0] for r in rows]
+    texts = [r[1] or "" for r in rows]
+    data = build(texts)
+    save(cur, book_id, version(ids, texts), data)
+    return data
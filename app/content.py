@@ -56,5 +56,6 @@ def make_content(channel_name: str, fmt: str) -> str:
             min_pub_dt=min_pub_dt,
             max_items=30,
             pick_latest_if_empty=True,
+            only_new=True,
         )
     return generate_by_format(fmt, items)
@@ -1,15 +1,109 @@
-import os
+import os, json, time, threading, queue, atexit
+import datetime as dt
+from contextlib import contextmanager
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
 
-def _get_conn():
-    dsn = os.environ["DATABASE_URL"]
-    return psycopg2.connect(dsn, sslmode="require")
+from app import metrics
 
+# ---- Пул соединений на процесс ----
+_POOL: ThreadedConnectionPool | None = None
+_POOL_SEM: threading.BoundedSemaphore | None = None
+_POOL_LOCK = threading.Lock()
+_LAST_USED: dict[int, float] = {}
+
+def _pool_size() -> tuple[int, int]:
+    lo = max(0, int(os.getenv("DB_POOL_MIN", "1")))
+    hi = max(1, int(os.getenv("DB_POOL_MAX", "5")))
+    return min(lo, hi), hi
+
+def _pool() -> ThreadedConnectionPool:
+    """Ленивый пул: TLS-рукопожатие платим один раз на соединение, а не на вызов."""
+    global _POOL, _POOL_SEM
+    if _POOL is not None:
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            lo, hi = _pool_size()
+            _POOL = ThreadedConnectionPool(
+                lo, hi, os.environ["DATABASE_URL"], sslmode="require",
+                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+            )
+            _POOL_SEM = threading.BoundedSemaphore(hi)
+    return _POOL
+
+def _healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    # проверяем только соединения, которые давно простаивали
+    idle = time.monotonic() - _LAST_USED.get(id(conn), 0.0)
+    if idle < float(os.getenv("DB_POOL_CHECK_SEC", "30")):
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout():
+    pool = _pool()
+    hi = _pool_size()[1]
+    for _ in range(hi + 1):
+        conn = pool.getconn()
+        if _healthy(conn):
+            return conn
+        _LAST_USED.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("DB pool: no healthy connection")
+
+@contextmanager
 def get_conn():
-    return _get_conn()
+    """
+    Соединение из пула: `with get_conn() as conn, conn.cursor() as cur: ...`
+    На выходе — commit (или rollback при ошибке) и возврат в пул;
+    оборванное соединение закрывается, пул откроет новое.
+    """
+    pool = _pool()
+    timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    t0 = time.perf_counter()
+    if not _POOL_SEM.acquire(timeout=timeout):
+        metrics.inc("db_checkout_timeouts_total")
+        raise psycopg2.OperationalError("DB pool: checkout timeout")
+    conn = None
+    broken = False
+    try:
+        conn = _checkout()
+        t1 = time.perf_counter()
+        metrics.observe("db_checkout_seconds", t1 - t0)
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except BaseException as e:
+            metrics.inc("db_errors_total", kind=type(e).__name__)
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+    finally:
+        if conn is not None:
+            metrics.observe("db_conn_seconds", time.perf_counter() - t1)
+            broken = broken or bool(conn.closed)
+            if broken:
+                _LAST_USED.pop(id(conn), None)
+            else:
+                _LAST_USED[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=broken)
+        _POOL_SEM.release()
 
 def init_db():
-    with _get_conn() as conn, conn.cursor() as cur:
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute("""
         CREATE TABLE IF NOT EXISTS logs (
             id SERIAL PRIMARY KEY,
@@ -17,6 +111,7 @@ def init_db():
             message TEXT
         );
         """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_at ON logs(at);")
         cur.execute("""
         CREATE TABLE IF NOT EXISTS chunks (
             id SERIAL PRIMARY KEY,
@@ -33,6 +128,53 @@ def init_db():
         cur.execute("CREATE INDEX IF NOT EXISTS idx_chunks_book ON chunks(book_id);")
         cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_book_chunk ON chunks(book_id, chunk_id);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks(hash);")
+        # MinHash-подпись текста чанка (app/minhash.py) — для отсева почти-дубликатов
+        cur.execute("ALTER TABLE chunks ADD COLUMN IF NOT EXISTS minhash BIGINT[];")
+
+        # кэш эмбеддингов по содержимому: (модель, sha1 нормализованного текста)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS emb_cache (
+            model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            emb JSONB NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (model, text_hash)
+        );
+        """)
+
+        # лексический индекс книги (app/bm25.py): строится при импорте чанков
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS bm25_index (
+            book_id TEXT PRIMARY KEY,
+            chunks_version TEXT NOT NULL,
+            data JSONB NOT NULL,
+            built_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """)
+
+        # конспекты книг: пересчитываются только при смене набора чанков
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS summaries (
+            book_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            chunks_version TEXT NOT NULL,
+            summary JSONB NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (book_id, model, chunks_version)
+        );
+        """)
+
+        # кэш ответов LLM (app/llm_cache.py, LLM_CACHE=db)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            last_hit_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_hit ON llm_cache(last_hit_at);")
 
         cur.execute("""
         CREATE TABLE IF NOT EXISTS drafts (
@@ -53,6 +195,54 @@ def init_db():
         cur.execute("ALTER TABLE drafts ADD COLUMN IF NOT EXISTS approved_by TEXT;")
         cur.execute("ALTER TABLE drafts ADD COLUMN IF NOT EXISTS approved_at TIMESTAMPTZ;")
 
+        # outbox: доставка постов с ретраями и защитой от двойной отправки (app/outbox.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id SERIAL PRIMARY KEY,
+            draft_id INTEGER NOT NULL,
+            channel TEXT NOT NULL,
+            alias TEXT NOT NULL,
+            token_env TEXT NOT NULL,
+            api_base TEXT,
+            text TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_retry_at TIMESTAMPTZ DEFAULT NOW(),
+            due_at TIMESTAMPTZ,
+            claimed_at TIMESTAMPTZ,
+            sent_at TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            UNIQUE (draft_id, channel)
+        );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox(state, next_retry_at);")
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS metrics_snapshots (
+            id SERIAL PRIMARY KEY,
+            at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            data JSONB NOT NULL
+        );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_metrics_snapshots_at ON metrics_snapshots(at);")
+
+        # пакетная генерация (Batch API): план и текущий пакет, см. planner.poll_batch_jobs
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            id SERIAL PRIMARY KEY,
+            stage TEXT NOT NULL,                 -- summary | posts
+            batch_id TEXT NOT NULL,
+            plan JSONB NOT NULL,
+            state TEXT NOT NULL DEFAULT 'open',  -- open | done | failed
+            control_row INTEGER,
+            note TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_open ON batch_jobs(state);")
+
         cur.execute("CREATE INDEX IF NOT EXISTS idx_drafts_pub ON drafts(channel, publish_date, publish_time);")
         cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_drafts_unique ON drafts(channel, publish_date, format);")
 
@@ -60,20 +250,211 @@ def init_db():
     print("DB: tables ensured")
 
 
+# ---- Буферизованная запись логов ----
+# add_log только кладёт строку в очередь; фоновый поток пишет пачками
+# (по размеру или по времени) и раз в час чистит старые записи.
+# После flush_logs (atexit) писателя уже нет — add_log пишет синхронно.
+#
+# Срок хранения — DELETE порциями по LOG_PURGE_BATCH строк, каждая в своей
+# транзакции: не держит длинных блокировок и не раздувает одну транзакцию.
+# Партиционирование logs по дням не делаем: таблица создаётся как обычная
+# (SERIAL), перевод на PARTITION BY — ручная миграция, а объём логов
+# при пакетной записи невелик.
+_LOG_Q: queue.Queue = queue.Queue(maxsize=int(os.getenv("LOG_BUFFER_MAX", "10000")))
+_LOG_STOP = threading.Event()
+_LOG_THREAD: threading.Thread | None = None
+_LOG_LOCK = threading.Lock()
+_LOG_STATS = {"written": 0, "dropped": 0, "failed": 0}
+
+def _count(key: str, n: int = 1) -> None:
+    with _LOG_LOCK:
+        _LOG_STATS[key] += n
+
+def _write_logs(batch: list[tuple[dt.datetime, str]]) -> None:
+    with get_conn() as conn, conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO logs(at, message) VALUES %s", batch)
+
+def _purge_logs() -> None:
+    days = int(os.getenv("LOG_RETENTION_DAYS", "30"))
+    if days <= 0:
+        return
+    limit = int(os.getenv("LOG_PURGE_BATCH", "5000"))
+    total = 0
+    while True:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+            DELETE FROM logs WHERE id IN (
+              SELECT id FROM logs WHERE at < NOW() - make_interval(days => %s) ORDER BY id LIMIT %s
+            );
+            """, (days, limit))
+            n = cur.rowcount
+        total += n
+        if n < limit:
+            break
+    if total:
+        print(f"[LOG] purged {total} rows older than {days}d")
+
+def _flush_batch(batch: list) -> None:
+    if not batch:
+        return
+    try:
+        _write_logs(batch)
+        _count("written", len(batch))
+    except Exception as e:
+        _count("failed", len(batch))
+        print(f"[LOG ERR] {e}")
+
+def _log_writer() -> None:
+    batch_size = int(os.getenv("LOG_BATCH_SIZE", "200"))
+    flush_sec = float(os.getenv("LOG_FLUSH_SEC", "5"))
+    purge_every = 3600.0
+    last_purge = 0.0
+    while True:
+        batch = []
+        deadline = time.monotonic() + flush_sec
+        while len(batch) < batch_size:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(_LOG_Q.get(timeout=left))
+            except queue.Empty:
+                break
+            if _LOG_STOP.is_set():
+                break
+        if _LOG_STOP.is_set():
+            # при остановке забираем всё, что осталось в очереди
+            batch.extend(_drain())
+        _flush_batch(batch)
+        if _LOG_STOP.is_set():
+            return
+        if time.monotonic() - last_purge >= purge_every:
+            last_purge = time.monotonic()
+            try:
+                _purge_logs()
+            except Exception as e:
+                print(f"[LOG ERR] purge: {e}")
+
+def _ensure_log_writer() -> None:
+    global _LOG_THREAD
+    if _LOG_THREAD is not None:
+        return
+    with _LOG_LOCK:
+        if _LOG_THREAD is None:
+            _LOG_THREAD = threading.Thread(target=_log_writer, name="log-writer", daemon=True)
+            _LOG_THREAD.start()
+
+def _drain() -> list:
+    batch = []
+    while True:
+        try:
+            batch.append(_LOG_Q.get_nowait())
+        except queue.Empty:
+            return batch
+
 def add_log(message: str):
-    with _get_conn() as conn, conn.cursor() as cur:
-        cur.execute("INSERT INTO logs(message) VALUES (%s)", (message,))
-        conn.commit()
+    """Неблокирующая запись в logs: при переполнении буфера строка отбрасывается."""
+    item = (dt.datetime.now(dt.timezone.utc), message)
+    if _LOG_STOP.is_set():
+        _flush_batch([item])  # writer остановлен (flush_logs) — пишем сразу
+        return
+    _ensure_log_writer()
+    try:
+        _LOG_Q.put_nowait(item)
+    except queue.Full:
+        _count("dropped")
+    if _LOG_STOP.is_set() and not (_LOG_THREAD and _LOG_THREAD.is_alive()):
+        # остановка случилась между проверкой и put: writer строку уже не заберёт
+        _flush_batch(_drain())
+
+def flush_logs(timeout: float = 10.0) -> None:
+    """Дописать буфер и остановить writer (вызывается при завершении процесса)."""
+    if _LOG_THREAD is None:
+        return
+    _LOG_STOP.set()
+    _LOG_THREAD.join(timeout)
+    if not _LOG_THREAD.is_alive():
+        _flush_batch(_drain())
+    stats = log_stats()
+    if stats["dropped"] or stats["failed"]:
+        print(f"[LOG] dropped={stats['dropped']} failed={stats['failed']}")
+
+def log_stats() -> dict:
+    with _LOG_LOCK:
+        stats = dict(_LOG_STATS)
+    return {**stats, "queued": _LOG_Q.qsize()}
+
+atexit.register(flush_logs)
 
 def count_chunks(book_id: str) -> int:
-    with _get_conn() as conn, conn.cursor() as cur:
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute("SELECT COUNT(*) FROM chunks WHERE book_id=%s;", (book_id,))
         (n,) = cur.fetchone()
         return int(n or 0)
 
+def fetch_summary(book_id: str, model: str, version: str) -> dict | None:
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT summary FROM summaries WHERE book_id=%s AND model=%s AND chunks_version=%s;",
+            (book_id, model, version),
+        )
+        row = cur.fetchone()
+        return row[0] if row else None
+
+def save_summary(book_id: str, model: str, version: str, summary: dict):
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        INSERT INTO summaries(book_id, model, chunks_version, summary)
+        VALUES (%s, %s, %s, %s::jsonb)
+        ON CONFLICT (book_id, model, chunks_version) DO UPDATE
+          SET summary=EXCLUDED.summary, created_at=NOW();
+        """, (book_id, model, version, json.dumps(summary, ensure_ascii=False)))
+        # старые версии конспекта этой книги больше не нужны
+        cur.execute(
+            "DELETE FROM summaries WHERE book_id=%s AND model=%s AND chunks_version<>%s;",
+            (book_id, model, version),
+        )
+        conn.commit()
+
+def create_batch_job(stage: str, batch_id: str, plan: dict, control_row: int | None = None) -> int:
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        INSERT INTO batch_jobs(stage, batch_id, plan, control_row)
+        VALUES (%s, %s, %s::jsonb, %s) RETURNING id;
+        """, (stage, batch_id, json.dumps(plan, ensure_ascii=False), control_row))
+        (job_id,) = cur.fetchone()
+        conn.commit()
+        return int(job_id)
+
+def open_batch_jobs() -> list[dict]:
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        SELECT id, stage, batch_id, plan, control_row, created_at
+          FROM batch_jobs WHERE state='open' ORDER BY id;
+        """)
+        cols = ("id", "stage", "batch_id", "plan", "control_row", "created_at")
+        out = []
+        for row in cur.fetchall():
+            job = dict(zip(cols, row))
+            if isinstance(job["plan"], str):
+                job["plan"] = json.loads(job["plan"])
+            out.append(job)
+        return out
+
+def update_batch_job(job_id: int, *, stage: str | None = None, batch_id: str | None = None,
+                     state: str | None = None, note: str | None = None):
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        UPDATE batch_jobs
+           SET stage=COALESCE(%s, stage), batch_id=COALESCE(%s, batch_id),
+               state=COALESCE(%s, state), note=COALESCE(%s, note), updated_at=NOW()
+         WHERE id=%s;
+        """, (stage, batch_id, state, note, job_id))
+        conn.commit()
+
 def upsert_draft(channel: str, fmt: str, book_id: str, text: str, d: str, t: str) -> int:
     """Создать/обновить черновик на дату/время. Возвращает id."""
-    with _get_conn() as conn, conn.cursor() as cur:
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute("""
         INSERT INTO drafts(channel, format, book_id, text, publish_date, publish_time, status)
         VALUES (%s,%s,%s,%s,%s,%s,COALESCE(%s,'new'))
@@ -87,7 +468,7 @@ def upsert_draft(channel: str, fmt: str, book_id: str, text: str, d: str, t: str
 
 def fetch_draft(channel: str, fmt: str, d: str):
     """Вернуть один черновик (id, text, edited_text, status) на дату d."""
-    with _get_conn() as conn, conn.cursor() as cur:
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute("""
         SELECT id, text, edited_text, status
         FROM drafts
@@ -97,24 +478,46 @@ def fetch_draft(channel: str, fmt: str, d: str):
         row = cur.fetchone()
         return row  # None | (id, text, edited_text, status)
 
-def apply_sheet_row(r: dict):
-    """Синхронизировать одну строку из Google Sheets в БД по id (только статус/edited_text)."""
+def fetch_draft_by_id(draft_id: int, timeout_ms: int | None = None):
+    """(id, text, edited_text, status) по id; timeout_ms — statement_timeout для быстрой перепроверки."""
+    with get_conn() as conn, conn.cursor() as cur:
+        if timeout_ms:
+            cur.execute("SET LOCAL statement_timeout = %s;", (int(timeout_ms),))
+        cur.execute("SELECT id, text, edited_text, status FROM drafts WHERE id=%s;", (draft_id,))
+        return cur.fetchone()
+
+def _sheet_row_params(r: dict) -> tuple | None:
     try:
         draft_id = int(r.get("id") or 0)
     except Exception:
-        return
+        return None
     if draft_id <= 0:
-        return
+        return None
     status = (r.get("status") or "").strip().lower() or "new"
     edited = r.get("edited_text") or None
-    with _get_conn() as conn, conn.cursor() as cur:
-        cur.execute("""
-        UPDATE drafts
-           SET status=%s,
-               edited_text=%s,
-               approved_by=COALESCE(%s, approved_by),
-               approved_at=CASE WHEN %s='approved' THEN NOW() ELSE approved_at END
-         WHERE id=%s;
-        """, (status, edited, r.get("approved_by"), status, draft_id))
+    return (draft_id, status, edited, r.get("approved_by"))
+
+def apply_sheet_rows(rows: list[dict]) -> int:
+    """
+    Синхронизировать пачку строк из Google Sheets (только статус/edited_text)
+    одним UPDATE ... FROM (VALUES ...) в одной транзакции. Возвращает число строк.
+    """
+    params = [p for p in (_sheet_row_params(r) for r in rows) if p]
+    if not params:
+        return 0
+    with get_conn() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+        UPDATE drafts AS d
+           SET status=v.status,
+               edited_text=v.edited_text,
+               approved_by=COALESCE(v.approved_by, d.approved_by),
+               approved_at=CASE WHEN v.status='approved' THEN NOW() ELSE d.approved_at END
+          FROM (VALUES %s) AS v(id, status, edited_text, approved_by)
+         WHERE d.id=v.id;
+        """, params, template="(%s::int, %s::text, %s::text, %s::text)")
         conn.commit()
+    return len(params)
 
+def apply_sheet_row(r: dict):
+    """Синхронизировать одну строку из Google Sheets в БД по id (только статус/edited_text)."""
+    apply_sheet_rows([r])
@@ -1,28 +1,54 @@
 from __future__ import annotations
-import re, hashlib, os
-from typing import List
+import re, io, hashlib, os, json, queue, threading
+from itertools import islice
+from typing import List, Dict, Tuple, Iterable, Iterator
 from app.db import get_conn, count_chunks
 from app.gpt import embed_texts
+from app.retriever import invalidate_book
+from app import bm25, minhash
 
 def _normalize_ws(s: str) -> str:
     return re.sub(r"\s+", " ", s).strip()
 
-def chunk_text(text: str, target_chars: int = 1200, overlap: int = 200) -> List[str]:
-    parts = [p.strip() for p in re.split(r"\n{2,}", text) if p.strip()]
-    chunks, buf = [], ""
-    for p in parts:
+_PARA_SPLIT = re.compile(r"\n{2,}")
+
+def _max_chunks() -> int:
+    # 0 — без ограничения (потоковый импорт больше не упирается во время)
+    return int(os.getenv("EMBED_MAX_CHUNKS", "0"))
+
+def iter_paragraphs(pieces: Iterable[str]) -> Iterator[str]:
+    """Абзацы (разделитель — пустая строка) из потока кусков текста."""
+    rest = ""
+    for piece in pieces:
+        rest += piece
+        parts = _PARA_SPLIT.split(rest)
+        rest = parts.pop()  # последний абзац может продолжиться в следующем куске
+        for p in parts:
+            p = p.strip()
+            if p:
+                yield p
+    rest = rest.strip()
+    if rest:
+        yield rest
+
+def iter_chunks(pieces: Iterable[str], target_chars: int = 1200, overlap: int = 200) -> Iterator[str]:
+    """Потоковый вариант chunk_text: память — один буфер чанка, а не вся книга."""
+    buf = ""
+    for p in iter_paragraphs(pieces):
         if len(buf) + len(p) + 1 <= target_chars:
             buf = (buf + "\n\n" + p).strip() if buf else p
         else:
             if buf:
-                chunks.append(buf)
+                yield buf
             tail = buf[-overlap:] if buf else ""
             buf = (tail + "\n\n" + p).strip()
     if buf:
-        chunks.append(buf)
-    # Ограничим количество чанков на импорт (MVP/без биллинга)
-    cap = int(os.getenv("EMBED_MAX_CHUNKS", "30"))
-    return chunks[:cap]
+        yield buf
+
+def chunk_text(text: str, target_chars: int = 1200, overlap: int = 200) -> List[str]:
+    chunks = list(iter_chunks([text], target_chars, overlap))
+    cap = _max_chunks()
+    return chunks[:cap] if cap > 0 else chunks
 
 def _sha1(s: str) -> str:
     import hashlib as _h
@@ -31,31 +57,255 @@ def _sha1(s: str) -> str:
 def json_dumps_float(arr: List[float]) -> str:
     return "[" + ",".join(f"{x:.7f}" for x in arr) + "]"
 
-def _batch_iter(lst: List[str], n: int):
-    for i in range(0, len(lst), n):
-        yield lst[i:i+n]
+def _embed_model() -> str:
+    return os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+
+def _is_zero(e: List[float]) -> bool:
+    # фолбэк embed_texts при исчерпании ретраев — такие векторы не кэшируем
+    return not any(e)
+
+def _embed_with_cache(texts: List[str]) -> Tuple[List[List[float]], int, int, Dict[str, List[float]]]:
+    """
+    Эмбеддинги для texts через таблицу emb_cache.
+    Кэш читается коротким отдельным соединением; в API (секунды–минуты)
+    уходят только тексты, которых ещё нет в кэше (уникальные), и соединение
+    при этом не держится. Новые векторы возвращаются отдельно — их пишет
+    вызывающий через _store_cache в своей транзакции вместе с чанками.
+    Возвращает (embs, hits, misses, fresh).
+    """
+    model = _embed_model()
+    keys = [_sha1(t) for t in texts]
+
+    cached: Dict[str, List[float]] = {}
+    uniq = list(dict.fromkeys(keys))
+    if uniq:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT text_hash, emb FROM emb_cache WHERE model=%s AND text_hash = ANY(%s);",
+                (model, uniq),
+            )
+            for h, emb in cur.fetchall():
+                cached[h] = json.loads(emb) if isinstance(emb, str) else emb
+
+    hits = sum(1 for k in keys if k in cached)
+    todo: Dict[str, str] = {}
+    for k, t in zip(keys, texts):
+        if k not in cached and k not in todo:
+            todo[k] = t
+
+    fresh: Dict[str, List[float]] = {}
+    todo_keys = list(todo)
+    if todo_keys:
+        # embed_texts сам пакует по токенам и шлёт пачки параллельно
+        embs = embed_texts([todo[k] for k in todo_keys])  # уже с ретраями/фолбэком
+        for k, e in zip(todo_keys, embs):
+            cached[k] = e
+            if not _is_zero(e):
+                fresh[k] = e
+
+    return [cached[k] for k in keys], hits, len(keys) - hits, fresh
+
+def _store_cache(cur, fresh: Dict[str, List[float]]) -> None:
+    model = _embed_model()
+    for k, e in fresh.items():
+        cur.execute(
+            """
+            INSERT INTO emb_cache(model, text_hash, emb)
+            VALUES (%s, %s, %s::jsonb)
+            ON CONFLICT (model, text_hash) DO NOTHING
+            """,
+            (model, k, json_dumps_float(e)),
+        )
+
+def _copy_escape(v) -> str:
+    if v is None:
+        return "\\N"
+    return (str(v).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def _write_chunks(cur, book_id: str, title: str, author: str, start: int,
+                  texts: List[str], embs: List[List[float]], hash_key: str | None = None):
+    """
+    Пачка чанков за два запроса: COPY во временную таблицу + один
+    INSERT ... SELECT ... ON CONFLICT (вместо INSERT на каждую строку).
+    """
+    cur.execute("""
+    CREATE TEMP TABLE IF NOT EXISTS chunks_stage (
+        book_id TEXT, title TEXT, author TEXT, chunk_id INTEGER,
+        text TEXT, emb TEXT, hash TEXT, minhash TEXT
+    ) ON COMMIT DELETE ROWS;
+    """)
+    cur.execute("TRUNCATE chunks_stage;")
+    buf = io.StringIO()
+    for i_off, (t, e) in enumerate(zip(texts, embs), start=start):
+        h = _sha1(f"{hash_key or book_id}:{i_off}:{t[:64]}")
+        sig = "{" + ",".join(map(str, minhash.signature(t))) + "}"
+        row = (book_id, title, author, i_off, t, json_dumps_float(e), h, sig)
+        buf.write("\t".join(_copy_escape(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(
+        "COPY chunks_stage(book_id, title, author, chunk_id, text, emb, hash, minhash) FROM STDIN", buf
+    )
+    cur.execute(
+        """
+        INSERT INTO chunks(book_id, title, author, chunk_id, text, emb, hash, minhash)
+        SELECT book_id, title, author, chunk_id, text, emb::jsonb, hash, minhash::bigint[] FROM chunks_stage
+        ON CONFLICT (book_id, chunk_id) DO UPDATE
+          SET text = EXCLUDED.text, emb = EXCLUDED.emb, hash = EXCLUDED.hash, minhash = EXCLUDED.minhash
+        """
+    )
 
 def upsert_book_chunks(book_id: str, title: str, author: str, chunks: List[str]) -> int:
     texts = [_normalize_ws(c) for c in chunks]
+    embs, hits, misses, fresh = _embed_with_cache(texts)
+    with get_conn() as conn, conn.cursor() as cur:
+        _store_cache(cur, fresh)
+        _write_chunks(cur, book_id, title, author, 1, texts, embs)
+        bm25.rebuild(cur, book_id)
+        conn.commit()
+    invalidate_book(book_id)
+    print(f"[EMB CACHE] {book_id}: hits={hits} misses={misses}")
+    return len(texts)
+
+# ---------- Потоковый импорт ----------
+# текст → чанкер → [очередь] → N потоков эмбеддингов → [очередь] → запись в БД.
+# Очереди ограничены, поэтому скачивание не убегает вперёд эмбеддингов,
+# а память не зависит от размера книги.
+# Соединения из пула берутся только на короткие шаги: чтение emb_cache
+# в эмбеддере и запись пачки (кэш + чанки) в writer — не на время API,
+# поэтому импорт занимает не больше workers + 1 слотов и лишь на миллисекунды.
+_DONE = object()
+
+def _q_put(q: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+def _q_get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _DONE
+
+def _stage_key(book_id: str) -> str:
+    return f"__ingest__:{book_id}"
+
+def ingest_stream(book_id: str, title: str, author: str, pieces: Iterable[str]) -> int:
+    """
+    Импорт книги из потока кусков текста (см. gdrive.iter_text).
+    Скачивание, эмбеддинги и запись в БД идут одновременно.
+    Чанки пишутся под временным ключом и в конце одной транзакцией
+    подменяют старую версию книги; при ошибке временные строки удаляются,
+    а старая версия остаётся как была.
+    Возвращает число записанных чанков.
+    """
     batch = int(os.getenv("EMBED_BATCH_SIZE", "16"))
-    inserted = 0
+    workers = max(1, int(os.getenv("INGEST_EMBED_WORKERS", "3")))
+    depth = max(1, int(os.getenv("INGEST_QUEUE_SIZE", "4")))
+    cap = _max_chunks()
+
+    q_embed: queue.Queue = queue.Queue(maxsize=depth)
+    q_db: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    stats = {"written": 0, "hits": 0, "misses": 0}
+    lock = threading.Lock()
+    stage = _stage_key(book_id)
+
+    # хвосты прошлого упавшего импорта (например, процесс убили посреди)
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM chunks WHERE book_id=%s;", (stage,))
+
+    def _fail(e: BaseException):
+        with lock:
+            errors.append(e)
+        stop.set()
+
+    def _embedder():
+        try:
+            while True:
+                item = _q_get(q_embed, stop)
+                if item is _DONE:
+                    break
+                start, texts = item
+                embs, hits, misses, fresh = _embed_with_cache(texts)
+                with lock:
+                    stats["hits"] += hits
+                    stats["misses"] += misses
+                _q_put(q_db, (start, texts, embs, fresh), stop)
+        except BaseException as e:
+            _fail(e)
+        finally:
+            _q_put(q_db, _DONE, stop)
+
+    def _writer():
+        done = 0
+        try:
+            while done < workers:
+                item = _q_get(q_db, stop)
+                if item is _DONE:
+                    if stop.is_set():
+                        break
+                    done += 1
+                    continue
+                start, texts, embs, fresh = item
+                # соединение — на одну пачку, а не на весь импорт
+                with get_conn() as conn, conn.cursor() as cur:
+                    _store_cache(cur, fresh)
+                    _write_chunks(cur, stage, title, author, start, texts, embs, hash_key=book_id)
+                with lock:
+                    stats["written"] += len(texts)
+        except BaseException as e:
+            _fail(e)
+
+    threads = [threading.Thread(target=_embedder, name=f"ingest-emb-{i}", daemon=True) for i in range(workers)]
+    threads.append(threading.Thread(target=_writer, name="ingest-db", daemon=True))
+    for t in threads:
+        t.start()
+
+    total = 0
+    try:
+        chunks = (_normalize_ws(c) for c in iter_chunks(pieces))
+        if cap > 0:
+            chunks = islice(chunks, cap)
+        while not stop.is_set():
+            part = list(islice(chunks, batch))
+            if not part:
+                break
+            _q_put(q_embed, (total + 1, part), stop)
+            total += len(part)
+    except BaseException as e:
+        _fail(e)
+    finally:
+        for _ in range(workers):
+            _q_put(q_embed, _DONE, stop)
+        for t in threads:
+            t.join()
+
+    if errors:
+        try:
+            with get_conn() as conn, conn.cursor() as cur:
+                cur.execute("DELETE FROM chunks WHERE book_id=%s;", (stage,))
+        except Exception as e:
+            print(f"[INGEST WARN] {book_id}: can't drop staged chunks: {e}")
+        invalidate_book(book_id)
+        raise errors[0]
+
+    # подмена версии книги целиком: читатели видят либо старую, либо новую
     with get_conn() as conn, conn.cursor() as cur:
-        for part in _batch_iter(texts, batch):
-            embs = embed_texts(part)  # уже с ретраями/фолбэком
-            for i_off, (t, e) in enumerate(zip(part, embs), start=inserted + 1):
-                h = _sha1(f"{book_id}:{i_off}:{t[:64]}")
-                cur.execute(
-                    """
-                    INSERT INTO chunks(book_id, title, author, chunk_id, text, emb, hash)
-                    VALUES (%s, %s, %s, %s, %s, %s::jsonb, %s)
-                    ON CONFLICT (book_id, chunk_id) DO UPDATE
-                      SET text = EXCLUDED.text, emb = EXCLUDED.emb, hash = EXCLUDED.hash
-                    """,
-                    (book_id, title, author, i_off, t, json_dumps_float(e), h),
-                )
-            inserted += len(part)
+        cur.execute("DELETE FROM chunks WHERE book_id=%s;", (book_id,))
+        cur.execute("UPDATE chunks SET book_id=%s WHERE book_id=%s;", (book_id, stage))
+        bm25.rebuild(cur, book_id)
         conn.commit()
-    return inserted
+    invalidate_book(book_id)
+    print(f"[EMB CACHE] {book_id}: hits={stats['hits']} misses={stats['misses']}")
+    return stats["written"]
 
 def ingest_from_file(book_id: str, title: str, author: str, path: str) -> int:
     with open(path, "r", encoding="utf-8") as f:
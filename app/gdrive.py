@@ -1,5 +1,6 @@
 from __future__ import annotations
-import os, json, io
+import os, json, io, codecs
+from typing import Iterator
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 from google.oauth2.service_account import Credentials
@@ -14,17 +15,31 @@ def _drive_service():
     creds = Credentials.from_service_account_info(info, scopes=SCOPES)
     return build("drive", "v3", credentials=creds, cache_discovery=False)
 
-def download_text(file_id: str) -> str:
+def iter_text(file_id: str, chunk_size: int | None = None) -> Iterator[str]:
+    """
+    Текст файла кусками по мере скачивания (Google Doc — через export).
+    UTF-8 декодируется инкрементально, буфер после каждого куска сбрасывается.
+    """
+    chunk_size = chunk_size or int(os.getenv("GDRIVE_CHUNK_BYTES", str(1024 * 1024)))
     svc = _drive_service()
     meta = svc.files().get(fileId=file_id, fields="id,name,mimeType").execute()
     mime = meta.get("mimeType")
     if mime == "application/vnd.google-apps.document":
-        data = svc.files().export(fileId=file_id, mimeType="text/plain").execute()
-        return data.decode("utf-8", errors="ignore") if isinstance(data, bytes) else str(data)
-    req = svc.files().get_media(fileId=file_id)
+        req = svc.files().export_media(fileId=file_id, mimeType="text/plain")
+    else:
+        req = svc.files().get_media(fileId=file_id)
     buf = io.BytesIO()
-    downloader = MediaIoBaseDownload(buf, req)
+    downloader = MediaIoBaseDownload(buf, req, chunksize=chunk_size)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
     done = False
     while not done:
         _, done = downloader.next_chunk()
-    return buf.getvalue().decode("utf-8", errors="ignore")
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        text = decoder.decode(data, final=done)
+        if text:
+            yield text
+
+def download_text(file_id: str) -> str:
+    return "".join(iter_text(file_id))
@@ -1,28 +1,30 @@
 # app/generator.py
 from __future__ import annotations
 
-import os, json, re
-from typing import Dict, List, Any
-
-from app.retriever import search_book
-from app.gpt import _client
+import os, json, re, math, threading
+from pathlib import Path
+from typing import Callable, Dict, List, Any, Tuple, Iterable
+from collections import OrderedDict
+import yaml
+import numpy as np
+
+from app.retriever import search_book_many, book_version
+from app.gpt import _client, _record_usage, _est_tokens, stream_chat
+from app import llm_cache, metrics, batch, postprocess, minhash
+from app.db import fetch_summary, save_summary
 from app.sheets import get_book_meta  # автор/метаданные из листа books
 
 MODEL_SUMMARY = os.getenv("OPENAI_MODEL_SUMMARY", "gpt-4o-mini")
 MODEL_POSTS   = os.getenv("OPENAI_MODEL_POSTS",   "gpt-4o-mini")
+TOV_FILE = Path(__file__).resolve().parents[1] / "config" / "tov.yaml"
 
-_SUMMARY_CACHE: Dict[str, Dict[str, Any]] = {}
+# LRU конспектов перед таблицей summaries: (book_id, model, chunks_version) -> summary
+_SUMMARY_CACHE: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+_SUMMARY_CACHE_MAX = int(os.getenv("SUMMARY_CACHE_SIZE", "32"))
+_SUMMARY_LOCKS: Dict[str, threading.Lock] = {}
+_SUMMARY_LOCKS_GUARD = threading.Lock()
 
 # ---------- Текстовые утилиты ----------
-def _clean_bold(s: str) -> str:
-    return s.replace("**", "").strip()
-
-def _squash_blanks(s: str) -> str:
-    return re.sub(r"\n{3,}", "\n\n", s).strip()
-
-def _normalize(s: str) -> str:
-    return _squash_blanks(_clean_bold(s))
-
 def _deslug(s: str) -> str:
     # Убираем расширения, подчёркивания/дефисы, лишние пробелы
     s = re.sub(r"\.(pdf|docx?|rtf|epub|txt)$", "", s, flags=re.I)
@@ -30,44 +32,6 @@ def _deslug(s: str) -> str:
     s = re.sub(r"\s{2,}", " ", s).strip()
     return s
 
-# Анти-кликбейт (фикс: это строка, не tuple)
-_STOP_START = r"(?:знаете ли вы|вы знали|а знаете|а что если|что если|секрет в том|многие не знают|представьте|представь)"
-
-def _declickbait(text: str) -> str:
-    if not text:
-        return text
-    text = re.sub(r"(?im)^\s*" + _STOP_START + r".{0,120}\?\s*\n?", "", text)
-    text = re.sub(r"(?im)в\s+одной\s+из\s+глав.*?(?:\.|\n)", "", text)
-    text = re.sub(r"(?im)эта\s+книга\s+покажет.*?(?:\.|\n)", "", text)
-    # Доп. штампики
-    text = re.sub(r"(?im)погрузитесь\s+в\s+мир.*?(?:\.|\n)", "", text)
-    text = re.sub(r"(?im)откройте\s+новые\s+горизонты.*?(?:\.|\n)", "", text)
-    return _squash_blanks(text)
-
-# Ограничение эмодзи
-_EMOJI_RE = re.compile(
-    r"[\U0001F1E6-\U0001F1FF]|"   # флаги
-    r"[\U0001F300-\U0001F5FF]|"   # символы/пиктограммы
-    r"[\U0001F600-\U0001F64F]|"   # смайлики
-    r"[\U0001F680-\U0001F6FF]|"   # транспорт/символы
-    r"[\U00002600-\U000026FF]|"   # разное
-    r"[\U00002700-\U000027BF]|"   # литералы
-    r"[\U0001FA70-\U0001FAFF]",   # расширения
-    flags=re.UNICODE
-)
-
-def _limit_emojis(text: str, max_count: int) -> str:
-    if max_count <= 0:
-        return _EMOJI_RE.sub("", text)
-    out, used = [], 0
-    for ch in text:
-        if _EMOJI_RE.fullmatch(ch):
-            if used < max_count:
-                out.append(ch); used += 1
-        else:
-            out.append(ch)
-    return "".join(out)
-
 # ---------- Нормализация меты из листа ----------
 def _as_meta_dict(meta_like) -> Dict[str, Any]:
     # get_book_meta может вернуть dict ИЛИ (dict, row)
@@ -159,7 +123,29 @@ def _book_author(summary: Dict[str, Any], book_id: str) -> str:
     return a
 
 # ---------- Контекст для суммаризации ----------
+_OVERLAP_MAX = 400  # iter_chunks перекрывает соседей на 200 символов; с запасом на нормализацию
+
+def _overlap(prev: str, cur: str, probe: int = 32) -> int:
+    """Длина общего куска «хвост prev = начало cur» (перекрытие соседних чанков), 0 — нет."""
+    if len(cur) < probe or len(prev) < probe:
+        return 0
+    head = cur[:probe]
+    lo = max(0, len(prev) - _OVERLAP_MAX)
+    i = prev.rfind(head, lo)
+    while i != -1:
+        if cur.startswith(prev[i:]):
+            return len(prev) - i
+        i = prev.rfind(head, lo, i + probe - 1)
+    return 0
+
 def _collect_context(book_id: str) -> str:
+    """
+    Фрагменты книги для конспекта: кандидаты по шести запросам, затем
+    жадный MMR — релевантность минус вложенность (MinHash) в уже взятые;
+    почти-дубликаты отбрасываются совсем. Перекрытие соседних чанков
+    в текст и в бюджет SUMMARY_CONTEXT_TOKENS идёт один раз. Склеиваем
+    в порядке книги.
+    """
     queries = [
         "основная идея книги в целом",
         "ключевые принципы и правила автора",
@@ -168,21 +154,81 @@ def _collect_context(book_id: str) -> str:
         "сильные цитаты и формулировки",
         "для кого книга и как использовать материалы",
     ]
-    chunks, seen = [], set()
-    for q in queries:
-        for ch in search_book(book_id, q, top_k=10):
-            t = (ch.get("text") or "").strip()
-            if t and t not in seen:
-                seen.add(t); chunks.append(t)
-            if len(chunks) >= 60:
-                break
-        if len(chunks) >= 60:
-            break
-    joined = "\n\n".join(chunks)
-    return joined[:40_000] if len(joined) > 40_000 else joined
+    budget = int(os.getenv("SUMMARY_CONTEXT_TOKENS", "20000"))
+    lam = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+    dup = float(os.getenv("CONTEXT_DUP_THRESHOLD", "0.5"))
+
+    # релевантность кандидата — лучшая по запросам, каждый запрос нормирован на свой топ
+    rel: Dict[int, float] = {}
+    texts: Dict[int, str] = {}
+    sig_of: Dict[int, np.ndarray] = {}
+    for hits in search_book_many(book_id, queries, top_k=10):
+        top = max((h["score"] for h in hits), default=0.0) or 1.0
+        for h in hits:
+            t = (h.get("text") or "").strip()
+            if not t:
+                continue
+            cid = h["chunk_id"]
+            texts[cid] = t
+            sig_of[cid] = h["minhash"]
+            rel[cid] = max(rel.get(cid, 0.0), h["score"] / top)
+    if not rel:
+        return ""
+
+    cand = list(rel)
+    sigs = np.stack([sig_of[c] for c in cand])
+    sizes = np.array([minhash.size(texts[c]) for c in cand], dtype=np.float32)
+    # перекрытие с предыдущим чанком книги, если он тоже среди кандидатов
+    ov = {c: _overlap(texts[c - 1], texts[c]) for c in cand if c - 1 in texts}
+    score = np.array([rel[c] for c in cand], dtype=np.float32)
+    max_sim = np.zeros(len(cand), dtype=np.float32)
+    alive = np.ones(len(cand), dtype=bool)
+    picked: set = set()
+    used = dropped = 0
+    while alive.any():
+        mmr = np.where(alive, lam * score - (1 - lam) * max_sim, -np.inf)
+        i = int(np.argmax(mmr))
+        alive[i] = False
+        c = cand[i]
+        shared = (ov.get(c, 0) if c - 1 in picked else 0) + (ov.get(c + 1, 0) if c + 1 in picked else 0)
+        cost = _est_tokens(texts[c][:max(0, len(texts[c]) - shared)]) + 1
+        if used + cost > budget:
+            continue
+        picked.add(c)
+        used += cost
+        sim = minhash.containment(sigs[i], sizes[i], sigs, sizes)
+        max_sim = np.maximum(max_sim, sim)
+        near = alive & (sim >= dup)
+        # соседа с перекрытием не выбрасываем — его общий кусок просто вырежется
+        for j in np.flatnonzero(near):
+            if cand[j] in (c - 1, c + 1) and ov.get(max(c, cand[j]), 0):
+                near[j] = False
+        dropped += int(near.sum())
+        alive &= ~near
+
+    parts = []
+    for c in sorted(picked):
+        t = texts[c]
+        if c - 1 in picked and ov.get(c):
+            t = t[ov[c]:].lstrip()
+        if t:
+            parts.append(t)
+    metrics.inc("context_chunks_total", len(picked), result="picked")
+    metrics.inc("context_chunks_total", dropped, result="near_duplicate")
+    metrics.inc("context_overlap_chars_total", sum(ov[c] for c in picked if c - 1 in picked and c in ov))
+    return "\n\n".join(parts)
 
 # ---------- Конспект (JSON) ----------
-def _ask_json_summary(context: str, book_id: str, channel_name: str) -> Dict[str, Any]:
+def _is_json(s: str) -> bool:
+    try:
+        json.loads(s)
+        return True
+    except Exception:
+        return False
+
+_SUMMARY_FORMAT = {"type":"json_object"}
+
+def _summary_messages(context: str) -> List[Dict[str, str]]:
     system = "Ты редактор делового Telegram-канала. Сделай структурированный, прикладной конспект книги. Русский язык."
     user = f"""
 На входе фрагменты книги. Сделай JSON-конспект:
@@ -204,129 +250,347 @@ def _ask_json_summary(context: str, book_id: str, channel_name: str) -> Dict[str
 {context}
 ---
 """
-    resp = _client().chat.completions.create(
-        model=MODEL_SUMMARY,
-        messages=[{"role":"system","content":system},
-                  {"role":"user","content":user}],
-        temperature=0.2,
-        response_format={"type":"json_object"},
-    )
+    return [{"role":"system","content":system},
+            {"role":"user","content":user}]
+
+def _parse_summary(raw: str) -> Dict[str, Any]:
     try:
-        return json.loads(resp.choices[0].message.content)
+        return json.loads(raw)
     except Exception:
         return {
             "about":{"title":"","author":"","thesis":"","audience":""},
             "key_ideas":[],"practices":[],"cases":[],"quotes":[],"reflection":[]
         }
 
+def _ask_json_summary(context: str, book_id: str, channel_name: str) -> Dict[str, Any]:
+    messages = _summary_messages(context)
+
+    def _create() -> str:
+        with metrics.timer("openai_request_seconds", op="summary", model=MODEL_SUMMARY):
+            resp = _client().chat.completions.create(
+                model=MODEL_SUMMARY,
+                messages=messages,
+                temperature=0.2,
+                response_format=_SUMMARY_FORMAT,
+            )
+        _record_usage("summary", MODEL_SUMMARY, resp)
+        return resp.choices[0].message.content or ""
+
+    raw = llm_cache.cached(
+        "summary", _create,
+        model=MODEL_SUMMARY, messages=messages, temperature=0.2,
+        response_format=_SUMMARY_FORMAT, accept=_is_json,
+    )
+    return _parse_summary(raw)
+
+def _summary_cached(key: Tuple[str, str, str]) -> Dict[str, Any] | None:
+    with _SUMMARY_LOCKS_GUARD:
+        s = _SUMMARY_CACHE.get(key)
+        if s is not None:
+            _SUMMARY_CACHE.move_to_end(key)
+        return s
+
+def _summary_remember(key: Tuple[str, str, str], summary: Dict[str, Any]):
+    with _SUMMARY_LOCKS_GUARD:
+        _SUMMARY_CACHE[key] = summary
+        _SUMMARY_CACHE.move_to_end(key)
+        while len(_SUMMARY_CACHE) > max(1, _SUMMARY_CACHE_MAX):
+            _SUMMARY_CACHE.popitem(last=False)
+
+def summary_key(book_id: str) -> Tuple[str, str, str]:
+    return (book_id, MODEL_SUMMARY, book_version(book_id))
+
+def stored_summary(key: Tuple[str, str, str]) -> Dict[str, Any] | None:
+    """Готовый конспект из LRU или таблицы summaries (без генерации)."""
+    hit = _summary_cached(key)
+    if hit is None:
+        hit = fetch_summary(*key)
+        if hit is not None:
+            _summary_remember(key, hit)
+    return hit
+
+def store_summary(key: Tuple[str, str, str], summary: Dict[str, Any]):
+    try:
+        save_summary(*key, summary)
+    except Exception as e:
+        print(f"[SUMMARY WARN] can't persist {key[0]}: {e}")
+    _summary_remember(key, summary)
+
 def _ensure_summary(book_id: str, channel_name: str) -> Dict[str, Any]:
-    if book_id in _SUMMARY_CACHE:
-        return _SUMMARY_CACHE[book_id]
-    ctx = _collect_context(book_id)
-    summary = _ask_json_summary(ctx, book_id, channel_name)
-    _SUMMARY_CACHE[book_id] = summary
-    return summary
+    """
+    Конспект книги: LRU в памяти → таблица summaries → генерация.
+    Ключ включает версию набора чанков, так что после перезаливки книги
+    конспект пересчитывается, а после рестарта — берётся из БД.
+    """
+    key = summary_key(book_id)
+    hit = _summary_cached(key)
+    if hit is not None:
+        return hit
+    # форматы дня генерятся параллельно — конспект книги считаем один раз
+    with _SUMMARY_LOCKS_GUARD:
+        lock = _SUMMARY_LOCKS.setdefault(book_id, threading.Lock())
+    with lock:
+        hit = stored_summary(key)
+        if hit is not None:
+            return hit
+        with metrics.timer("generate_stage_seconds", stage="context"):
+            ctx = _collect_context(book_id)
+        with metrics.timer("generate_stage_seconds", stage="summary"):
+            summary = _ask_json_summary(ctx, book_id, channel_name)
+        store_summary(key, summary)
+        return summary
+
+def prewarm_summaries(book_ids: Iterable[str], channel_name: str = "") -> int:
+    """Заранее посчитать/поднять конспекты книг. Возвращает число успешных."""
+    ok = 0
+    for book_id in book_ids:
+        if not book_id:
+            continue
+        try:
+            _ensure_summary(book_id, channel_name)
+            ok += 1
+        except Exception as e:
+            print(f"[SUMMARY WARN] prewarm {book_id}: {e}")
+    return ok
+
+# ---------- Контекст поста ----------
+# Какие разделы конспекта нужны формату; about (тезис/аудитория) — всем.
+# Неизвестный формат (или пустые нужные разделы) — конспект целиком.
+_FORMAT_SECTIONS: Dict[str, Tuple[str, ...]] = {
+    "announce": ("about", "key_ideas"),
+    "insight":  ("about", "key_ideas"),
+    "practice": ("about", "practices"),
+    "case":     ("about", "cases", "key_ideas"),
+    "quote":    ("about", "quotes"),
+    "reflect":  ("about", "key_ideas", "reflection"),
+}
+
+def _compact(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _format_context(fmt: str, summary: Dict[str, Any]) -> str:
+    """Срез конспекта под формат в компактном JSON; пишет в метрики сэкономленные токены."""
+    sections = _FORMAT_SECTIONS.get(fmt)
+    part = summary if sections is None else {k: summary[k] for k in sections if summary.get(k)}
+    if set(part) <= {"about"}:
+        part = summary  # нужных разделов в конспекте нет — пусть модель берёт из всего
+    ctx = _compact(part)
+    full = _est_tokens(json.dumps(summary, ensure_ascii=False, indent=2))
+    saved = max(0, full - _est_tokens(ctx))
+    metrics.inc("prompt_tokens_saved_total", saved, fmt=fmt)
+    print(f"[PROMPT] {fmt}: context ~{_est_tokens(ctx)} tokens (saved ~{saved})")
+    return ctx
+
+# ---------- Длина поста (config/tov.yaml → max_len) ----------
+_TOV: Dict[str, Any] | None = None
+
+def _tov() -> Dict[str, Any]:
+    global _TOV
+    if _TOV is None:
+        try:
+            with open(TOV_FILE, "r", encoding="utf-8") as f:
+                _TOV = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            _TOV = {}
+    return _TOV
+
+def _postprocess_rules(channel_name: str) -> postprocess.Rules:
+    ch = ((_tov().get("channels") or {}).get(channel_name) or {})
+    return postprocess.rules_for(channel_name, ch.get("postprocess"))
+
+def _max_len(channel_name: str, fmt: str) -> int | None:
+    """max_len формата для канала (символы текста без заголовка и хэштегов)."""
+    ch = ((_tov().get("channels") or {}).get(channel_name) or {})
+    val = ((ch.get("formats") or {}).get(fmt) or {}).get("max_len")
+    return int(val) if val else None
+
+def _max_tokens_for(max_len: int | None) -> int | None:
+    """
+    Потолок max_tokens с запасом над max_len: обрезку по длине делает стрим,
+    а этот лимит только страхует от разговорчивой модели.
+    """
+    if not max_len:
+        return None
+    chars_per_token = float(os.getenv("GEN_CHARS_PER_TOKEN", "2"))
+    return math.ceil(max_len / chars_per_token * 1.2)
+
+_SENT_END = re.compile(r"[.!?…][»\"')\]]*(?=\s|$)|\n")
+
+def _cut_at_sentence(text: str, limit: int, force: bool = False) -> str:
+    """
+    Не длиннее limit, по границе предложения/строки; без неё — по слову с «…».
+    force — резать и короткий текст (ответ оборван по max_tokens на полуслове).
+    """
+    if len(text) <= limit and not force:
+        return text
+    head = text[:limit]
+    ends = [m.end() for m in _SENT_END.finditer(head)]
+    if ends and ends[-1] >= limit // 2:
+        return head[:ends[-1]].rstrip()
+    cut = head.rsplit(None, 1)[0] if " " in head else head
+    return cut.rstrip(" ,;:—-") + "…"
+
+def _fit_len(text: str, finish: str | None, max_len: int | None) -> str:
+    """
+    Общее правило для стрима, обычного запроса и Batch API: длиннее max_len —
+    режем по предложению; оборванный (cutoff/length) — подрезаем хвост всегда.
+    """
+    if finish in ("cutoff", "length"):
+        return _cut_at_sentence(text, min(len(text), max_len or len(text)), force=True)
+    if max_len and len(text) > max_len:
+        return _cut_at_sentence(text, max_len)
+    return text
+
+def _stream_enabled() -> bool:
+    return os.getenv("GEN_STREAM", "true").lower() == "true"
 
 # ---------- Генерация постов ----------
-def _gen_with_prompt(fmt: str, summary: Dict[str, Any], *, book_id: str, channel_name: str) -> str:
-    base = json.dumps(summary, ensure_ascii=False, indent=2)
+_PROMPTS = {
+    "announce": (
+        "Сделай анонс книги для Telegram.\n"
+        "Структура:\n"
+        "- 1 строка: зачем читать (без слов «эта книга покажет»),\n"
+        "- 2–3 буллета: кому полезно/какой выигрыш,\n"
+        "- 1 крючок: яркая цифра/факт/метафора.\n"
+        "Стиль: энергично, конкретно, без воды, 2–3 уместных эмодзи.\n"
+        "Избегай общих фраз. Не повторяй название — заголовок добавим отдельно. Без жирного (**)."
+    ),
+    "insight": (
+        "Выдели 3–5 конкретных идей из книги. Каждая — 1–2 предложения + короткий прикладной пример.\n"
+        "Стиль: лаконично, разговорно, 1–2 эмодзи суммарно. Без жирного. Заголовок добавим сами."
+    ),
+    "practice": (
+        "Возьми 1 прикладную практику. Дай название и 3–6 чётких шагов.\n"
+        "Добавь бытовой пример (одним абзацем).\n"
+        "Стиль: дружелюбный, без воды, 1–2 эмодзи. Без жирного. Заголовок добавим сами."
+    ),
+    "case": (
+        "Опиши 1 кейс: контекст → действие → результат → вывод (3–5 предложений).\n"
+        "Без общих штампов, 0–1 эмодзи. Без жирного. Заголовок добавим сами."
+    ),
+    "quote": (
+        "Дай 1 сильную цитату дословно в кавычках + 1–2 предложения как применить.\n"
+        "Без жирного, 0–1 эмодзи. Заголовок добавим сами."
+    ),
+    "reflect": (
+        "Сформулируй 1–2 вопроса для рефлексии так, чтобы читатель примерил идею на себя.\n"
+        "Коротко, 0–1 эмодзи. Без жирного. Заголовок добавим сами."
+    ),
+}
+
+def _post_messages(fmt: str, summary: Dict[str, Any]) -> List[Dict[str, str]]:
+    base = _format_context(fmt, summary)
+    prompt = _PROMPTS.get(fmt, "Сделай краткую выжимку по книге: конкретно, без жирного и без повторения заголовка.")
+    return [
+        {"role":"system","content":"Ты редактор Telegram-канала: пиши ярко, по делу, с лёгкими эмодзи и без жирного выделения."},
+        {"role":"user","content":f"Конспект книги:\n{base}\n\nЗадача:\n{prompt}"}
+    ]
+
+def _finish_post(fmt: str, raw: str, summary: Dict[str, Any], *, book_id: str, channel_name: str) -> str:
+    """Постобработка ответа модели (app/postprocess.py): чистка, лимит эмодзи, заголовок и хэштеги."""
     title = _book_title(summary, book_id, channel_name)
     author = _book_author(summary, book_id)
-
-    prompts = {
-        "announce": (
-            "Сделай анонс книги для Telegram.\n"
-            "Структура:\n"
-            "- 1 строка: зачем читать (без слов «эта книга покажет»),\n"
-            "- 2–3 буллета: кому полезно/какой выигрыш,\n"
-            "- 1 крючок: яркая цифра/факт/метафора.\n"
-            "Стиль: энергично, конкретно, без воды, 2–3 уместных эмодзи.\n"
-            "Избегай общих фраз. Не повторяй название — заголовок добавим отдельно. Без жирного (**)."
-        ),
-        "insight": (
-            "Выдели 3–5 конкретных идей из книги. Каждая — 1–2 предложения + короткий прикладной пример.\n"
-            "Стиль: лаконично, разговорно, 1–2 эмодзи суммарно. Без жирного. Заголовок добавим сами."
-        ),
-        "practice": (
-            "Возьми 1 прикладную практику. Дай название и 3–6 чётких шагов.\n"
-            "Добавь бытовой пример (одним абзацем).\n"
-            "Стиль: дружелюбный, без воды, 1–2 эмодзи. Без жирного. Заголовок добавим сами."
-        ),
-        "case": (
-            "Опиши 1 кейс: контекст → действие → результат → вывод (3–5 предложений).\n"
-            "Без общих штампов, 0–1 эмодзи. Без жирного. Заголовок добавим сами."
-        ),
-        "quote": (
-            "Дай 1 сильную цитату дословно в кавычках + 1–2 предложения как применить.\n"
-            "Без жирного, 0–1 эмодзи. Заголовок добавим сами."
-        ),
-        "reflect": (
-            "Сформулируй 1–2 вопроса для рефлексии так, чтобы читатель примерил идею на себя.\n"
-            "Коротко, 0–1 эмодзи. Без жирного. Заголовок добавим сами."
-        ),
-    }
-    prompt = prompts.get(fmt, "Сделай краткую выжимку по книге: конкретно, без жирного и без повторения заголовка.")
-
-    resp = _client().chat.completions.create(
-        model=MODEL_POSTS,
-        messages=[
-            {"role":"system","content":"Ты редактор Telegram-канала: пиши ярко, по делу, с лёгкими эмодзи и без жирного выделения."},
-            {"role":"user","content":f"Конспект книги:\n{base}\n\nЗадача:\n{prompt}"}
-        ],
-        temperature=0.7,
-    )
-    body = _normalize(resp.choices[0].message.content or "")
-    body = _declickbait(body)
-
-    # лимит эмодзи из п.2: 1 / 2 / 3 в зависимости от длины
-    length = len(body)
-    max_emoji = 1 if length < 400 else (2 if length < 800 else 3)
-    body = _limit_emojis(body, max_emoji)
-
-    # Заголовки/хэштеги
-    map_emoji = {
-        "announce": "📚",
-        "insight":  "💡",
-        "practice": "🛠️",
-        "case":     "📌",
-        "quote":    "🗣️",
-        "reflect":  "🧭",
-    }
-    map_tag = {
-        "announce": "#анонс #книга",
-        "insight":  "#инсайт",
-        "practice": "#практика",
-        "case":     "#кейс",
-        "quote":    "#цитата",
-        "reflect":  "#рефлексия",
-    }
-    map_label = {
-        "announce": "анонс",
-        "insight":  "ключевые идеи",
-        "practice": "практика",
-        "case":     "кейс",
-        "quote":    "цитата",
-        "reflect":  "вопрос дня",
-    }
-
-    emoji = map_emoji.get(fmt, "📝")
-    label = map_label.get(fmt, fmt)
-    tags  = map_tag.get(fmt, "#сводка")
-
-    # Заголовок: для анонса добавляем автора, если известен
-    if fmt == "announce":
-        title_full = f"{title} ({author})" if author else title
-        header = f"{emoji} Книга дня — {title_full}"
-    else:
-        header = f"{emoji} {title} — {label.capitalize()}"
-
-    final = f"{header}\n\n{body}\n\n{tags}"
-    return final.strip()
+    rules = _postprocess_rules(channel_name)
+    return postprocess.render(fmt, postprocess.clean(raw, rules), title, author, rules)
+
+def _gen_with_prompt(fmt: str, summary: Dict[str, Any], *, book_id: str, channel_name: str,
+                     on_partial: Callable[[str], None] | None = None) -> str:
+    """
+    Пост формата fmt. Ответ стримится (GEN_STREAM), и как только текст дорос до
+    max_len из tov.yaml — поток обрывается и текст режется по границе предложения.
+    on_partial(текст) получает промежуточный текст (например, для превью).
+    """
+    messages = _post_messages(fmt, summary)
+    max_len = _max_len(channel_name, fmt)
+    max_tokens = _max_tokens_for(max_len)
+
+    def _create() -> str:
+        if _stream_enabled():
+            text, finish = stream_chat(
+                messages, model=MODEL_POSTS, temperature=0.7, max_tokens=max_tokens, site="posts",
+                should_stop=(lambda t: len(t) >= max_len) if max_len else None,
+                on_partial=on_partial,
+            )
+        else:
+            kwargs = {"max_tokens": max_tokens} if max_tokens else {}
+            with metrics.timer("openai_request_seconds", op="posts", model=MODEL_POSTS):
+                resp = _client().chat.completions.create(
+                    model=MODEL_POSTS,
+                    messages=messages,
+                    temperature=0.7,
+                    **kwargs,
+                )
+            _record_usage("posts", MODEL_POSTS, resp)
+            text, finish = resp.choices[0].message.content or "", resp.choices[0].finish_reason
+        return _fit_len(text, finish, max_len)
+
+    # temperature 0.7 → кэшируется только при LLM_CACHE_SITES=posts
+    raw = llm_cache.cached("posts", _create, model=MODEL_POSTS, messages=messages,
+                           temperature=0.7, max_tokens=max_tokens)
+    return _finish_post(fmt, raw, summary, book_id=book_id, channel_name=channel_name)
 
 # ---------- Публичные ----------
-def generate_from_book(channel_name: str, book_id: str, fmt: str) -> str:
+def generate_from_book(channel_name: str, book_id: str, fmt: str,
+                       on_partial: Callable[[str], None] | None = None) -> str:
     s = _ensure_summary(book_id, channel_name)
-    return _gen_with_prompt(fmt.lower(), s, book_id=book_id, channel_name=channel_name)
+    return _gen_with_prompt(fmt.lower(), s, book_id=book_id, channel_name=channel_name, on_partial=on_partial)
+
+# ---------- Batch API: запросы и разбор ответов ----------
+# Пакет может идти часами, поэтому сборка запросов и разбор ответов разнесены:
+# planner отправляет пакет и разбирает его на одном из следующих тиков.
+def summary_requests(book_ids: Iterable[str]) -> Tuple[Dict[str, Dict[str, Any]], List[dict]]:
+    """(готовые конспекты из LRU/БД, запросы Batch API для недостающих)."""
+    ready: Dict[str, Dict[str, Any]] = {}
+    reqs = []
+    for book_id in dict.fromkeys(b for b in book_ids if b):
+        hit = stored_summary(summary_key(book_id))
+        if hit is not None:
+            ready[book_id] = hit
+            continue
+        reqs.append(batch.request(
+            f"summary|{book_id}", MODEL_SUMMARY, _summary_messages(_collect_context(book_id)),
+            temperature=0.2, response_format=_SUMMARY_FORMAT,
+        ))
+    return ready, reqs
+
+def apply_summaries(results: Dict[str, str | None]) -> Dict[str, Dict[str, Any]]:
+    """Разобрать и сохранить конспекты из ответов пакета. Невалидные — пропускаются."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for cid, raw in results.items():
+        book_id = cid.split("|", 1)[1]
+        if raw is None or not _is_json(raw):
+            print(f"[SUMMARY WARN] batch returned no summary for {book_id}")
+            continue
+        out[book_id] = _parse_summary(raw)
+        store_summary(summary_key(book_id), out[book_id])
+    return out
+
+def post_requests(items: List[Tuple[str, str, str, str]], summaries: Dict[str, Dict[str, Any]]) -> List[dict]:
+    """Запросы постов. items: (key, channel_name, book_id, fmt), key — уникальный custom_id."""
+    reqs = []
+    for key, channel_name, book_id, fmt in items:
+        s = summaries.get(book_id)
+        if s is None:
+            continue
+        fmt = fmt.lower()
+        max_tokens = _max_tokens_for(_max_len(channel_name, fmt))
+        params = {"max_tokens": max_tokens} if max_tokens else {}
+        reqs.append(batch.request(key, MODEL_POSTS, _post_messages(fmt, s), temperature=0.7, **params))
+    return reqs
+
+def apply_posts(items: List[Tuple[str, str, str, str]], summaries: Dict[str, Dict[str, Any]],
+                results: Dict[str, str | None]) -> Dict[str, str | None]:
+    """key → готовый текст поста (None — не сгенерировался)."""
+    out: Dict[str, str | None] = {}
+    for key, channel_name, book_id, fmt in items:
+        raw = results.get(key)
+        if raw is None or book_id not in summaries:
+            out[key] = None
+            continue
+        fmt = fmt.lower()
+        raw = _fit_len(raw, None, _max_len(channel_name, fmt))
+        out[key] = _finish_post(fmt, raw, summaries[book_id], book_id=book_id, channel_name=channel_name)
+    return out
 
 def generate_by_format(fmt: str, items: List[dict]) -> str:
     f = (fmt or "").lower()
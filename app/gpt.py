@@ -1,10 +1,13 @@
 # app/gpt.py
 from __future__ import annotations
 import os, time, random
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from openai import RateLimitError, APIStatusError
 
+from app import llm_cache, metrics
+
 # ---- Singleton OpenAI клиент ----
 __CLIENT: Optional[OpenAI] = None
 
@@ -30,67 +33,219 @@ _client_ok = _client
 
 # ---- Вспомогательные функции с ретраями ----
 
+def _record_usage(op: str, model: str, res) -> None:
+    """Токены из ответа API в метрики (prompt/completion)."""
+    usage = getattr(res, "usage", None)
+    if usage is None:
+        return
+    for kind in ("prompt", "completion"):
+        n = getattr(usage, f"{kind}_tokens", None)
+        if n:
+            metrics.inc("openai_tokens_total", n, op=op, model=model, kind=kind)
+
 def _retry_sleep(attempt: int):
     # экспоненциальный бэкофф с легким джиттером
     time.sleep(min(2 ** attempt, 30) + random.uniform(0, 0.5))
 
-def embed_texts(
-    texts: List[str],
-    model: str | None = None,
-    max_retries: int | None = None
-) -> List[List[float]]:
-    model = model or os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
-    max_retries = int(os.getenv("OPENAI_RETRY", "4")) if max_retries is None else max_retries
+# ---- Эмбеддинги: упаковка по токенам + параллельные запросы ----
+_RETRYABLE = (429, 500, 502, 503, 504)
+_EMBED_DIM = 1536
+
+def _est_tokens(s: str) -> int:
+    # грубая оценка без токенизатора: для кириллицы ~2–3 символа на токен, берём с запасом
+    return max(1, len(s) // 2)
+
+def _pack_batches(texts: List[str]) -> List[Tuple[int, int]]:
+    """Диапазоны [i, j) подряд идущих текстов, влезающие в лимит запроса."""
+    max_tokens = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "250000"))
+    max_inputs = int(os.getenv("EMBED_MAX_BATCH_INPUTS", "2048"))
+    out, start, acc = [], 0, 0
+    for i, t in enumerate(texts):
+        n = _est_tokens(t)
+        if i > start and (acc + n > max_tokens or i - start >= max_inputs):
+            out.append((start, i))
+            start, acc = i, 0
+        acc += n
+    if start < len(texts):
+        out.append((start, len(texts)))
+    return out
 
+def _embed_request(texts: List[str], model: str, max_retries: int) -> List[List[float]]:
+    """Один запрос с ретраями; после исчерпания попыток — исключение."""
     for attempt in range(max_retries + 1):
         try:
-            res = _client().embeddings.create(model=model, input=texts)
+            with metrics.timer("openai_request_seconds", op="embeddings", model=model):
+                res = _client().embeddings.create(model=model, input=texts)
+            _record_usage("embeddings", model, res)
+            metrics.inc("openai_embed_inputs_total", len(texts), model=model)
             return [d.embedding for d in res.data]
         except RateLimitError:
             if attempt >= max_retries:
-                # мягкий фолбэк — вернём нули, чтобы пайплайн не падал
-                dim = 1536
-                return [[0.0] * dim for _ in texts]
+                raise
+            metrics.inc("openai_retries_total", op="embeddings", model=model)
             _retry_sleep(attempt)
         except APIStatusError as e:
-            if getattr(e, "status_code", 0) in (429, 500, 502, 503, 504):
-                if attempt >= max_retries:
-                    dim = 1536
-                    return [[0.0] * dim for _ in texts]
+            if getattr(e, "status_code", 0) in _RETRYABLE and attempt < max_retries:
+                metrics.inc("openai_retries_total", op="embeddings", model=model)
                 _retry_sleep(attempt)
             else:
                 raise
 
+def _embed_batch(texts: List[str], model: str, max_retries: int) -> List[List[float]]:
+    """
+    Пачка с изоляцией ошибок: отказ не трогает соседние пачки,
+    400 (например, превышен лимит токенов) — делим пополам и повторяем только половины.
+    """
+    try:
+        return _embed_request(texts, model, max_retries)
+    except RateLimitError:
+        # мягкий фолбэк — вернём нули, чтобы пайплайн не падал
+        metrics.inc("openai_embed_zero_fallback_total", len(texts), model=model)
+        return [[0.0] * _EMBED_DIM for _ in texts]
+    except APIStatusError as e:
+        status = getattr(e, "status_code", 0)
+        if status in _RETRYABLE:
+            metrics.inc("openai_embed_zero_fallback_total", len(texts), model=model)
+            return [[0.0] * _EMBED_DIM for _ in texts]
+        if status == 400 and len(texts) > 1:
+            mid = len(texts) // 2
+            return (_embed_batch(texts[:mid], model, max_retries)
+                    + _embed_batch(texts[mid:], model, max_retries))
+        raise
+
+def embed_texts(
+    texts: List[str],
+    model: str | None = None,
+    max_retries: int | None = None
+) -> List[List[float]]:
+    """
+    Эмбеддинги для любого числа текстов. Тексты пакуются в запросы по оценке
+    токенов (EMBED_MAX_BATCH_TOKENS), запросы идут параллельно (EMBED_CONCURRENCY),
+    порядок результата совпадает с порядком texts.
+    """
+    model = model or os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+    max_retries = int(os.getenv("OPENAI_RETRY", "4")) if max_retries is None else max_retries
+    if not texts:
+        return []
+
+    spans = _pack_batches(list(texts))
+    workers = max(1, min(int(os.getenv("EMBED_CONCURRENCY", "4")), len(spans)))
+    if workers == 1:
+        parts = [_embed_batch(texts[i:j], model, max_retries) for i, j in spans]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed") as pool:
+            parts = list(pool.map(lambda sp: _embed_batch(texts[sp[0]:sp[1]], model, max_retries), spans))
+
+    out: List[List[float]] = []
+    for p in parts:
+        out.extend(p)
+    return out
+
+def stream_chat(
+    messages: List[Dict[str, str]],
+    *,
+    model: str,
+    temperature: float,
+    max_tokens: int | None = None,
+    site: str = "chat",
+    should_stop: Callable[[str], bool] | None = None,
+    on_partial: Callable[[str], None] | None = None,
+) -> Tuple[str, str]:
+    """
+    Стриминговый chat.completions. После каждого куска зовёт on_partial(текст_целиком);
+    если should_stop(текст) вернул True — поток закрывается, дальше токены не генерируются.
+    Возвращает (текст, finish_reason), где finish_reason == "cutoff" при досрочной остановке.
+    """
+    kwargs = dict(model=model, messages=messages, temperature=temperature,
+                  stream=True, stream_options={"include_usage": True})
+    if max_tokens:
+        kwargs["max_tokens"] = max_tokens
+    t0 = time.perf_counter()
+    text, finish, usage_chunk = "", "", None
+    with metrics.timer("openai_request_seconds", op=site, model=model):
+        stream = _client().chat.completions.create(**kwargs)
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    usage_chunk = chunk
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish = choice.finish_reason or finish
+                delta = getattr(choice.delta, "content", None) or ""
+                if not delta:
+                    continue
+                if not text:
+                    metrics.observe("openai_ttft_seconds", time.perf_counter() - t0, op=site, model=model)
+                text += delta
+                if on_partial is not None:
+                    try:
+                        on_partial(text)
+                    except Exception as e:
+                        print(f"[STREAM WARN] on_partial: {e}")
+                if should_stop is not None and should_stop(text):
+                    finish = "cutoff"
+                    break
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+    if usage_chunk is not None:
+        _record_usage(site, model, usage_chunk)
+    else:
+        # поток оборвали до итогового usage — считаем вывод по оценке
+        metrics.inc("openai_tokens_total", _est_tokens(text), op=site, model=model, kind="completion")
+    if finish == "cutoff":
+        metrics.inc("openai_stream_cutoff_total", op=site, model=model)
+    return text, finish
+
+_LIMIT_MSG = "⏳ Лимит генерации временно исчерпан."
+
 def chat(
     system: str,
     user: str,
     model: str | None = None,
     max_tokens: int = 800,
-    temperature: float = 0.3
+    temperature: float = 0.3,
+    cache_site: str = "chat",
 ) -> str:
     model = model or os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
     max_retries = int(os.getenv("OPENAI_RETRY", "4"))
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
 
-    for attempt in range(max_retries + 1):
-        try:
-            res = _client().chat.completions.create(
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                messages=[
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": user},
-                ],
-            )
-            return (res.choices[0].message.content or "").strip()
-        except RateLimitError:
-            if attempt >= max_retries:
-                return "⏳ Лимит генерации временно исчерпан."
-            _retry_sleep(attempt)
-        except APIStatusError as e:
-            if getattr(e, "status_code", 0) in (429, 500, 502, 503, 504):
+    def _create() -> str:
+        for attempt in range(max_retries + 1):
+            try:
+                with metrics.timer("openai_request_seconds", op=cache_site, model=model):
+                    res = _client().chat.completions.create(
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        messages=messages,
+                    )
+                _record_usage(cache_site, model, res)
+                return (res.choices[0].message.content or "").strip()
+            except RateLimitError:
                 if attempt >= max_retries:
-                    return "⏳ Лимит генерации временно исчерпан."
+                    metrics.inc("openai_chat_fallback_total", op=cache_site, model=model)
+                    return _LIMIT_MSG
+                metrics.inc("openai_retries_total", op=cache_site, model=model)
                 _retry_sleep(attempt)
-            else:
-                raise
+            except APIStatusError as e:
+                if getattr(e, "status_code", 0) in (429, 500, 502, 503, 504):
+                    if attempt >= max_retries:
+                        metrics.inc("openai_chat_fallback_total", op=cache_site, model=model)
+                        return _LIMIT_MSG
+                    metrics.inc("openai_retries_total", op=cache_site, model=model)
+                    _retry_sleep(attempt)
+                else:
+                    raise
+
+    return llm_cache.cached(
+        cache_site, _create,
+        model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+        accept=lambda t: t != _LIMIT_MSG,
+    )
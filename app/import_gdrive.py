@@ -1,8 +1,7 @@
 from __future__ import annotations
-from app.gdrive import download_text
-from app.embeddings import chunk_text, upsert_book_chunks
+from app.gdrive import iter_text
+from app.embeddings import ingest_stream
 
 def ingest_book_from_drive(book_id: str, title: str, author: str, file_id: str) -> int:
-    raw = download_text(file_id)
-    chunks = chunk_text(raw)
-    return upsert_book_chunks(book_id, title, author, chunks)
+    # скачивание, эмбеддинги и запись в БД идут конвейером (см. ingest_stream)
+    return ingest_stream(book_id, title, author, iter_text(file_id))
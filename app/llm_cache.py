@@ -0,0 +1,203 @@
+# app/llm_cache.py
+from __future__ import annotations
+import os, json, time, hashlib, sqlite3, threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from app.db import get_conn
+from app import metrics
+
+# Кэш ответов LLM по содержимому запроса: (model, messages, temperature,
+# response_format, max_tokens) → текст ответа.
+#
+#   LLM_CACHE=off|db|file   — бэкенд (по умолчанию выключен)
+#   LLM_CACHE_SITES=posts   — call-site'ы, которые кэшируются и при temperature > 0.2
+#   LLM_CACHE_TTL_SEC, LLM_CACHE_MAX — срок жизни и лимит записей
+#
+# Запросы с temperature ≤ 0.2 кэшируются всегда (если бэкенд включён).
+
+DETERMINISTIC_TEMP = 0.2
+_EVICT_EVERY = 50
+
+_STATS: Dict[str, Dict[str, int]] = {}
+_LOCK = threading.Lock()
+_PUTS = 0
+
+def _backend() -> str:
+    return (os.getenv("LLM_CACHE", "off") or "off").strip().lower()
+
+def _ttl() -> int:
+    return int(os.getenv("LLM_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+
+def _max_entries() -> int:
+    return int(os.getenv("LLM_CACHE_MAX", "5000"))
+
+def _opt_in_sites() -> set[str]:
+    return {s.strip() for s in os.getenv("LLM_CACHE_SITES", "").split(",") if s.strip()}
+
+def _bump(site: str, field: str):
+    with _LOCK:
+        st = _STATS.setdefault(site, {"hits": 0, "misses": 0, "stores": 0})
+        st[field] += 1
+    metrics.inc("llm_cache_events_total", site=site, event=field)
+
+def enabled_for(site: str, temperature: float) -> bool:
+    if _backend() not in ("db", "file"):
+        return False
+    return temperature <= DETERMINISTIC_TEMP or site in _opt_in_sites()
+
+def make_key(model: str, messages: List[Dict[str, Any]], temperature: float,
+             response_format: Optional[dict] = None, max_tokens: Optional[int] = None) -> str:
+    raw = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature,
+         "response_format": response_format, "max_tokens": max_tokens},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# ---------- хранилища ----------
+def _file_path() -> Path:
+    return Path(os.getenv("LLM_CACHE_FILE", ".cache/llm_cache.sqlite"))
+
+def _sqlite():
+    p = _file_path()
+    p.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(p), timeout=10)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        last_hit_at REAL NOT NULL
+    );
+    """)
+    return conn
+
+def _get(key: str) -> Optional[str]:
+    now = time.time()
+    if _backend() == "file":
+        conn = _sqlite()
+        try:
+            row = conn.execute(
+                "SELECT response FROM llm_cache WHERE key=? AND created_at >= ?;",
+                (key, now - _ttl()),
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE llm_cache SET last_hit_at=? WHERE key=?;", (now, key))
+                conn.commit()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        UPDATE llm_cache SET last_hit_at=NOW()
+         WHERE key=%s AND created_at >= NOW() - make_interval(secs => %s)
+        RETURNING response;
+        """, (key, _ttl()))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+def _put(key: str, model: str, response: str):
+    now = time.time()
+    if _backend() == "file":
+        conn = _sqlite()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache(key, model, response, created_at, last_hit_at) VALUES (?,?,?,?,?);",
+                (key, model, response, now, now),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return
+
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        INSERT INTO llm_cache(key, model, response)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (key) DO UPDATE
+          SET response=EXCLUDED.response, created_at=NOW(), last_hit_at=NOW();
+        """, (key, model, response))
+
+def _evict():
+    """Удалить просроченное и оставить не больше LLM_CACHE_MAX самых свежих по last_hit_at."""
+    now = time.time()
+    if _backend() == "file":
+        conn = _sqlite()
+        try:
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?;", (now - _ttl(),))
+            conn.execute("""
+            DELETE FROM llm_cache WHERE key NOT IN (
+                SELECT key FROM llm_cache ORDER BY last_hit_at DESC LIMIT ?
+            );""", (_max_entries(),))
+            conn.commit()
+        finally:
+            conn.close()
+        return
+
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM llm_cache WHERE created_at < NOW() - make_interval(secs => %s);", (_ttl(),))
+        cur.execute("""
+        DELETE FROM llm_cache WHERE key NOT IN (
+            SELECT key FROM llm_cache ORDER BY last_hit_at DESC LIMIT %s
+        );""", (_max_entries(),))
+
+# ---------- публичное API ----------
+def lookup(site: str, key: str) -> Optional[str]:
+    try:
+        hit = _get(key)
+    except Exception as e:
+        print(f"[LLM CACHE ERR] get: {e}")
+        hit = None
+    _bump(site, "hits" if hit is not None else "misses")
+    return hit
+
+def store(site: str, key: str, model: str, response: str):
+    global _PUTS
+    try:
+        _put(key, model, response)
+        _bump(site, "stores")
+        with _LOCK:
+            _PUTS += 1
+            evict = _PUTS % _EVICT_EVERY == 0
+        if evict:
+            _evict()
+    except Exception as e:
+        print(f"[LLM CACHE ERR] put: {e}")
+
+def cached(
+    site: str,
+    create: Callable[[], str],
+    *,
+    model: str,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    response_format: Optional[dict] = None,
+    max_tokens: Optional[int] = None,
+    accept: Callable[[str], bool] | None = None,
+) -> str:
+    """
+    Вернуть ответ из кэша или вызвать create() и (если accept разрешает) сохранить.
+    Если кэш для call-site'а не включён — просто create().
+    """
+    if not enabled_for(site, temperature):
+        return create()
+    key = make_key(model, messages, temperature, response_format, max_tokens)
+    hit = lookup(site, key)
+    if hit is not None:
+        return hit
+    text = create()
+    if text and (accept is None or accept(text)):
+        store(site, key, model, text)
+    return text
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Счётчики по call-site'ам + hit rate."""
+    with _LOCK:
+        out = {}
+        for site, st in _STATS.items():
+            total = st["hits"] + st["misses"]
+            out[site] = {**st, "hit_rate": (st["hits"] / total) if total else 0.0}
+        return out
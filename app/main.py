@@ -1,14 +1,15 @@
 # app/main.py
 from __future__ import annotations
-import os, time, schedule, yaml
+import os, sys, signal, yaml
 from pathlib import Path
-from datetime import datetime, date as _date, date, time as dtime
+from datetime import datetime, timedelta, date as _date
 from zoneinfo import ZoneInfo
 
 from app.max_api import send_text
-from app.db import init_db, add_log, fetch_draft, apply_sheet_row
-from app.planner import generate_day, poll_control  # <-- ночная генерация + опрос листа control
-from app.sheets import pull_all
+from app import scheduler, outbox, metrics
+from app.db import init_db, add_log
+from app.planner import generate_day, generate_batch, poll_batch_jobs, enabled_channels, poll_control  # <-- ночная генерация + опрос листа control
+from app import staging
 
 ROOT = Path(__file__).resolve().parents[1]
 CFG_CH = ROOT / "config" / "channels.yaml"
@@ -21,7 +22,25 @@ def load_yaml(p: Path):
 def local_now(tz: str):
     return datetime.now(ZoneInfo(tz))
 
-def job_send(alias: str, token_env: str, text: str, api_base: str | None = None):
+def job_send(alias: str, token_env: str, text: str, api_base: str | None = None,
+             draft_id: int | None = None, channel: str | None = None, due_at: datetime | None = None):
+    """
+    Черновики идут через outbox (ретраи, без двойной отправки);
+    без draft_id — разовая прямая отправка, как раньше.
+    Если outbox недоступен (БД упала/таймаут), замороженный текст
+    отправляется напрямую — пост в слот важнее гарантий очереди.
+    """
+    if draft_id is not None:
+        try:
+            queued = outbox.enqueue(draft_id, channel or alias, alias, token_env, text,
+                                    api_base=api_base, due_at=due_at)
+            add_log(f"[OUTBOX] {alias} draft_id={draft_id} queued={queued}")
+            return
+        except Exception as e:
+            msg = f"[OUTBOX-FALLBACK] {alias} draft_id={draft_id}: enqueue failed ({e}), sending directly"
+            print(msg)
+            add_log(msg)
+
     import app.max_api as max_api
     token = os.getenv(token_env)
     dry = not bool(token)  # если токена нет — DRY-режим
@@ -29,29 +48,18 @@ def job_send(alias: str, token_env: str, text: str, api_base: str | None = None)
     tag = "DRY" if dry else "SENT"
     msg = f"[{tag}] {alias} -> {ok}"
     print(msg)
-    try:
-        add_log(msg)
-    except Exception as e:
-        print(f"[LOG ERR] {e}")
-
-def _to_utc_hhmm(local_hhmm: str, tz_name: str) -> str:
-    parts = list(map(int, local_hhmm.split(":")))
-    if len(parts) == 2:
-        h, m = parts; s = 0
-    elif len(parts) == 3:
-        h, m, s = parts
-    else:
-        raise ValueError(f"Bad time format: {local_hhmm}")
-    today_utc: date = datetime.now(ZoneInfo("UTC")).date()
-    local_dt = datetime.combine(today_utc, dtime(hour=h, minute=m, second=s), tzinfo=ZoneInfo(tz_name))
-    utc_dt = local_dt.astimezone(ZoneInfo("UTC"))
-    return utc_dt.strftime("%H:%M:%S")
+    add_log(msg)
+    # опоздание считаем так же, как доставщик outbox
+    if ok and due_at is not None:
+        late = staging.record_lateness(f"{alias} draft_id={draft_id}", due_at)
+        add_log(f"[LATE] {alias} draft_id={draft_id} {late:.2f}s {staging.lateness_stats()}")
 
 def schedule_channel(ch: dict, slots: list, default_tz: str):
     """
     Постинг ТОЛЬКО из заранее утверждённых черновиков:
-    - перед отправкой тянем актуальный статус/правки из Sheets
-    - берём текст из БД drafts (создан заранее generate_day/poll_control)
+    - за STAGE_AHEAD_MIN минут до слота синкаем статус/правки из Sheets
+      и замораживаем черновик (app/staging.py)
+    - в момент слота — быстрая перепроверка статуса по id и отправка
     """
     alias = ch["alias"]
     token_env = ch["token_env"]
@@ -62,24 +70,13 @@ def schedule_channel(ch: dict, slots: list, default_tz: str):
     for s in slots:
         t_local = s["time"]
         fmt = s["format"]
-        t_utc = _to_utc_hhmm(t_local, tz)
 
-        def make_job(a=alias, te=token_env, api=api_base, fmt=fmt, tz=tz, ch_name=ch_name):
+        def make_job(a=alias, te=token_env, api=api_base, fmt=fmt, tz=tz, ch_name=ch_name, t_local=t_local):
             def _run():
                 now = local_now(tz).strftime("%Y-%m-%d %H:%M:%S")
                 today_iso = local_now(tz).date().isoformat()
 
-                # синк статусов/правок из Sheets
-                try:
-                    rows = pull_all()
-                    for r in rows:
-                        if (r.get("channel") == ch_name) and (r.get("date") == today_iso) and (r.get("format") == fmt):
-                            apply_sheet_row(r)
-                except Exception as e:
-                    print(f"[SYNC SHEETS ERR] {e}")
-
-                # ищем черновик на сегодня
-                row = fetch_draft(channel=ch_name, fmt=fmt, d=today_iso)
+                row = staging.ready_row(ch_name, fmt, today_iso)
                 if not row:
                     print(f"[SKIP] no draft for {ch_name} {fmt} {today_iso}")
                     return
@@ -95,21 +92,27 @@ def schedule_channel(ch: dict, slots: list, default_tz: str):
 
                 msg = f"[RUN {now} {tz}] {a} draft_id={draft_id} fmt={fmt}"
                 print(msg)
-                try:
-                    add_log(msg)
-                except Exception as e:
-                    print(f"[LOG ERR] {e}")
+                add_log(msg)
 
-                job_send(alias=a, token_env=te, text=text_to_send, api_base=api)
+                job_send(alias=a, token_env=te, text=text_to_send, api_base=api,
+                         draft_id=draft_id, channel=ch_name,
+                         due_at=staging.slot_due(t_local, tz, today_iso))
             return _run
 
-        schedule.every().day.at(t_utc).do(make_job())
-        sched_msg = f"[SCHED] {alias} {t_local} local / {t_utc} UTC ({fmt}) [{tz}]"
+        job = scheduler.every_day_at(t_local, tz, make_job(), name=f"{alias} {fmt} {t_local}")
+        sched_msg = f"[SCHED] {alias} {t_local} local ({fmt}) [{tz}] next={job.next_run:%Y-%m-%d %H:%M:%S} UTC"
         print(sched_msg)
-        try:
-            add_log(sched_msg)
-        except Exception as e:
-            print(f"[LOG ERR] {e}")
+        add_log(sched_msg)
+
+        ahead = staging.ahead_minutes()
+        if ahead > 0:
+            h, m, *_ = map(int, t_local.split(":"))
+            t_stage = (datetime(2000, 1, 1, h, m) - timedelta(minutes=ahead)).strftime("%H:%M")
+            scheduler.every_day_at(
+                t_stage, tz,
+                lambda ch_name=ch_name, fmt=fmt, tz=tz: staging.stage_ahead(ch_name, fmt, tz),
+                name=f"stage {alias} {fmt} {t_local}",
+            )
 
 def _load_slots_for_channel(sc_cfg: dict, alias: str, name: str):
     tz = sc_cfg.get("timezone", "UTC")
@@ -125,12 +128,18 @@ def _load_slots_for_channel(sc_cfg: dict, alias: str, name: str):
     return tz, slots
 
 def main():
+    # SIGTERM (Heroku) → штатный выход, чтобы atexit дописал буфер логов
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
     # БД
     try:
         init_db()
     except Exception as e:
         print(f"[DB INIT ERR] {e}")
 
+    # /metrics и снимки метрик в БД (если включены в env)
+    metrics.start()
+
     # конфиги каналов/слотов
     ch_cfg = load_yaml(CFG_CH)
     sc_cfg = load_yaml(CFG_SC)
@@ -139,14 +148,22 @@ def main():
     # одноразовая генерация при старте (для тестов)
     if os.getenv("GENERATE_AT_START", "false").lower() == "true":
         today_iso = _date.today().isoformat()
-        for ch in ch_cfg["channels"]:
-            if not ch.get("enabled", True):
-                continue
+        if os.getenv("GEN_BATCH", "false").lower() == "true":
+            # все каналы одним пакетом Batch API
             try:
-                n = generate_day(channel_name=ch.get("name") or "", channel_alias=ch.get("alias") or "", date_iso=today_iso)
-                print(f"[DRAFTS] generated {n} for {ch.get('name')} {today_iso}")
+                job_id = generate_batch(enabled_channels(), [today_iso])
+                print(f"[DRAFTS] batch job {job_id} submitted for {today_iso}")
             except Exception as e:
-                print(f"[DRAFTS ERR] {ch.get('name')}: {e}")
+                print(f"[DRAFTS ERR] batch: {e}")
+        else:
+            for ch in ch_cfg["channels"]:
+                if not ch.get("enabled", True):
+                    continue
+                try:
+                    n = generate_day(channel_name=ch.get("name") or "", channel_alias=ch.get("alias") or "", date_iso=today_iso)
+                    print(f"[DRAFTS] generated {n} for {ch.get('name')} {today_iso}")
+                except Exception as e:
+                    print(f"[DRAFTS ERR] {ch.get('name')}: {e}")
 
     # регистрируем постинг‑джобы
     for ch in ch_cfg["channels"]:
@@ -162,18 +179,19 @@ def main():
     if os.getenv("POLL_CONTROL", "false").lower() == "true":
         sec = int(os.getenv("CONTROL_POLL_SEC", "60"))
         print(f"[CONTROL] polling enabled every {sec} sec")
-        schedule.every(sec).seconds.do(poll_control)
+        scheduler.every_seconds(sec, poll_control, name="poll_control")
+
+    # пакеты Batch API: результат забираем на тиках, а не ждём в воркере
+    if os.getenv("GEN_BATCH", "false").lower() == "true" or os.getenv("POLL_CONTROL", "false").lower() == "true":
+        sec = float(os.getenv("GEN_BATCH_POLL_SEC", "30"))
+        scheduler.every_seconds(sec, poll_batch_jobs, name="batch_jobs")
 
-    start_msg = "[START] Worker running. Tick every second."
+    start_msg = f"[START] Worker running. {len(scheduler.jobs())} jobs scheduled."
     print(start_msg)
-    try:
-        add_log(start_msg)
-    except Exception as e:
-        print(f"[LOG ERR] {e}")
+    add_log(start_msg)
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    outbox.start_worker()
+    scheduler.run_forever()
 
 if __name__ == "__main__":
     main()
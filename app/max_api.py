@@ -1,8 +1,12 @@
 import os, requests
 
-def _post(url, payload):
+from app import metrics
+
+def _post(url, payload, endpoint="tg"):
     try:
-        r = requests.post(url, json=payload, timeout=20)
+        with metrics.timer("send_request_seconds", endpoint=endpoint):
+            r = requests.post(url, json=payload, timeout=20)
+        metrics.inc("send_requests_total", endpoint=endpoint, status=r.status_code)
         return r.status_code, r.text
     except Exception as e:
         return 0, str(e)
@@ -10,20 +14,27 @@ def _post(url, payload):
 def send_text(token: str|None, alias: str, text: str, api_base: str|None=None, dry_run: bool=False):
     if dry_run or not token:
         print(f"[DRY-RUN] -> {alias}: {text[:120]}...")
+        metrics.inc("send_total", result="dry")
         return True
 
-    url1 = f"https://api.telegram.org/bot{token}/sendMessage"
+    tg_base = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+    url1 = f"{tg_base}/bot{token}/sendMessage"
     st, body = _post(url1, {"chat_id": alias, "text": text})
     if 200 <= st < 300:
-        print("[OK tg-like]", body[:200]); return True
+        print("[OK tg-like]", body[:200])
+        metrics.inc("send_total", result="ok")
+        return True
 
     if api_base:
         url2 = api_base.rstrip("/") + "/sendMessage"
-        st2, body2 = _post(url2, {"chat_id": alias, "text": text})
+        st2, body2 = _post(url2, {"chat_id": alias, "text": text}, endpoint="custom")
         if 200 <= st2 < 300:
-            print("[OK custom]", body2[:200]); return True
+            print("[OK custom]", body2[:200])
+            metrics.inc("send_total", result="ok")
+            return True
         print("[ERR custom]", st2, body2[:200])
     else:
         print("[ERR tg-like]", st, body[:200])
 
+    metrics.inc("send_total", result="fail")
     return False
@@ -0,0 +1,159 @@
+# app/metrics.py
+from __future__ import annotations
+import os, json, time, bisect, threading, traceback
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+# Метрики процесса в памяти: счётчики и гистограммы с метками.
+#
+#   METRICS_PORT=9108          — отдавать GET /metrics в текстовом формате Prometheus
+#   METRICS_SNAPSHOT_SEC=300   — периодически писать снимок в таблицу metrics_snapshots
+#
+# Оба выключены по умолчанию; сбор в памяти идёт всегда и стоит копейки.
+# Латентности — в секундах, имена: <подсистема>_<что>_<единица|total>.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LATENESS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_LOCK = threading.Lock()
+_COUNTERS: Dict[str, Dict[Labels, float]] = {}
+_HISTS: Dict[str, Dict[Labels, List[float]]] = {}  # [bucket counts..., +Inf count, sum]
+_BUCKETS: Dict[str, Tuple[float, ...]] = {}
+_STARTED = False
+
+def _key(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name: str, value: float = 1.0, **labels):
+    k = _key(labels)
+    with _LOCK:
+        series = _COUNTERS.setdefault(name, {})
+        series[k] = series.get(k, 0.0) + value
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] | None = None, **labels):
+    k = _key(labels)
+    with _LOCK:
+        bs = _BUCKETS.setdefault(name, tuple(buckets or DEFAULT_BUCKETS))
+        h = _HISTS.setdefault(name, {}).get(k)
+        if h is None:
+            h = _HISTS[name][k] = [0.0] * (len(bs) + 2)
+        h[bisect.bisect_left(bs, value)] += 1
+        h[-1] += value
+
+@contextmanager
+def timer(name: str, **labels):
+    """
+    Замер блока в гистограмму name; исключение дополнительно
+    считается в <name без _seconds>_errors_total.
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc(name.removesuffix("_seconds") + "_errors_total", **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+# ---------- выгрузка ----------
+def snapshot() -> Dict[str, Dict]:
+    """Все ряды в JSON-пригодном виде (для БД, бенчей и отладки)."""
+    with _LOCK:
+        counters = {n: [{"labels": dict(k), "value": v} for k, v in s.items()] for n, s in _COUNTERS.items()}
+        hists = {}
+        for n, s in _HISTS.items():
+            bs = _BUCKETS[n]
+            hists[n] = [{
+                "labels": dict(k),
+                "buckets": dict(zip([str(b) for b in bs] + ["+Inf"], h[:-1])),
+                "count": sum(h[:-1]),
+                "sum": h[-1],
+            } for k, h in s.items()]
+    return {"counters": counters, "histograms": hists}
+
+def _esc(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt_labels(labels: Labels, extra: Tuple[str, str] | None = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in items) + "}"
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def render() -> str:
+    """Текстовый формат экспозиции Prometheus 0.0.4."""
+    out: List[str] = []
+    with _LOCK:
+        for n in sorted(_COUNTERS):
+            out.append(f"# TYPE {n} counter")
+            for k, v in sorted(_COUNTERS[n].items()):
+                out.append(f"{n}{_fmt_labels(k)} {_num(v)}")
+        for n in sorted(_HISTS):
+            bs = _BUCKETS[n]
+            out.append(f"# TYPE {n} histogram")
+            for k, h in sorted(_HISTS[n].items()):
+                acc = 0.0
+                for b, c in zip(list(bs) + [float("inf")], h[:-1]):
+                    acc += c
+                    le = "+Inf" if b == float("inf") else _num(b)
+                    out.append(f"{n}_bucket{_fmt_labels(k, ('le', le))} {_num(acc)}")
+                out.append(f"{n}_sum{_fmt_labels(k)} {_num(h[-1])}")
+                out.append(f"{n}_count{_fmt_labels(k)} {_num(acc)}")
+    return "\n".join(out) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    srv = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=srv.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[METRICS] serving /metrics on {host}:{srv.server_port}")
+    return srv
+
+def save_snapshot():
+    from app.db import get_conn  # db сам пишет метрики — импорт здесь, чтобы не было цикла
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("INSERT INTO metrics_snapshots(data) VALUES (%s::jsonb);",
+                    (json.dumps(snapshot(), ensure_ascii=False),))
+
+def _snapshot_loop(every: float):
+    while True:
+        time.sleep(every)
+        try:
+            save_snapshot()
+        except Exception as e:
+            print(f"[METRICS ERR] snapshot: {e}")
+            print(traceback.format_exc())
+
+def start():
+    """Поднять HTTP-эндпоинт и/или снимки в БД по env (один раз на процесс)."""
+    global _STARTED
+    with _LOCK:
+        if _STARTED:
+            return
+        _STARTED = True
+    port = int(os.getenv("METRICS_PORT", "0") or 0)
+    if port:
+        serve(port)
+    every = float(os.getenv("METRICS_SNAPSHOT_SEC", "0") or 0)
+    if every > 0:
+        threading.Thread(target=_snapshot_loop, args=(every,), name="metrics-snap", daemon=True).start()
@@ -0,0 +1,57 @@
+# app/minhash.py
+from __future__ import annotations
+import re, zlib
+from typing import List
+import numpy as np
+
+# MinHash-подписи чанков для поиска почти-дубликатов.
+# Шинглы — тройки соседних слов (нижний регистр, ё→е); каждый шингл хешируется
+# crc32 и прогоняется через PERM перестановок вида (a·x + b) mod p.
+# Доля совпавших позиций двух подписей ≈ коэффициент Жаккара их шинглов.
+# Для отсева дубликатов важнее вложенность (пересечение / меньшее множество):
+# короткий чанк целиком внутри длинного по Жаккару выглядит «непохожим».
+# Её оцениваем из Жаккара и числа шинглов: |A∩B| = J·(|A|+|B|)/(1+J).
+# Подпись считается при записи чанков (embeddings._write_chunks) и лежит
+# в chunks.minhash; retriever поднимает её вместе с векторами.
+#
+# LSH-бандинг (бакеты по полосам подписи) здесь сознательно не используется:
+# сборка контекста сравнивает десятки кандидатов, и полная матрица сравнений —
+# один numpy-вызов на выбранный чанк; к тому же MMR нужна сама оценка сходства
+# со всеми выбранными, а не только факт «попали в один бакет». Бандинг имеет
+# смысл, если искать дубликаты по всей книге или между книгами.
+
+_WORD_RE = re.compile(r"[a-zа-я0-9]+")
+_PRIME = np.uint64(4294967311)  # простое > 2^32: (a·x + b) не переполняет uint64
+PERM = 64
+_RNG = np.random.RandomState(20240917)
+_A = _RNG.randint(1, 2**32 - 1, size=PERM, dtype=np.uint64)
+_B = _RNG.randint(0, 2**32 - 1, size=PERM, dtype=np.uint64)
+
+def _shingles(text: str, k: int = 3) -> np.ndarray:
+    words = _WORD_RE.findall((text or "").lower().replace("ё", "е"))
+    if len(words) < k:
+        words = words or [""]
+        grams = {" ".join(words)}
+    else:
+        grams = {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+def signature(text: str) -> List[int]:
+    x = _shingles(text)
+    return ((np.outer(x, _A) + _B) % _PRIME).min(axis=0).tolist()
+
+def similarity(sig: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Оценка Жаккара подписи sig с каждой строкой others."""
+    if others.size == 0:
+        return np.zeros(0, dtype=np.float32)
+    return (others == sig).mean(axis=1).astype(np.float32)
+
+def size(text: str) -> int:
+    """Число различных шинглов текста (для оценки вложенности)."""
+    return int(_shingles(text).shape[0])
+
+def containment(sig: np.ndarray, n: int, others: np.ndarray, ns: np.ndarray) -> np.ndarray:
+    """Оценка |A∩B| / min(|A|, |B|) для подписи sig (n шинглов) и строк others (ns шинглов)."""
+    j = similarity(sig, others)
+    inter = j * (n + ns) / (1 + j)
+    return np.minimum(1.0, inter / np.maximum(1, np.minimum(n, ns))).astype(np.float32)
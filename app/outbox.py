@@ -0,0 +1,148 @@
+# app/outbox.py
+from __future__ import annotations
+import os, time, random, threading, traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from app.db import get_conn, add_log
+from app import max_api, staging
+
+# Durable outbox для отправки постов.
+# Слот кладёт пост в таблицу outbox (уникально по draft_id+channel, так что
+# второй воркер/повторный запуск не отправит дважды), а фоновый доставщик
+# забирает строки через FOR UPDATE SKIP LOCKED, соблюдает лимит на токен бота
+# и повторяет неудачные попытки с экспоненциальной задержкой.
+#
+# Состояния: pending → sending → sent | pending (ретрай) | failed
+
+_WAKE = threading.Event()
+_THREAD: threading.Thread | None = None
+_START_LOCK = threading.Lock()
+
+_RATE_LOCK = threading.Lock()
+_NEXT_SEND: Dict[str, float] = {}  # token_env -> monotonic time следующей разрешённой отправки
+
+def _max_attempts() -> int:
+    return int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+
+def _backoff(attempts: int) -> float:
+    base = float(os.getenv("OUTBOX_BACKOFF_SEC", "5"))
+    cap = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "600"))
+    return min(base * 2 ** max(0, attempts - 1), cap) + random.uniform(0, 1)
+
+def enqueue(draft_id: int, channel: str, alias: str, token_env: str, text: str,
+            api_base: str | None = None, due_at: datetime | None = None) -> bool:
+    """Поставить пост в очередь. False — такой (draft_id, channel) уже есть."""
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+        INSERT INTO outbox(draft_id, channel, alias, token_env, api_base, text, due_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (draft_id, channel) DO NOTHING
+        RETURNING id;
+        """, (draft_id, channel, alias, token_env, api_base, text, due_at))
+        row = cur.fetchone()
+    if row:
+        _WAKE.set()
+        return True
+    print(f"[OUTBOX] draft {draft_id} for {channel} already queued/sent")
+    return False
+
+def _claim(limit: int) -> List[tuple]:
+    # OUTBOX_STUCK_SEC должен быть заметно больше времени одной отправки:
+    # зависшая в sending строка считается брошенной и забирается повторно
+    stuck = int(os.getenv("OUTBOX_STUCK_SEC", "300"))
+    max_attempts = _max_attempts()
+    with get_conn() as conn, conn.cursor() as cur:
+        # зависшие без оставшихся попыток не переотправляем — это failed
+        cur.execute("""
+        UPDATE outbox SET state='failed', last_error=COALESCE(last_error, 'stuck in sending')
+         WHERE state='sending' AND claimed_at < NOW() - make_interval(secs => %s)
+           AND attempts >= %s
+        RETURNING id, alias, draft_id;
+        """, (stuck, max_attempts))
+        for row_id, alias, draft_id in cur.fetchall():
+            msg = f"[OUTBOX] {alias} draft_id={draft_id} stuck in sending, attempts exhausted -> failed"
+            print(msg)
+            add_log(msg)
+        cur.execute("""
+        UPDATE outbox SET state='sending', attempts=attempts+1, claimed_at=NOW()
+         WHERE id IN (
+            SELECT id FROM outbox
+             WHERE (state='pending' AND next_retry_at <= NOW())
+                OR (state='sending' AND claimed_at < NOW() - make_interval(secs => %s)
+                    AND attempts < %s)
+             ORDER BY next_retry_at
+             LIMIT %s
+             FOR UPDATE SKIP LOCKED
+         )
+        RETURNING id, draft_id, channel, alias, token_env, api_base, text, attempts, due_at;
+        """, (stuck, max_attempts, limit))
+        return cur.fetchall()
+
+def _finish(row_id: int, ok: bool, attempts: int, error: str = ""):
+    with get_conn() as conn, conn.cursor() as cur:
+        if ok:
+            cur.execute("UPDATE outbox SET state='sent', sent_at=NOW(), last_error=NULL WHERE id=%s;", (row_id,))
+        elif attempts >= _max_attempts():
+            cur.execute("UPDATE outbox SET state='failed', last_error=%s WHERE id=%s;", (error, row_id))
+        else:
+            cur.execute("""
+            UPDATE outbox SET state='pending', last_error=%s,
+                   next_retry_at=NOW() + make_interval(secs => %s)
+             WHERE id=%s;
+            """, (error, _backoff(attempts), row_id))
+
+def _wait_rate(token_env: str):
+    """Не чаще OUTBOX_RATE_PER_SEC сообщений в секунду на один токен бота."""
+    interval = 1.0 / max(0.01, float(os.getenv("OUTBOX_RATE_PER_SEC", "1")))
+    with _RATE_LOCK:
+        now = time.monotonic()
+        at = max(now, _NEXT_SEND.get(token_env, 0.0))
+        _NEXT_SEND[token_env] = at + interval
+    if at > now:
+        time.sleep(at - now)
+
+def _deliver(row: tuple):
+    row_id, draft_id, channel, alias, token_env, api_base, text, attempts, due_at = row
+    token = os.getenv(token_env)
+    dry = not bool(token)  # если токена нет — DRY-режим
+    try:
+        _wait_rate(token_env)
+        ok = max_api.send_text(token=token, alias=alias, text=text, api_base=api_base, dry_run=dry)
+        error = "" if ok else "send_text returned False"
+    except Exception as e:
+        ok, error = False, str(e)
+
+    tag = "DRY" if dry else ("SENT" if ok else "FAIL")
+    msg = f"[{tag}] {alias} draft_id={draft_id} attempt={attempts} -> {ok}"
+    print(msg)
+    add_log(msg)
+    if ok and due_at is not None:
+        late = staging.record_lateness(f"{alias} draft_id={draft_id}", due_at)
+        add_log(f"[LATE] {alias} draft_id={draft_id} {late:.2f}s {staging.lateness_stats()}")
+    _finish(row_id, ok, attempts, error)
+
+def _worker():
+    poll = float(os.getenv("OUTBOX_POLL_SEC", "5"))
+    workers = max(1, int(os.getenv("OUTBOX_WORKERS", "4")))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox") as pool:
+        while True:
+            _WAKE.clear()
+            try:
+                rows = _claim(limit=workers * 4)
+                list(pool.map(_deliver, rows))
+            except Exception as e:
+                rows = []
+                print(f"[OUTBOX ERR] {e}")
+                print(traceback.format_exc())
+            if not rows:
+                _WAKE.wait(timeout=poll)
+
+def start_worker():
+    """Запустить фоновый доставщик (один на процесс)."""
+    global _THREAD
+    with _START_LOCK:
+        if _THREAD is None:
+            _THREAD = threading.Thread(target=_worker, name="outbox", daemon=True)
+            _THREAD.start()
@@ -1,13 +1,19 @@
 # app/planner.py
 from __future__ import annotations
-import traceback
+import os, traceback
 import datetime as dt
 from typing import List, Dict, Tuple
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 
-from app.generator import generate_from_book
-from app.db import upsert_draft
+from app.generator import (
+    generate_from_book, prewarm_summaries,
+    summary_requests, apply_summaries, post_requests, apply_posts, stored_summary, summary_key,
+)
+from app.db import upsert_draft, add_log, create_batch_job, open_batch_jobs, update_batch_job
+from app.llm_cache import cache_stats
+from app import metrics, batch
 from app.sheets import (
     push_drafts, pull_control_requests, update_control_status,
     pull_books, update_book_status
@@ -15,6 +21,7 @@ from app.sheets import (
 
 ROOT = Path(__file__).resolve().parents[1]
 SCH_FILE = ROOT / "config" / "schedules.yaml"
+CH_FILE = ROOT / "config" / "channels.yaml"
 
 def _load_yaml(p: Path) -> dict:
     return yaml.safe_load(p.read_text(encoding="utf-8")) or {}
@@ -30,6 +37,15 @@ def _find_channel_slots(alias: str, name: str) -> Tuple[str, List[Dict]]:
             break
     return tz, slots
 
+def enabled_channels() -> List[Tuple[str, str]]:
+    """(name, alias) включённых каналов из channels.yaml."""
+    cfg = _load_yaml(CH_FILE)
+    return [
+        (ch.get("name") or "", ch.get("alias") or "")
+        for ch in (cfg.get("channels") or [])
+        if ch.get("enabled", True)
+    ]
+
 def _pick_new_book() -> dict | None:
     # Берём первую книгу со статусом new (без выдумок)
     for b in pull_books():
@@ -37,6 +53,22 @@ def _pick_new_book() -> dict | None:
             return b
     return None
 
+def _generate_texts(channel_name: str, book_id: str, slots: List[Dict]) -> List[str | BaseException]:
+    """
+    Тексты для всех слотов через пул потоков (GEN_CONCURRENCY).
+    Порядок результатов = порядок слотов; ошибка слота возвращается как исключение.
+    """
+    workers = max(1, min(int(os.getenv("GEN_CONCURRENCY", "4")), len(slots)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gen") as pool:
+        futs = [pool.submit(generate_from_book, channel_name, book_id, s["format"]) for s in slots]
+        out: List[str | BaseException] = []
+        for f in futs:
+            try:
+                out.append(f.result())
+            except Exception as e:
+                out.append(e)
+    return out
+
 def generate_day(channel_name: str, channel_alias: str, date_iso: str) -> int:
     print(f"[GEN] start generate_day channel={channel_name} alias={channel_alias} date={date_iso}")
     tz, slots = _find_channel_slots(channel_alias, channel_name)
@@ -64,12 +96,19 @@ def generate_day(channel_name: str, channel_alias: str, date_iso: str) -> int:
     created_rows: List[Dict] = []
     created_count = 0
 
-    # 2) генерим все слоты
-    for s in slots:
+    # 2) генерим все слоты параллельно (LLM-вызовы независимы),
+    #    а черновики пишем по порядку слотов
+    with metrics.timer("generate_stage_seconds", stage="posts"):
+        texts = _generate_texts(channel_name, book_id, slots)
+    for s, res in zip(slots, texts):
         fmt = s["format"]
         hhmm = s["time"]
+        if isinstance(res, BaseException):
+            print(f"[GEN ERR] slot {fmt} {hhmm}: {res}")
+            print("".join(traceback.format_exception(res)))
+            continue
         try:
-            text = generate_from_book(channel_name, book_id, fmt)
+            text = res
             draft_id = upsert_draft(
                 channel=channel_name, fmt=fmt, book_id=book_id,
                 text=text, d=date_iso, t=hhmm
@@ -97,7 +136,8 @@ def generate_day(channel_name: str, channel_alias: str, date_iso: str) -> int:
     pushed_ok = False
     if created_rows:
         try:
-            push_drafts(created_rows)
+            with metrics.timer("generate_stage_seconds", stage="sheets_push"):
+                push_drafts(created_rows)
             pushed_ok = True
             print(f"[SHEETS] pushed {len(created_rows)} rows for book {book_title}")
         except Exception as e:
@@ -119,8 +159,214 @@ def generate_day(channel_name: str, channel_alias: str, date_iso: str) -> int:
         print(f"[BOOKS ERR] update_book_status(final): {e}")
         print(traceback.format_exc())
 
+    stats = cache_stats()
+    if stats:
+        print(f"[LLM CACHE] {stats}")
+    metrics.inc("generate_drafts_total", created_count, channel=channel_name)
+
     return created_count
 
+# ---------- Пакетная генерация (Batch API) ----------
+# Пакет идёт до 24 ч, поэтому в воркере планировщика его не ждём:
+# generate_batch отправляет пакет и записывает план в batch_jobs,
+# а poll_batch_jobs на каждом тике проверяет статус и двигает задачу дальше:
+#   summary (пакет конспектов) → posts (пакет постов) → черновики + push → done
+
+def _plan_items(plan: List[Dict]) -> List[Tuple[str, str, str, str]]:
+    # custom_id — по слоту, а не по формату: один формат может стоять в дне дважды
+    return [
+        (f"post|{i}|{j}|{s['format']}", p["channel"], p["book_id"], s["format"])
+        for i, p in enumerate(plan)
+        for j, s in enumerate(p["slots"])
+    ]
+
+def _submit(reqs: List[dict], what: str) -> str:
+    batch_id = batch.submit(reqs)
+    msg = f"[BATCH] submitted {batch_id}: {len(reqs)} {what} requests"
+    print(msg)
+    add_log(msg)
+    return batch_id
+
+def _rollback_books(plan: List[Dict], reason: str):
+    for p in plan:
+        try:
+            update_book_status(p["book_id"], "new", note=f"rollback: {reason} for {p['channel']} {p['date']}")
+        except Exception as e:
+            print(f"[BOOKS ERR] update_book_status(rollback): {e}")
+
+def generate_batch(channels: List[Tuple[str, str]], dates: List[str], control_row: int | None = None) -> int:
+    """
+    Пакетная генерация (OpenAI Batch API) для набора каналов и дат:
+    каждой паре (дата, канал) — своя книга со статусом new. Отправляет пакет
+    конспектов (или сразу постов, если конспекты готовы) и возвращает id задачи
+    в batch_jobs (0 — нечего генерировать); результат разберёт poll_batch_jobs.
+    """
+    new_books = [b for b in pull_books() if (b.get("status") or "").strip().lower() == "new"]
+    plan: List[Dict] = []
+    for date_iso in dates:
+        for name, alias in channels:
+            _, slots = _find_channel_slots(alias, name)
+            if not slots:
+                print(f"[GEN] no slots for {name or alias}")
+                continue
+            if not new_books:
+                print(f"[GEN] no new books left for {name or alias} {date_iso}")
+                continue
+            book_id = (new_books.pop(0).get("file_id") or "").strip()
+            plan.append({"date": date_iso, "channel": name or alias, "book_id": book_id,
+                         "slots": [{"format": s["format"], "time": s["time"]} for s in slots]})
+    if not plan:
+        return 0
+
+    for p in plan:
+        try:
+            update_book_status(p["book_id"], "in_progress", note=f"batch for {p['channel']} {p['date']}")
+        except Exception as e:
+            print(f"[BOOKS WARN] can't set in_progress: {e}")
+
+    try:
+        with metrics.timer("generate_stage_seconds", stage="batch_submit"):
+            ready, reqs = summary_requests(p["book_id"] for p in plan)
+            if reqs:
+                stage, batch_id = "summary", _submit(reqs, "summary")
+            else:
+                stage, batch_id = "posts", _submit(post_requests(_plan_items(plan), ready), "post")
+        job_id = create_batch_job(stage, batch_id, {"plan": plan}, control_row)
+    except Exception:
+        _rollback_books(plan, "batch submit failed")
+        raise
+    print(f"[BATCH] job {job_id}: {stage} batch {batch_id} for {len(plan)} channel-days")
+    return job_id
+
+def _finalize(plan: List[Dict], texts: Dict[str, str | None]) -> int:
+    """Черновики из готовых текстов, один push в Sheets, финальные статусы книг."""
+    created_rows: List[Dict] = []
+    created: Dict[int, int] = {}
+    for i, p in enumerate(plan):
+        for j, s in enumerate(p["slots"]):
+            fmt, hhmm = s["format"], s["time"]
+            text = texts.get(f"post|{i}|{j}|{fmt}")
+            if text is None:
+                print(f"[GEN ERR] batch slot {p['channel']} {fmt} {p['date']}: no result")
+                continue
+            try:
+                draft_id = upsert_draft(channel=p["channel"], fmt=fmt, book_id=p["book_id"],
+                                        text=text, d=p["date"], t=hhmm)
+            except Exception as e:
+                print(f"[GEN ERR] slot {fmt} {hhmm}: {e}")
+                print(traceback.format_exc())
+                continue
+            created[i] = created.get(i, 0) + 1
+            created_rows.append({
+                "id": draft_id, "date": p["date"], "time": hhmm, "channel": p["channel"],
+                "format": fmt, "book_id": p["book_id"], "text": text, "status": "new",
+                "edited_text": "", "approved_by": "", "approved_at": "",
+            })
+
+    pushed_ok = False
+    if created_rows:
+        try:
+            with metrics.timer("generate_stage_seconds", stage="sheets_push"):
+                push_drafts(created_rows)
+            pushed_ok = True
+            print(f"[SHEETS] pushed {len(created_rows)} batch rows")
+        except Exception as e:
+            print(f"[SHEETS ERR] push_drafts: {e}")
+            print(traceback.format_exc())
+
+    for i, p in enumerate(plan):
+        n = created.get(i, 0)
+        try:
+            if n and pushed_ok:
+                update_book_status(p["book_id"], "used", note=f"used for {p['channel']} {p['date']} ({n} drafts, batch)")
+            else:
+                reason = "0 drafts" if not n else "push failed"
+                update_book_status(p["book_id"], "new", note=f"rollback: {reason} for {p['channel']} {p['date']}")
+        except Exception as e:
+            print(f"[BOOKS ERR] update_book_status(final): {e}")
+        metrics.inc("generate_drafts_total", n, channel=p["channel"])
+
+    return len(created_rows)
+
+def _stored_summaries(plan: List[Dict]) -> Dict[str, Dict]:
+    out = {}
+    for book_id in dict.fromkeys(p["book_id"] for p in plan):
+        s = stored_summary(summary_key(book_id))
+        if s is not None:
+            out[book_id] = s
+    return out
+
+def _close_job(job: Dict, state: str, note: str):
+    update_batch_job(job["id"], state=state, note=note)
+    msg = f"[BATCH] job {job['id']} {state}: {note}"
+    print(msg)
+    add_log(msg)
+    if job.get("control_row"):
+        try:
+            update_control_status(int(job["control_row"]), "done" if state == "done" else "error", note)
+        except Exception as e:
+            print(f"[CONTROL ERR] batch job {job['id']}: {e}")
+
+def _advance(job: Dict):
+    plan = job["plan"]["plan"]
+    items = _plan_items(plan)
+    if job["stage"] == "summary":
+        res = batch.check(job["batch_id"], [f"summary|{b}" for b in dict.fromkeys(p["book_id"] for p in plan)])
+    else:
+        res = batch.check(job["batch_id"], [key for key, *_ in items])
+
+    if res is None:
+        timeout = float(os.getenv("GEN_BATCH_TIMEOUT_SEC", "86400"))
+        age = (dt.datetime.now(dt.timezone.utc) - job["created_at"]).total_seconds()
+        if age > timeout:
+            _rollback_books(plan, "batch timeout")
+            _close_job(job, "failed", f"batch {job['batch_id']} not finished after {age:.0f}s")
+        return
+
+    if job["stage"] == "summary":
+        apply_summaries(res)
+        reqs = post_requests(items, _stored_summaries(plan))
+        if not reqs:
+            _rollback_books(plan, "no summaries")
+            _close_job(job, "failed", "batch returned no summaries")
+            return
+        batch_id = _submit(reqs, "post")
+        update_batch_job(job["id"], stage="posts", batch_id=batch_id)
+        return
+
+    with metrics.timer("generate_stage_seconds", stage="batch_posts"):
+        texts = apply_posts(items, _stored_summaries(plan), res)
+    n = _finalize(plan, texts)
+    _close_job(job, "done", f"created {n} drafts (batch)")
+
+def poll_batch_jobs():
+    """Тик планировщика: продвинуть открытые пакетные задачи (без ожидания)."""
+    for job in open_batch_jobs():
+        try:
+            _advance(job)
+        except Exception as e:
+            print(f"[BATCH ERR] job {job['id']}: {e}")
+            print(traceback.format_exc())
+
+def _date_range(value: str) -> List[str]:
+    """'2025-01-01' или '2025-01-01..2025-01-07' → список дат."""
+    lo, _, hi = (value or dt.date.today().isoformat()).partition("..")
+    start = dt.date.fromisoformat(lo.strip())
+    end = dt.date.fromisoformat(hi.strip()) if hi.strip() else start
+    return [(start + dt.timedelta(days=k)).isoformat() for k in range((end - start).days + 1)]
+
+def prewarm_upcoming(limit: int | None = None) -> int:
+    """Посчитать конспекты для ближайших книг со статусом new (лист books)."""
+    limit = int(os.getenv("SUMMARY_PREWARM_BOOKS", "3")) if limit is None else limit
+    ids = [
+        (b.get("file_id") or "").strip()
+        for b in pull_books()
+        if (b.get("status") or "").strip().lower() == "new"
+    ][:limit]
+    n = prewarm_summaries(ids)
+    print(f"[SUMMARY] prewarmed {n}/{len(ids)} books")
+    return n
+
 def poll_control():
     reqs = pull_control_requests()
     if not reqs:
@@ -135,6 +381,19 @@ def poll_control():
             if action == "generate_day":
                 n = generate_day(ch_name, alias, date_iso)
                 update_control_status(int(row), "done", f"created {n} drafts")
+            elif action == "generate_batch":
+                # date: день или диапазон 'YYYY-MM-DD..YYYY-MM-DD'; пустой channel — все включённые
+                dates = _date_range(r.get("date") or "")
+                channels = [(ch_name, alias)] if (ch_name or alias) else enabled_channels()
+                job_id = generate_batch(channels, dates, control_row=int(row))
+                if job_id:
+                    # done/error поставит poll_batch_jobs, когда пакет вернётся
+                    update_control_status(int(row), "in_progress", f"batch job {job_id}")
+                else:
+                    update_control_status(int(row), "done", "nothing to generate")
+            elif action == "prewarm_summaries":
+                n = prewarm_upcoming()
+                update_control_status(int(row), "done", f"prewarmed {n} summaries")
             else:
                 update_control_status(int(row), "error", f"unknown action {action}")
         except Exception as e:
@@ -0,0 +1,165 @@
+# app/postprocess.py
+from __future__ import annotations
+import re, threading
+from typing import Any, Dict, List, Tuple
+
+# Постобработка сгенерированного поста за один проход.
+# Анти-кликбейт собран в один скомпилированный сканер: один finditer по тексту
+# (в нижнем регистре — без IGNORECASE это заметно быстрее) находит все штампы,
+# вырезаем их срезами, схлопываем пустые строки и, если эмодзи больше лимита,
+# прореживаем их одним sub. Правила применяются «слева направо» разом, а не
+# цепочкой проходов, поэтому вырезание одного штампа не порождает новых совпадений.
+#
+# Правила канала дополняются из config/tov.yaml:
+#   channels:
+#     <name>:
+#       postprocess:
+#         stop_starts: ["а вы когда-нибудь"]   # строка-вопрос с такого начала удаляется целиком
+#         stop_phrases: ["в этой статье"]      # фраза вырезается до конца предложения
+#         emoji_limits: [[400, 1], [800, 2], [null, 3]]  # [длина меньше, лимит]; null — иначе
+#         tags: {quote: "#цитата #мысль"}
+
+STOP_STARTS = (
+    "знаете ли вы", "вы знали", "а знаете", "а что если", "что если",
+    "секрет в том", "многие не знают", "представьте", "представь",
+)
+STOP_PHRASES = (
+    "в одной из глав", "эта книга покажет",
+    "погрузитесь в мир", "откройте новые горизонты",
+)
+EMOJI_LIMITS: Tuple[Tuple[int | None, int], ...] = ((400, 1), (800, 2), (None, 3))
+
+_EMOJI_CLASS = (
+    r"[\U0001F1E6-\U0001F1FF"   # флаги
+    r"\U0001F300-\U0001F5FF"    # символы/пиктограммы
+    r"\U0001F600-\U0001F64F"    # смайлики
+    r"\U0001F680-\U0001F6FF"    # транспорт/символы
+    r"\U00002600-\U000026FF"    # разное
+    r"\U00002700-\U000027BF"    # литералы
+    r"\U0001FA70-\U0001FAFF]"   # расширения
+)
+_EMOJI_RE = re.compile(_EMOJI_CLASS)
+_BLANKS_RE = re.compile(r"\n{3,}")
+
+FORMAT_EMOJI = {
+    "announce": "📚",
+    "insight":  "💡",
+    "practice": "🛠️",
+    "case":     "📌",
+    "quote":    "🗣️",
+    "reflect":  "🧭",
+}
+FORMAT_TAGS = {
+    "announce": "#анонс #книга",
+    "insight":  "#инсайт",
+    "practice": "#практика",
+    "case":     "#кейс",
+    "quote":    "#цитата",
+    "reflect":  "#рефлексия",
+}
+FORMAT_LABELS = {
+    "announce": "анонс",
+    "insight":  "ключевые идеи",
+    "practice": "практика",
+    "case":     "кейс",
+    "quote":    "цитата",
+    "reflect":  "вопрос дня",
+}
+
+def _phrase_re(phrase: str) -> str:
+    return r"\s+".join(re.escape(w) for w in phrase.split())
+
+class Rules:
+    """Скомпилированные правила одного канала."""
+    __slots__ = ("scanner", "scanner_i", "emoji_limits", "tags")
+
+    def __init__(self, stop_starts: List[str], stop_phrases: List[str],
+                 emoji_limits: List[Tuple[int | None, int]], tags: Dict[str, str]):
+        starts = "|".join(_phrase_re(p.lower()) for p in stop_starts)
+        phrases = "|".join(_phrase_re(p.lower()) for p in stop_phrases)
+        alts = []
+        if starts:
+            alts.append(r"^\s*(?:" + starts + r").{0,120}\?\s*\n?")
+        if phrases:
+            alts.append(r"(?:" + phrases + r").*?(?:\.|\n)")
+        pattern = "|".join(alts) or r"(?!)"
+        self.scanner = re.compile(pattern, re.MULTILINE)
+        # для текстов, у которых lower() меняет длину (редкие символы), — обычный IGNORECASE
+        self.scanner_i = re.compile(pattern, re.MULTILINE | re.IGNORECASE)
+        self.emoji_limits = tuple(emoji_limits)
+        self.tags = tags
+
+    def emoji_limit(self, length: int) -> int:
+        for below, limit in self.emoji_limits:
+            if below is None or length < below:
+                return limit
+        return self.emoji_limits[-1][1] if self.emoji_limits else 0
+
+def compile_rules(cfg: Dict[str, Any] | None = None) -> Rules:
+    cfg = cfg or {}
+    limits = [(None if b is None else int(b), int(n)) for b, n in (cfg.get("emoji_limits") or EMOJI_LIMITS)]
+    return Rules(
+        stop_starts=list(STOP_STARTS) + list(cfg.get("stop_starts") or []),
+        stop_phrases=list(STOP_PHRASES) + list(cfg.get("stop_phrases") or []),
+        emoji_limits=limits,
+        tags={**FORMAT_TAGS, **(cfg.get("tags") or {})},
+    )
+
+_RULES: Dict[str, Rules] = {}
+_LOCK = threading.Lock()
+
+def rules_for(channel_name: str, cfg: Dict[str, Any] | None = None) -> Rules:
+    """Правила канала (компилируются один раз; cfg — секция postprocess из tov.yaml)."""
+    with _LOCK:
+        r = _RULES.get(channel_name)
+        if r is None:
+            r = _RULES[channel_name] = compile_rules(cfg)
+        return r
+
+def reset():
+    """Забыть скомпилированные правила (после правки tov.yaml)."""
+    with _LOCK:
+        _RULES.clear()
+
+def _drop_emojis(text: str, keep: int) -> str:
+    seen = 0
+    def _sub(m):
+        nonlocal seen
+        seen += 1
+        return m.group() if seen <= keep else ""
+    return _EMOJI_RE.sub(_sub, text)
+
+def clean(text: str, rules: Rules) -> str:
+    """Тело поста: без **, штампов и лишних пустых строк; эмодзи не больше лимита по длине."""
+    text = text.replace("**", "").strip()
+    low = text.lower()
+    if len(low) == len(text):
+        matches = rules.scanner.finditer(low)
+    else:
+        matches = rules.scanner_i.finditer(text)
+    parts: List[str] = []
+    pos = 0
+    for m in matches:
+        parts.append(text[pos:m.start()])
+        pos = m.end()
+    if parts:
+        parts.append(text[pos:])
+        text = "".join(parts)
+    body = _BLANKS_RE.sub("\n\n", text).strip()
+    limit = rules.emoji_limit(len(body))
+    if len(_EMOJI_RE.findall(body)) > limit:
+        body = _drop_emojis(body, limit)
+    return body
+
+def render(fmt: str, body: str, title: str, author: str, rules: Rules) -> str:
+    """Заголовок + тело + хэштеги."""
+    emoji = FORMAT_EMOJI.get(fmt, "📝")
+    label = FORMAT_LABELS.get(fmt, fmt)
+    tags = rules.tags.get(fmt, "#сводка")
+    # Заголовок: для анонса добавляем автора, если известен
+    if fmt == "announce":
+        title_full = f"{title} ({author})" if author else title
+        header = f"{emoji} Книга дня — {title_full}"
+    else:
+        header = f"{emoji} {title} — {label.capitalize()}"
+    return f"{header}\n\n{body}\n\n{tags}".strip()
@@ -1,15 +1,18 @@
 from __future__ import annotations
 from typing import List, Dict, Any
-import json
+from collections import OrderedDict
+import os, json, time, threading
 import numpy as np
 from app.db import get_conn
 from app.gpt import embed_texts
+from app import bm25, minhash, metrics
 
-def _cosine(a: np.ndarray, b: np.ndarray) -> float:
-    na = np.linalg.norm(a); nb = np.linalg.norm(b)
-    if na == 0 or nb == 0: 
-        return 0.0
-    return float(a.dot(b) / (na * nb))
+# Режимы поиска (RETRIEVER_MODE):
+#   vector  — только косинус по эмбеддингам (по умолчанию, как раньше)
+#   hybrid  — косинус + BM25, оценки смешиваются с весом RETRIEVER_HYBRID_ALPHA
+#   lexical — только BM25: без обращения к API эмбеддингов
+# Эмбеддинги запросов кэшируются в памяти (RETRIEVER_QUERY_CACHE штук) —
+# постоянные запросы из generator._collect_context уходят в API один раз.
 
 def _to_vec(emb: Any) -> np.ndarray:
     """
@@ -30,20 +33,193 @@ def _to_vec(emb: Any) -> np.ndarray:
     # неизвестный формат
     return np.zeros(1536, dtype=np.float32)
 
-def search_book(book_id: str, query: str, top_k: int = 5) -> List[Dict]:
-    [qv] = embed_texts([query])
-    q = np.array(qv, dtype=np.float32)
+# ---------- Индекс книги в памяти ----------
+class _BookIndex:
+    """
+    Все векторы книги одной матрицей float32 (строки уже нормированы),
+    чтобы косинус для запроса считался одним matvec.
+    """
+    __slots__ = ("chunk_ids", "texts", "mat", "lex", "sigs", "rows", "version", "loaded_at")
+
+    def __init__(self, chunk_ids: List[int], texts: List[str], mat: np.ndarray,
+                 lex: bm25.Index | None = None, sigs: List[List[int] | None] | None = None):
+        self.chunk_ids = chunk_ids
+        self.texts = texts
+        self.mat = mat
+        self.lex = lex if lex is not None else bm25.Index(bm25.build(texts))
+        # MinHash-подписи строками матрицы; чанки, записанные до подписей, досчитываем
+        sigs = sigs or [None] * len(texts)
+        self.sigs = np.array(
+            [s if s is not None and len(s) == minhash.PERM else minhash.signature(t) for s, t in zip(sigs, texts)],
+            dtype=np.uint64,
+        ).reshape(len(texts), minhash.PERM)
+        self.rows = {cid: i for i, cid in enumerate(chunk_ids)}
+        self.version = bm25.version(chunk_ids, texts)  # версия из уже загруженных текстов, без запроса к БД
+        self.loaded_at = time.monotonic()
+
+_INDEX: Dict[str, _BookIndex] = {}
+_INDEX_LOCK = threading.Lock()
 
-    rows = []
+def _index_ttl() -> float:
+    # страховка для случая, когда чанки пишет другой процесс
+    return float(os.getenv("RETRIEVER_INDEX_TTL_SEC", "3600"))
+
+def _load_index(book_id: str) -> _BookIndex:
     with get_conn() as conn, conn.cursor() as cur:
         cur.execute(
-            "SELECT chunk_id, text, emb FROM chunks WHERE book_id=%s ORDER BY chunk_id ASC;",
+            "SELECT chunk_id, text, emb, minhash FROM chunks WHERE book_id=%s ORDER BY chunk_id ASC;",
             (book_id,)
         )
-        for chunk_id, text, emb_val in cur.fetchall():
-            v = _to_vec(emb_val)
-            score = _cosine(q, v)
-            rows.append((chunk_id, text or "", score))
+        rows = cur.fetchall()
+
+        chunk_ids, texts, vecs, sigs = [], [], [], []
+        for chunk_id, text, emb_val, sig in rows:
+            chunk_ids.append(chunk_id)
+            texts.append(text or "")
+            vecs.append(_to_vec(emb_val))
+            sigs.append(sig)
+
+        ver = bm25.version(chunk_ids, texts)
+        lex_data = bm25.load(cur, book_id, ver)
+
+    if lex_data is None:
+        # BM25 строится при импорте; для книг, залитых до него, строим в памяти
+        # и сохраняем отдельной короткой транзакцией — загрузка индекса от неё не зависит
+        lex_data = bm25.build(texts)
+        try:
+            with get_conn() as conn, conn.cursor() as cur:
+                bm25.save(cur, book_id, ver, lex_data)
+        except Exception as e:
+            print(f"[RETRIEVER WARN] can't persist bm25 for {book_id}: {e}")
+
+    dim = max((v.shape[0] for v in vecs), default=1536)
+    mat = np.zeros((len(vecs), dim), dtype=np.float32)
+    for i, v in enumerate(vecs):
+        if v.shape[0] == dim:
+            mat[i] = v  # битые/короткие векторы остаются нулевыми
+
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    mat /= norms
+    return _BookIndex(chunk_ids, texts, np.ascontiguousarray(mat), bm25.Index(lex_data), sigs)
+
+def get_index(book_id: str) -> _BookIndex:
+    with _INDEX_LOCK:
+        idx = _INDEX.get(book_id)
+    if idx is not None and time.monotonic() - idx.loaded_at < _index_ttl():
+        return idx
+    idx = _load_index(book_id)
+    with _INDEX_LOCK:
+        _INDEX[book_id] = idx
+    return idx
+
+def book_version(book_id: str) -> str:
+    """
+    Отпечаток набора чанков книги (bm25.version) из индекса
+    в памяти: живёт до invalidate_book/TTL, так что не сканирует книгу на каждый вызов.
+    """
+    return get_index(book_id).version
+
+def invalidate_book(book_id: str) -> None:
+    """Сбросить индекс книги (вызывается после записи новых чанков)."""
+    with _INDEX_LOCK:
+        _INDEX.pop(book_id, None)
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(n)
+    return part[np.argsort(-scores[part], kind="stable")]
+
+# ---------- Эмбеддинги запросов ----------
+_QUERY_EMB: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+_QUERY_EMB_LOCK = threading.Lock()
+
+def _embed_queries(queries: List[str]) -> np.ndarray:
+    """Нормированные эмбеддинги запросов; в API уходят только новые."""
+    model = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+    size = int(os.getenv("RETRIEVER_QUERY_CACHE", "256"))
+    found: Dict[str, np.ndarray] = {}
+    with _QUERY_EMB_LOCK:
+        for q in queries:
+            v = _QUERY_EMB.get((model, q))
+            if v is not None:
+                _QUERY_EMB.move_to_end((model, q))
+                found[q] = v
+    todo = [q for q in dict.fromkeys(queries) if q not in found]
+    metrics.inc("retriever_query_emb_total", len(queries) - len(todo), result="hit")
+    if todo:
+        metrics.inc("retriever_query_emb_total", len(todo), result="miss")
+        for q, e in zip(todo, embed_texts(todo)):
+            v = np.asarray(e, dtype=np.float32)
+            n = float(np.linalg.norm(v))
+            found[q] = v / n if n else v
+            if n and size > 0:  # нулевой фолбэк после ошибок API не кэшируем
+                with _QUERY_EMB_LOCK:
+                    _QUERY_EMB[(model, q)] = found[q]
+                    while len(_QUERY_EMB) > size:
+                        _QUERY_EMB.popitem(last=False)
+    return np.stack([found[q] for q in queries]) if queries else np.empty((0, 0), dtype=np.float32)
+
+def _mode(mode: str | None) -> str:
+    mode = (mode or os.getenv("RETRIEVER_MODE", "vector")).strip().lower()
+    if mode not in ("vector", "hybrid", "lexical"):
+        print(f"[RETRIEVER WARN] unknown RETRIEVER_MODE={mode!r}, using vector")
+        return "vector"
+    return mode
+
+def _scale(row: np.ndarray) -> np.ndarray:
+    top = float(row.max()) if row.size else 0.0
+    return row / top if top > 0 else row
+
+def search_book_many(book_id: str, queries: List[str], top_k: int = 5,
+                     mode: str | None = None) -> List[List[Dict]]:
+    """
+    Несколько запросов за раз: один индекс книги, одно матричное умножение
+    и не больше одного вызова эмбеддингов (только для незнакомых запросов).
+    Результаты — в порядке queries; score — косинус, BM25 или их смесь (см. mode);
+    minhash — подпись чанка из того же снимка индекса, что и текст.
+    """
+    if not queries:
+        return []
+    mode = _mode(mode)
+    t0 = time.perf_counter()
+    idx = get_index(book_id)
+    n_chunks = len(idx.chunk_ids)
+
+    vec = None
+    if mode != "lexical":
+        qs = _embed_queries(list(queries))
+        if qs.ndim == 2 and qs.shape[1] == idx.mat.shape[1]:
+            vec = qs @ idx.mat.T  # (n_queries, n_chunks)
+        elif mode == "vector":
+            return [[] for _ in queries]
+
+    if mode == "vector":
+        scores = vec
+    else:
+        lex = np.stack([idx.lex.scores(q) for q in queries]) if n_chunks else np.zeros((len(queries), 0), np.float32)
+        if vec is None:
+            scores = lex
+        else:
+            alpha = float(os.getenv("RETRIEVER_HYBRID_ALPHA", "0.5"))
+            # BM25 не ограничен сверху — приводим к [0, 1] по лучшему чанку запроса
+            scores = alpha * vec + (1 - alpha) * np.stack([_scale(r) for r in lex])
+
+    out: List[List[Dict]] = []
+    for row in scores:
+        out.append([
+            {"chunk_id": idx.chunk_ids[i], "text": idx.texts[i], "score": float(row[i]),
+             "minhash": idx.sigs[i]}
+            for i in _top_k(row, top_k)
+        ])
+    metrics.observe("retriever_search_seconds", time.perf_counter() - t0, mode=mode)
+    return out
 
-    rows.sort(key=lambda x: x[2], reverse=True)
-    return [{"chunk_id": cid, "text": txt, "score": sc} for cid, txt, sc in rows[:top_k]]
+def search_book(book_id: str, query: str, top_k: int = 5, mode: str | None = None) -> List[Dict]:
+    [hits] = search_book_many(book_id, [query], top_k=top_k, mode=mode)
+    return hits
@@ -0,0 +1,159 @@
+# app/scheduler.py
+from __future__ import annotations
+import os, heapq, itertools, threading, traceback
+from datetime import datetime, timedelta, time as dtime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+from zoneinfo import ZoneInfo
+
+# Планировщик на куче ближайших срабатываний.
+# Ежедневные задачи считаются в своей таймзоне на каждую дату заново,
+# поэтому переход на летнее/зимнее время не сдвигает слоты.
+# Поток спит до ближайшего события (без опроса раз в секунду).
+
+_UTC = ZoneInfo("UTC")
+_MAX_SLEEP = 300.0  # страховка от скачков системных часов
+
+def _misfire_grace() -> float:
+    return float(os.getenv("SCHED_MISFIRE_GRACE_SEC", "300"))
+
+def _parse_hhmm(s: str) -> dtime:
+    parts = list(map(int, s.split(":")))
+    if len(parts) == 2:
+        h, m = parts; sec = 0
+    elif len(parts) == 3:
+        h, m, sec = parts
+    else:
+        raise ValueError(f"Bad time format: {s}")
+    return dtime(hour=h, minute=m, second=sec)
+
+class Job:
+    def __init__(self, name: str, fn: Callable[[], None], *,
+                 at: Optional[dtime] = None, tz: str = "UTC",
+                 interval: Optional[float] = None, grace: Optional[float] = None):
+        self.name = name
+        self.fn = fn
+        self.at = at
+        self.tz = tz
+        self.interval = interval
+        self.grace = _misfire_grace() if grace is None else grace
+        self.next_run: Optional[datetime] = None  # aware UTC
+        self.running = False
+        self.cancelled = False
+
+    def fire_after(self, after: datetime) -> datetime:
+        """Ближайшее срабатывание строго позже after (aware)."""
+        if self.interval is not None:
+            return after + timedelta(seconds=self.interval)
+        zone = ZoneInfo(self.tz)
+        day = after.astimezone(zone).date()
+        while True:
+            cand = datetime.combine(day, self.at, tzinfo=zone).astimezone(_UTC)
+            if cand > after:
+                return cand
+            day += timedelta(days=1)
+
+    def __repr__(self):
+        nxt = self.next_run.isoformat() if self.next_run else "-"
+        return f"<Job {self.name} next={nxt}>"
+
+_HEAP: List[tuple] = []
+_SEQ = itertools.count()
+_COND = threading.Condition()
+_POOL: Optional[ThreadPoolExecutor] = None
+
+def _now() -> datetime:
+    return datetime.now(_UTC)
+
+def _push(job: Job):
+    heapq.heappush(_HEAP, (job.next_run, next(_SEQ), job))
+    _COND.notify()
+
+def every_day_at(hhmm: str, tz: str, fn: Callable[[], None], name: str = "",
+                 catch_up: bool = True, grace: Optional[float] = None) -> Job:
+    """
+    Ежедневная задача в hh:mm[:ss] по локальному времени tz.
+    catch_up: если слот сегодня уже прошёл, но не дальше grace — выполнить сразу.
+    """
+    job = Job(name or f"daily {hhmm} {tz}", fn, at=_parse_hhmm(hhmm), tz=tz, grace=grace)
+    now = _now()
+    nxt = job.fire_after(now - timedelta(seconds=job.grace if catch_up else 0))
+    job.next_run = nxt
+    with _COND:
+        _push(job)
+    return job
+
+def every_seconds(seconds: float, fn: Callable[[], None], name: str = "") -> Job:
+    job = Job(name or f"every {seconds}s", fn, interval=float(seconds), grace=float(seconds))
+    job.next_run = job.fire_after(_now())
+    with _COND:
+        _push(job)
+    return job
+
+def cancel(job: Job):
+    with _COND:
+        job.cancelled = True
+        _COND.notify()
+
+def jobs() -> List[Job]:
+    with _COND:
+        return [j for _, _, j in sorted(_HEAP) if not j.cancelled]
+
+def _run_job(job: Job, due: datetime):
+    late = (_now() - due).total_seconds()
+    try:
+        job.fn()
+    except Exception as e:
+        print(f"[SCHED ERR] {job.name}: {e}")
+        print(traceback.format_exc())
+    finally:
+        with _COND:
+            job.running = False
+    if late > 1:
+        print(f"[SCHED] {job.name} started {late:.1f}s late")
+
+def _pool() -> ThreadPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor(
+            max_workers=max(1, int(os.getenv("SCHED_WORKERS", "4"))),
+            thread_name_prefix="sched",
+        )
+    return _POOL
+
+def run_pending() -> float:
+    """Запустить всё, что пора; вернуть секунды до следующего события."""
+    due_jobs = []
+    with _COND:
+        now = _now()
+        while _HEAP and _HEAP[0][0] <= now:
+            due, _, job = heapq.heappop(_HEAP)
+            if job.cancelled:
+                continue
+            # следующий запуск считаем от планового времени, а не от now
+            job.next_run = job.fire_after(max(due, now - timedelta(seconds=job.grace)))
+            if job.next_run <= now:
+                job.next_run = job.fire_after(now)
+            _push(job)
+            if (now - due).total_seconds() > job.grace:
+                print(f"[SCHED] misfire {job.name}: due {due.isoformat()}, skipped")
+                continue
+            if job.running:
+                print(f"[SCHED] {job.name} still running, skipped")
+                continue
+            job.running = True
+            due_jobs.append((job, due))
+        wait = (_HEAP[0][0] - now).total_seconds() if _HEAP else _MAX_SLEEP
+    for job, due in due_jobs:
+        _pool().submit(_run_job, job, due)
+    return max(0.0, min(wait, _MAX_SLEEP))
+
+def run_forever():
+    while True:
+        wait = run_pending()
+        with _COND:
+            # задачу могли добавить, пока мы были вне лока
+            if _HEAP:
+                wait = min(wait, max(0.0, (_HEAP[0][0] - _now()).total_seconds()))
+            if wait > 0:
+                _COND.wait(timeout=wait)
@@ -1,9 +1,11 @@
 # app/sheets.py
 from __future__ import annotations
-import os, json, datetime as dt
+import os, json, time, threading, datetime as dt
 import gspread
 from google.oauth2.service_account import Credentials
 
+from app import metrics
+
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 SHEET_KEY = os.getenv("GSHEET_KEY")
 
@@ -14,29 +16,148 @@ CONTROL_HEADERS = ["timestamp","action","date","channel","alias","status","note"
 # books
 BOOKS_HEADERS = ["file_id","title","author","mimeType","url","status","updated_at","note"]
 
+# ---------- клиент / листы (кэш на процесс) ----------
+_GC = None
+_SH = None
+_WS: dict[str, "gspread.Worksheet"] = {}
+# _LOCK защищает только кэши ниже (чтение/подмену), сетевые вызовы gspread
+# идут без него: медленный batchGet не должен стопорить остальных.
+_LOCK = threading.RLock()
+_DONE = threading.Condition(_LOCK)  # «загрузка вкладки закончилась»
+
+# снапшоты вкладок: title -> (monotonic time, values)
+_SNAP: dict[str, tuple[float, list[list[str]]]] = {}
+_INFLIGHT: set[str] = set()  # вкладки, которые сейчас кто-то перечитывает
+_GEN: dict[str, int] = {}    # счётчик invalidate: устаревший ответ не кладём в кэш
+_TABS = {
+    "drafts":  (HEADERS, 2000),
+    "control": (CONTROL_HEADERS, 1000),
+    "books":   (BOOKS_HEADERS, 1000),
+}
+
+def _snapshot_ttl() -> float:
+    return float(os.getenv("SHEETS_SNAPSHOT_TTL_SEC", "60"))
+
+def _api(op: str, fn, *args, **kwargs):
+    """Любой вызов Sheets API — через сюда, чтобы попасть в метрики."""
+    with metrics.timer("sheets_api_seconds", op=op):
+        return fn(*args, **kwargs)
+
 def _client():
+    global _GC
+    with _LOCK:
+        if _GC is not None:
+            return _GC
     raw = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     if not raw:
         raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is not set")
     info = json.loads(raw)
     creds = Credentials.from_service_account_info(info, scopes=SCOPES)
-    return gspread.authorize(creds)
+    gc = gspread.authorize(creds)
+    with _LOCK:
+        if _GC is None:
+            _GC = gc
+        return _GC
 
 def _open():
+    global _SH
     if not SHEET_KEY:
         raise RuntimeError("GSHEET_KEY is not set")
-    gc = _client()
-    return gc.open_by_key(SHEET_KEY)
+    with _LOCK:
+        if _SH is not None:
+            return _SH
+    sh = _api("open", _client().open_by_key, SHEET_KEY)
+    with _LOCK:
+        if _SH is None:
+            _SH = sh
+        return _SH
 
-# ---------- drafts ----------
-def _ws_drafts():
+def _ws(title: str):
+    with _LOCK:
+        ws = _WS.get(title)
+        if ws is not None:
+            return ws
+    headers, nrows = _TABS[title]
     sh = _open()
     try:
-        ws = sh.worksheet("drafts")
+        ws = _api("worksheet", sh.worksheet, title)
     except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="drafts", rows=2000, cols=len(HEADERS)+2)
-        ws.update("A1:K1", [HEADERS])
-    return ws
+        ws = _api("add_worksheet", sh.add_worksheet, title=title, rows=nrows, cols=len(headers)+2)
+        _api("update", ws.update, f"A1:{chr(ord('A') + len(headers) - 1)}1", [headers])
+    with _LOCK:
+        return _WS.setdefault(title, ws)
+
+def _reset_handles():
+    global _SH
+    with _LOCK:
+        _SH = None
+        _WS.clear()
+        for t in list(_SNAP):
+            _GEN[t] = _GEN.get(t, 0) + 1
+        _SNAP.clear()
+
+def invalidate(*tabs: str):
+    """Сбросить снапшоты вкладок (после собственных записей). Без аргументов — все."""
+    with _LOCK:
+        for t in (tabs or list(_TABS)):
+            _GEN[t] = _GEN.get(t, 0) + 1
+            _SNAP.pop(t, None)
+
+def _fresh(title: str, now: float):
+    hit = _SNAP.get(title)
+    return hit[1] if hit and now - hit[0] < _snapshot_ttl() else None
+
+def _snapshot(title: str) -> list[list[str]]:
+    """
+    Значения вкладки из снапшота. Если он устарел — одним batchGet
+    перечитываем все устаревшие вкладки (drafts, control, books) сразу.
+    Пока вкладку перечитывает другой поток, ждём его ответа, а не шлём свой.
+    """
+    with _LOCK:
+        while True:
+            now = time.monotonic()
+            values = _fresh(title, now)
+            if values is not None:
+                return values
+            if title not in _INFLIGHT:
+                break
+            _DONE.wait()
+        stale = [t for t in _TABS if t not in _INFLIGHT and _fresh(t, now) is None]
+        _INFLIGHT.update(stale)
+        gens = {t: _GEN.get(t, 0) for t in stale}
+
+    got: dict[str, list[list[str]]] = {}
+    try:
+        for t in stale:
+            _ws(t)  # гарантируем, что вкладка существует
+        res = _api("batch_get", _open().values_batch_get, [f"'{t}'" for t in stale])
+        for t, vr in zip(stale, res.get("valueRanges", [])):
+            got[t] = vr.get("values", [])
+    except gspread.exceptions.APIError:
+        _reset_handles()
+        raise
+    finally:
+        with _LOCK:
+            for t in stale:
+                if t in got and _GEN.get(t, 0) == gens[t]:
+                    _SNAP[t] = (now, got[t])
+            _INFLIGHT.difference_update(stale)
+            _DONE.notify_all()
+    return got.get(title, [])
+
+def _records(values: list[list[str]], headers: list[str]) -> list[dict]:
+    if not values:
+        return []
+    header = values[0]
+    out = []
+    for line in values[1:]:
+        rec = dict(zip(header, line + [""] * (len(header) - len(line))))
+        out.append({k: rec.get(k, "") for k in headers})
+    return out
+
+# ---------- drafts ----------
+def _ws_drafts():
+    return _ws("drafts")
 
 def push_drafts(rows: list[dict]):
     ws = _ws_drafts()
@@ -48,33 +169,42 @@ def push_drafts(rows: list[dict]):
             r.get("status","new"), r.get("edited_text",""), r.get("approved_by",""), r.get("approved_at",""),
         ])
     if values:
-        ws.append_rows(values, value_input_option="RAW")
+        _api("append_rows", ws.append_rows, values, value_input_option="RAW")
+        invalidate("drafts")
 
 def pull_all() -> list[dict]:
+    return _records(_snapshot("drafts"), HEADERS)
+
+def pull_drafts_for_date(date_iso: str) -> list[dict]:
+    """
+    Свежие строки drafts только за дату: читаем колонку date (B),
+    затем один диапазон A{min}:K{max} вокруг найденных строк.
+    """
     ws = _ws_drafts()
-    rows = ws.get_all_records()
+    dates = _api("col_values", ws.col_values, 2)
+    idx = [i for i, v in enumerate(dates[1:], start=2) if (v or "").strip() == date_iso]
+    if not idx:
+        return []
+    lo, hi = min(idx), max(idx)
+    block = _api("get", ws.get, f"A{lo}:K{hi}")
+    wanted = set(idx)
     out = []
-    for r in rows:
-        d = {k: r.get(k, "") for k in HEADERS}
-        out.append(d)
+    for i, line in enumerate(block, start=lo):
+        if i not in wanted:
+            continue
+        line = list(line) + [""] * (len(HEADERS) - len(line))
+        out.append(dict(zip(HEADERS, line)))
     return out
 
 # ---------- control ----------
 def _ws_control():
-    sh = _open()
-    try:
-        ws = sh.worksheet("control")
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="control", rows=1000, cols=len(CONTROL_HEADERS)+2)
-        ws.update("A1:G1", [CONTROL_HEADERS])
-    return ws
+    return _ws("control")
 
 def pull_control_requests() -> list[dict]:
     """
     Возвращает заявки со status='request'. Добавляет поле _row (номер строки).
     """
-    ws = _ws_control()
-    values = ws.get_all_values()
+    values = _snapshot("control")
     if not values:
         return []
     header = values[0]
@@ -88,30 +218,19 @@ def pull_control_requests() -> list[dict]:
 
 def update_control_status(row: int, status: str, note: str = ""):
     ws = _ws_control()
-    ws.update(f"F{row}:G{row}", [[status, note]])
+    _api("update", ws.update, f"F{row}:G{row}", [[status, note]])
+    invalidate("control")
 
 # ---------- books ----------
 def _ws_books():
-    sh = _open()
-    try:
-        ws = sh.worksheet("books")
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="books", rows=1000, cols=len(BOOKS_HEADERS)+2)
-        ws.update("A1:H1", [BOOKS_HEADERS])
-    return ws
+    return _ws("books")
 
 def pull_books() -> list[dict]:
-    ws = _ws_books()
-    rows = ws.get_all_records()
-    out = []
-    for r in rows:
-        d = {k: r.get(k, "") for k in BOOKS_HEADERS}
-        out.append(d)
-    return out
+    return _records(_snapshot("books"), BOOKS_HEADERS)
 
 def _find_book_row_by_id(file_id: str) -> int | None:
     ws = _ws_books()
-    col = ws.col_values(1)  # A: file_id
+    col = _api("col_values", ws.col_values, 1)  # A: file_id
     for idx, val in enumerate(col[1:], start=2):
         if (val or "").strip() == (file_id or "").strip():
             return idx
@@ -128,16 +247,16 @@ def update_book_status(file_id: str, status: str, note: str = ""):
         return
     updated = dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M")
     # ВНИМАНИЕ: только строки, никаких tuple
-    ws.update(f"F{row}:H{row}", [[str(status), str(updated), str(note)]])
+    _api("update", ws.update, f"F{row}:H{row}", [[str(status), str(updated), str(note)]])
+    invalidate("books")
 
 def get_book_meta(file_id: str) -> dict:
-    ws = _ws_books()
-    values = ws.get_all_values()
+    values = _snapshot("books")
     if not values:
         return {}
     header = values[0]
     for line in values[1:]:
-        if (line[0] or "").strip() == (file_id or "").strip():
+        if line and (line[0] or "").strip() == (file_id or "").strip():
             rec = dict(zip(header, line + [""] * (len(header) - len(line))))
             return {
                 "file_id": rec.get("file_id",""),
@@ -1,14 +1,22 @@
 # app/sources/rss.py
 from __future__ import annotations
 
+import os
 import re
+import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import List, Dict
+from pathlib import Path
+from typing import List, Dict, Tuple
+from urllib.parse import urlparse
 
 import requests
 import feedparser
 
+from app import metrics
+
 
 # Аккуратный User-Agent — некоторые сайты режут дефолтные клиенты
 UA = "Mozilla/5.0 (compatible; MaxAutopostBot/1.0; +https://example.com/bot)"
@@ -47,11 +55,90 @@ def _to_item(e, source_url: str) -> Dict:
     }
 
 
+# ---------- состояние лент (ETag/Last-Modified, разобранные записи, seen) ----------
+_STATE_LOCK = threading.Lock()
+_MAX_ENTRIES_PER_FEED = 100
+_MAX_SEEN = 5000
+
+
+def _state_path() -> Path:
+    return Path(os.getenv("RSS_STATE_FILE", ".cache/rss_state.json"))
+
+
+def _item_to_json(it: Dict) -> Dict:
+    d = dict(it)
+    d["published_at"] = it["published_at"].isoformat() if it.get("published_at") else None
+    return d
+
+
+def _item_from_json(d: Dict) -> Dict:
+    it = dict(d)
+    it["published_at"] = datetime.fromisoformat(d["published_at"]) if d.get("published_at") else None
+    return it
+
+
+def _load_state() -> Dict:
+    p = _state_path()
+    try:
+        if p.exists():
+            return json.loads(p.read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"[RSS] state read error: {e}")
+    return {"feeds": {}, "seen": []}
+
+
+def _save_state(state: Dict) -> None:
+    p = _state_path()
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(p)
+    except Exception as e:
+        print(f"[RSS] state write error: {e}")
+
+
+def _fetch_feed(url: str, feed_state: Dict) -> Tuple[List[Dict], Dict]:
+    """
+    Условный GET одной ленты. 304 — отдаём записи из состояния без парсинга.
+    Возвращает (items, новое состояние ленты); при ошибке — то, что было.
+    """
+    headers = {"User-Agent": UA}
+    if feed_state.get("etag"):
+        headers["If-None-Match"] = feed_state["etag"]
+    if feed_state.get("last_modified"):
+        headers["If-Modified-Since"] = feed_state["last_modified"]
+    cached = [_item_from_json(d) for d in feed_state.get("entries", [])]
+    host = urlparse(url).netloc
+    try:
+        with metrics.timer("rss_fetch_seconds", host=host):
+            resp = requests.get(url, headers=headers, timeout=TIMEOUT)
+        metrics.inc("rss_fetch_total", host=host, status=resp.status_code)
+        if resp.status_code == 304:
+            return cached, feed_state
+        resp.raise_for_status()
+        feed = feedparser.parse(resp.content)
+    except Exception as e:
+        # лента недоступна — отдаём прошлые записи, но не молча
+        print(f"[RSS WARN] {url}: {e}; using {len(cached)} cached entries")
+        metrics.inc("rss_stale_total", host=host)
+        return cached, feed_state
+
+    items = [_to_item(e, url) for e in feed.entries[:_MAX_ENTRIES_PER_FEED]]
+    new_state = {
+        "etag": resp.headers.get("ETag") or "",
+        "last_modified": resp.headers.get("Last-Modified") or "",
+        "entries": [_item_to_json(it) for it in items],
+    }
+    return items, new_state
+
+
 def fetch_rss(
     urls: List[str],
     min_pub_dt: datetime | None = None,
     max_items: int = 10,
     pick_latest_if_empty: bool = True,
+    only_new: bool = False,
 ) -> List[Dict]:
     """
     Собирает элементы из списка RSS-урлов.
@@ -60,52 +147,62 @@ def fetch_rss(
     - max_items: сколько элементов вернуть итого
     - pick_latest_if_empty: если после фильтра ничего не осталось,
       берём по 1 самому новому элементу из каждой ленты (без фильтра)
+    - only_new: пропускать ссылки, уже отданные прошлыми вызовами
+
+    Ленты качаются параллельно (RSS_CONCURRENCY) условным GET;
+    ETag/Last-Modified, записи и seen-ссылки хранятся в RSS_STATE_FILE.
 
     Возвращает список dict: {title, link, summary, published_at, source}
     """
+    with _STATE_LOCK:
+        state = _load_state()
+    feeds_state = state.setdefault("feeds", {})
+    seen = set(state.get("seen") or [])
+
+    # 1) все ленты параллельно, один проход
+    per_feed: Dict[str, List[Dict]] = {}
+    workers = max(1, min(int(os.getenv("RSS_CONCURRENCY", "8")), len(urls) or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rss") as pool:
+        futs = {url: pool.submit(_fetch_feed, url, feeds_state.get(url) or {}) for url in urls}
+        for url, fut in futs.items():
+            feed_items, feed_state = fut.result()
+            per_feed[url] = feed_items
+            feeds_state[url] = feed_state
+
+    # 2) «свежие» (берём с запасом, потом обрежем)
     items: List[Dict] = []
-
-    session = requests.Session()
-    session.headers["User-Agent"] = UA
-
-    # 1) Пытаемся собрать «свежие»
     for url in urls:
-        try:
-            resp = session.get(url, timeout=TIMEOUT)
-            resp.raise_for_status()
-            feed = feedparser.parse(resp.content)
-        except Exception:
-            continue
-
-        # берём с запасом, потом обрежем
-        for e in feed.entries[: max_items * 3]:
-            it = _to_item(e, url)
+        for it in per_feed.get(url, [])[: max_items * 3]:
             if min_pub_dt and it["published_at"] and it["published_at"] < min_pub_dt:
                 continue
             if not it["title"] or not it["link"]:
                 continue
+            if only_new and it["link"] in seen:
+                continue
             items.append(it)
 
-    # 2) Если свежих нет — подстрахуемся и возьмём самые новые вообще
+    # 3) Если свежих нет — берём самые новые вообще из уже разобранных лент
     if not items and pick_latest_if_empty:
         for url in urls:
-            try:
-                resp = session.get(url, timeout=TIMEOUT)
-                resp.raise_for_status()
-                feed = feedparser.parse(resp.content)
-                e = feed.entries[0] if feed.entries else None
-                if not e:
-                    continue
-                it = _to_item(e, url)
-                if not it["title"] or not it["link"]:
-                    continue
-                items.append(it)
-            except Exception:
+            feed_items = per_feed.get(url) or []
+            it = feed_items[0] if feed_items else None
+            if not it or not it["title"] or not it["link"]:
+                continue
+            if only_new and it["link"] in seen:
                 continue
+            items.append(it)
 
-    # 3) Сортируем по дате (None в конец), обрезаем до max_items
+    # 4) Сортируем по дате (None в конец), обрезаем до max_items
     items.sort(
         key=lambda x: x["published_at"] or datetime.min.replace(tzinfo=timezone.utc),
         reverse=True,
     )
-    return items[:max_items]
+    items = items[:max_items]
+
+    with _STATE_LOCK:
+        fresh = _load_state()
+        fresh.setdefault("feeds", {}).update({u: feeds_state[u] for u in urls if u in feeds_state})
+        seen_list = list(dict.fromkeys((fresh.get("seen") or []) + [it["link"] for it in items]))
+        fresh["seen"] = seen_list[-_MAX_SEEN:]
+        _save_state(fresh)
+    return items
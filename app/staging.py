@@ -0,0 +1,134 @@
+# app/staging.py
+from __future__ import annotations
+import os, json, threading
+from pathlib import Path
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+from zoneinfo import ZoneInfo
+
+from app.db import fetch_draft, fetch_draft_by_id
+from app.sync import sync_drafts
+from app import metrics
+
+# Предподготовка слотов: за STAGE_AHEAD_MIN минут до публикации синкаем
+# модерацию из Sheets, берём черновик из БД и замораживаем его в памяти
+# и в локальном снапшоте. В момент слота остаётся дешёвая перепроверка
+# статуса по id и отправка; если БД тормозит — шлём замороженный текст.
+
+Row = Tuple[int, str, str, str]  # (id, text, edited_text, status), как fetch_draft
+
+_READY: Dict[str, dict] = {}
+_LOCK = threading.Lock()
+_LATENESS: List[float] = []
+_LATENESS_MAX = 1000
+
+def ahead_minutes() -> int:
+    return int(os.getenv("STAGE_AHEAD_MIN", "10"))
+
+def _snapshot_path() -> Path:
+    return Path(os.getenv("STAGE_FILE", ".cache/staged.json"))
+
+def _key(channel: str, fmt: str, date_iso: str) -> str:
+    return f"{channel}|{fmt}|{date_iso}"
+
+def _save_snapshot():
+    p = _snapshot_path()
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(".tmp")
+        with _LOCK:
+            data = json.dumps(_READY, ensure_ascii=False)
+        tmp.write_text(data, encoding="utf-8")
+        tmp.replace(p)
+    except Exception as e:
+        print(f"[STAGE ERR] snapshot: {e}")
+
+def _load_snapshot() -> Dict[str, dict]:
+    p = _snapshot_path()
+    try:
+        return json.loads(p.read_text(encoding="utf-8")) if p.exists() else {}
+    except Exception as e:
+        print(f"[STAGE ERR] snapshot read: {e}")
+        return {}
+
+def _prune(today_iso: str):
+    # держим только сегодня и будущее
+    with _LOCK:
+        for k in [k for k in _READY if k.rsplit("|", 1)[-1] < today_iso]:
+            _READY.pop(k, None)
+
+def resolve(channel: str, fmt: str, date_iso: str) -> Row | None:
+    """Полный путь: синк модерации из Sheets + черновик из БД."""
+    try:
+        sync_drafts(channel=channel, date_iso=date_iso)
+    except Exception as e:
+        print(f"[SYNC SHEETS ERR] {e}")
+    return fetch_draft(channel=channel, fmt=fmt, d=date_iso)
+
+def stage(channel: str, fmt: str, date_iso: str) -> Row | None:
+    """Заморозить черновик слота (в памяти и в снапшоте)."""
+    row = resolve(channel, fmt, date_iso)
+    if not row:
+        print(f"[STAGE] no draft for {channel} {fmt} {date_iso}")
+        return None
+    _prune(date_iso)
+    with _LOCK:
+        _READY[_key(channel, fmt, date_iso)] = {
+            "row": list(row),
+            "staged_at": datetime.utcnow().isoformat(timespec="seconds"),
+        }
+    _save_snapshot()
+    print(f"[STAGE] {channel} {fmt} {date_iso} draft_id={row[0]} status={row[3]}")
+    return row
+
+def stage_ahead(channel: str, fmt: str, tz: str):
+    """Задача планировщика: подготовить слот, который сработает через STAGE_AHEAD_MIN."""
+    target = datetime.now(ZoneInfo(tz)) + timedelta(minutes=ahead_minutes())
+    stage(channel, fmt, target.date().isoformat())
+
+def ready_row(channel: str, fmt: str, date_iso: str) -> Row | None:
+    """
+    Черновик для отправки прямо сейчас: замороженный + перепроверка статуса по id
+    (STAGE_RECHECK_MS). Нет заготовки — идём полным путём.
+    """
+    k = _key(channel, fmt, date_iso)
+    with _LOCK:
+        staged = _READY.get(k)
+    if staged is None:
+        staged = _load_snapshot().get(k)
+    if staged is None:
+        return resolve(channel, fmt, date_iso)
+
+    row = tuple(staged["row"])
+    try:
+        fresh = fetch_draft_by_id(int(row[0]), timeout_ms=int(os.getenv("STAGE_RECHECK_MS", "1500")))
+        if fresh:
+            return fresh
+        return None  # черновик удалён
+    except Exception as e:
+        print(f"[STAGE] recheck failed, using staged draft {row[0]}: {e}")
+        return row
+
+def slot_due(t_local: str, tz: str, date_iso: str) -> datetime:
+    h, m, *rest = map(int, t_local.split(":"))
+    d = datetime.fromisoformat(date_iso).date()
+    return datetime(d.year, d.month, d.day, h, m, rest[0] if rest else 0, tzinfo=ZoneInfo(tz))
+
+def record_lateness(name: str, due: datetime, sent_at: datetime | None = None) -> float:
+    """Запомнить опоздание отправки относительно слота (сек)."""
+    sent_at = sent_at or datetime.now(due.tzinfo)
+    late = (sent_at - due).total_seconds()
+    metrics.observe("slot_lateness_seconds", late, buckets=metrics.LATENESS_BUCKETS)
+    with _LOCK:
+        _LATENESS.append(late)
+        del _LATENESS[:-_LATENESS_MAX]
+    print(f"[LATE] {name} {late:.2f}s after slot")
+    return late
+
+def lateness_stats() -> dict:
+    with _LOCK:
+        xs = sorted(_LATENESS)
+    if not xs:
+        return {"count": 0}
+    pick = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+    return {"count": len(xs), "p50": pick(0.5), "p95": pick(0.95), "max": xs[-1]}
@@ -0,0 +1,61 @@
+# app/sync.py
+from __future__ import annotations
+import hashlib, threading
+from typing import Dict, List
+
+from app.sheets import pull_all, pull_drafts_for_date
+from app.db import apply_sheet_rows
+
+# Инкрементальный синк модерации Sheets → drafts.
+# Запоминаем отпечаток (status, edited_text, approved_by) каждой строки по id
+# и отправляем в БД только то, что изменилось с прошлого раза.
+_SEEN: Dict[int, str] = {}
+_LOCK = threading.Lock()
+
+def _row_id(r: dict) -> int:
+    try:
+        return int(r.get("id") or 0)
+    except Exception:
+        return 0
+
+def _fingerprint(r: dict) -> str:
+    raw = "\x1f".join(str(r.get(k) or "") for k in ("status", "edited_text", "approved_by"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def sync_drafts(channel: str | None = None, date_iso: str | None = None) -> int:
+    """
+    Применить к БД изменённые строки листа drafts (опционально — только канал/дата).
+    С датой читаем из листа только строки этой даты (свежие, без снапшота),
+    без даты — весь лист из снапшота sheets. Запись — одной транзакцией.
+    Возвращает число обновлённых черновиков.
+    """
+    # перегенерированный день дописывает строки с тем же id — побеждает последняя,
+    # как при построчном применении (UPDATE ... FROM с повтором ключа взял бы любую)
+    latest: Dict[int, dict] = {}
+    rows = pull_drafts_for_date(date_iso) if date_iso else pull_all()
+    for r in rows:
+        if channel is not None and r.get("channel") != channel:
+            continue
+        if date_iso is not None and r.get("date") != date_iso:
+            continue
+        rid = _row_id(r)
+        if rid <= 0:
+            continue
+        latest[rid] = r
+
+    changed: List[dict] = []
+    fps: Dict[int, str] = {}
+    for rid, r in latest.items():
+        fp = _fingerprint(r)
+        with _LOCK:
+            if _SEEN.get(rid) == fp:
+                continue
+        changed.append(r)
+        fps[rid] = fp
+
+    if not changed:
+        return 0
+    n = apply_sheet_rows(changed)
+    with _LOCK:
+        _SEEN.update(fps)
+    return n
@@ -0,0 +1,77 @@
+# bench/bench_chunk_upsert.py
+"""
+Сравнение записи чанков: построчный INSERT ... ON CONFLICT (как было)
+против COPY во временную таблицу + один INSERT ... SELECT (embeddings._write_chunks).
+
+    DATABASE_URL=... python -m bench.bench_chunk_upsert --sizes 1000,10000
+
+Пишет в chunks под book_id='__bench__' и удаляет за собой. Результат — JSON в stdout.
+"""
+from __future__ import annotations
+import argparse, json, random, time
+
+from app.db import get_conn, init_db
+from app.embeddings import _sha1, _write_chunks, json_dumps_float
+
+BOOK_ID = "__bench__"
+DIM = 1536
+
+def _rows(n: int, seed: int = 0):
+    rnd = random.Random(seed)
+    texts = [f"Фрагмент {i}. " + "слово " * rnd.randint(100, 200) for i in range(n)]
+    embs = [[rnd.uniform(-1, 1) for _ in range(DIM)] for _ in range(n)]
+    return texts, embs
+
+def _per_row(cur, texts, embs):
+    for i_off, (t, e) in enumerate(zip(texts, embs), start=1):
+        h = _sha1(f"{BOOK_ID}:{i_off}:{t[:64]}")
+        cur.execute(
+            """
+            INSERT INTO chunks(book_id, title, author, chunk_id, text, emb, hash)
+            VALUES (%s, %s, %s, %s, %s, %s::jsonb, %s)
+            ON CONFLICT (book_id, chunk_id) DO UPDATE
+              SET text = EXCLUDED.text, emb = EXCLUDED.emb, hash = EXCLUDED.hash
+            """,
+            (BOOK_ID, "bench", "bench", i_off, t, json_dumps_float(e), h),
+        )
+
+def _bulk(cur, texts, embs):
+    _write_chunks(cur, BOOK_ID, "bench", "bench", 1, texts, embs)
+
+def _cleanup():
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM chunks WHERE book_id=%s;", (BOOK_ID,))
+
+def _run(fn, texts, embs) -> float:
+    _cleanup()
+    t0 = time.perf_counter()
+    with get_conn() as conn, conn.cursor() as cur:
+        fn(cur, texts, embs)
+        conn.commit()
+    return time.perf_counter() - t0
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,10000")
+    args = ap.parse_args()
+
+    init_db()
+    results = []
+    try:
+        for n in (int(x) for x in args.sizes.split(",") if x.strip()):
+            texts, embs = _rows(n)
+            per_row = _run(_per_row, texts, embs)
+            bulk = _run(_bulk, texts, embs)
+            results.append({
+                "chunks": n,
+                "per_row_sec": round(per_row, 3),
+                "bulk_sec": round(bulk, 3),
+                "speedup": round(per_row / bulk, 2) if bulk else None,
+            })
+            print(f"[BENCH] {n} chunks: per-row {per_row:.2f}s, bulk {bulk:.2f}s", flush=True)
+    finally:
+        _cleanup()
+    print(json.dumps({"bench": "chunk_upsert", "results": results}, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
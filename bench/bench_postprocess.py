@@ -0,0 +1,96 @@
+# bench/bench_postprocess.py
+"""
+Постобработка поста: цепочка regex-проходов + посимвольный цикл по эмодзи
+(как было в generator) против однопроходного app.postprocess.
+
+    python -m bench.bench_postprocess --posts 20000
+
+Печатает JSON в stdout. differs_from_legacy — посты, где результат отличается:
+старая цепочка применяла правила по очереди, и вырезание одного штампа
+могло «склеить» текст в новое совпадение для следующего правила; корпус
+нарочно набит штампами вплотную друг к другу, на живых постах таких мало.
+"""
+from __future__ import annotations
+import argparse, json, random, re, time
+
+from app import postprocess
+
+# ---------- как было ----------
+_STOP_START = r"(?:знаете ли вы|вы знали|а знаете|а что если|что если|секрет в том|многие не знают|представьте|представь)"
+_EMOJI_RE = re.compile(
+    r"[\U0001F1E6-\U0001F1FF]|[\U0001F300-\U0001F5FF]|[\U0001F600-\U0001F64F]|[\U0001F680-\U0001F6FF]|"
+    r"[\U00002600-\U000026FF]|[\U00002700-\U000027BF]|[\U0001FA70-\U0001FAFF]"
+)
+
+def _squash_blanks(s):
+    return re.sub(r"\n{3,}", "\n\n", s).strip()
+
+def _declickbait(text):
+    if not text:
+        return text
+    text = re.sub(r"(?im)^\s*" + _STOP_START + r".{0,120}\?\s*\n?", "", text)
+    text = re.sub(r"(?im)в\s+одной\s+из\s+глав.*?(?:\.|\n)", "", text)
+    text = re.sub(r"(?im)эта\s+книга\s+покажет.*?(?:\.|\n)", "", text)
+    text = re.sub(r"(?im)погрузитесь\s+в\s+мир.*?(?:\.|\n)", "", text)
+    text = re.sub(r"(?im)откройте\s+новые\s+горизонты.*?(?:\.|\n)", "", text)
+    return _squash_blanks(text)
+
+def _limit_emojis(text, max_count):
+    if max_count <= 0:
+        return _EMOJI_RE.sub("", text)
+    out, used = [], 0
+    for ch in text:
+        if _EMOJI_RE.fullmatch(ch):
+            if used < max_count:
+                out.append(ch); used += 1
+        else:
+            out.append(ch)
+    return "".join(out)
+
+def legacy(raw: str) -> str:
+    body = _squash_blanks(raw.replace("**", "").strip())
+    body = _declickbait(body)
+    length = len(body)
+    return _limit_emojis(body, 1 if length < 400 else (2 if length < 800 else 3))
+
+# ---------- корпус ----------
+_PIECES = [
+    "Привычки складываются в систему.", "**Главное** — начать с малого.", "Представьте, что у вас есть час?",
+    "А знаете, почему это работает?", "В одной из глав автор пишет о старте.", "Эта книга покажет путь",
+    "Погрузитесь в мир продуктивности.", "Откройте новые горизонты!", "💡", "🔥🔥", "✅", "📚 Совет дня:",
+    "- шаг 1: запишите цель", "- шаг 2: уберите лишнее", "\n", "\n\n\n", "  ", "Что если начать сегодня?",
+]
+
+def corpus(n: int, seed: int = 0):
+    rnd = random.Random(seed)
+    return ["".join(rnd.choice(_PIECES) + rnd.choice([" ", "\n", ""]) for _ in range(rnd.randint(5, 60)))
+            for _ in range(n)]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--posts", type=int, default=20000)
+    args = ap.parse_args()
+
+    posts = corpus(args.posts)
+    rules = postprocess.compile_rules()
+
+    t0 = time.perf_counter()
+    old = [legacy(p) for p in posts]
+    t_old = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new = [postprocess.clean(p, rules) for p in posts]
+    t_new = time.perf_counter() - t0
+
+    differs = sum(1 for a, b in zip(old, new) if a != b)
+    print(json.dumps({
+        "posts": len(posts),
+        "avg_chars": round(sum(map(len, posts)) / len(posts)),
+        "legacy_us_per_post": round(t_old / len(posts) * 1e6, 2),
+        "single_pass_us_per_post": round(t_new / len(posts) * 1e6, 2),
+        "speedup": round(t_old / t_new, 2) if t_new else None,
+        "differs_from_legacy": differs,
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
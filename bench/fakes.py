@@ -0,0 +1,319 @@
+# bench/fakes.py
+"""
+Локальные заменители внешних сервисов для бенчмарков:
+OpenAI (эмбеддинги/чат с настраиваемой задержкой), gspread-подобная таблица
+в памяти, Drive и HTTP-приёмник sendMessage. Postgres — настоящий, из DATABASE_URL.
+"""
+from __future__ import annotations
+import re, json, time, codecs, hashlib, threading, itertools
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+# ---------- OpenAI ----------
+def _est_tokens(s: str) -> int:
+    return max(1, len(s) // 2)
+
+class FakeOpenAI:
+    """
+    Совместим с тем, что зовёт код: embeddings.create, chat.completions.create,
+    а также files/batches (Batch API: пакет исполняется в фоне с batch_concurrency
+    параллельными запросами, формат output-файла — как у OpenAI).
+    Задержка = latency_ms + токены / tokens_per_sec (ввод для эмбеддингов, вывод для чата).
+    """
+    def __init__(self, latency_ms: float = 300, tokens_per_sec: float = 80,
+                 embed_tokens_per_sec: float = 200_000, dim: int = 1536,
+                 batch_concurrency: int = 16):
+        self.latency = latency_ms / 1000.0
+        self.tps = tokens_per_sec
+        self.embed_tps = embed_tokens_per_sec
+        self.dim = dim
+        self.batch_concurrency = batch_concurrency
+        self.calls = {"embeddings": 0, "chat": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._files: Dict[str, bytes] = {}
+        self._batches: Dict[str, SimpleNamespace] = {}
+        self.embeddings = SimpleNamespace(create=self._embed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.files = SimpleNamespace(create=self._file_create, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._batch_create, retrieve=self._batch_retrieve)
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.calls[key] += n
+
+    def vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:4], "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32).tolist()
+
+    def _embed(self, model: str, input: List[str], **_):
+        self._count("embeddings")
+        tokens = sum(_est_tokens(t) for t in input)
+        time.sleep(self.latency + tokens / self.embed_tps)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=self.vector(t)) for t in input])
+
+    def _reply(self, messages: List[Dict], response_format) -> str:
+        if response_format and response_format.get("type") == "json_object":
+            return json.dumps({
+                "about": {"title": "Тестовая книга", "author": "Автор", "thesis": "Тезис", "audience": "Все"},
+                "key_ideas": [f"Идея {i}" for i in range(5)],
+                "practices": [{"name": "Практика", "steps": ["шаг 1", "шаг 2", "шаг 3"]}],
+                "cases": ["Кейс 1", "Кейс 2"],
+                "quotes": [{"text": "Цитата", "note": "пояснение"}],
+                "reflection": ["Вопрос?"],
+            }, ensure_ascii=False)
+        return ("Короткий абзац о главной мысли книги 💡. " * 6).strip() + "\n\n" + \
+               "\n".join(f"- пункт {i}: конкретный шаг и пример" for i in range(4))
+
+    def _chat(self, model: str, messages: List[Dict], temperature: float = 0.0,
+              response_format=None, max_tokens: int | None = None, stream: bool = False,
+              stream_options: Dict | None = None, **_):
+        self._count("chat")
+        text = self._reply(messages, response_format)
+        finish = "stop"
+        if max_tokens and len(text) > max_tokens * 2:
+            text, finish = text[: max_tokens * 2], "length"
+        if stream:
+            return _FakeStream(self, messages, text, finish, bool((stream_options or {}).get("include_usage")))
+        prompt_tokens = sum(_est_tokens(m.get("content") or "") for m in messages)
+        completion_tokens = _est_tokens(text)
+        self._count("prompt_tokens", prompt_tokens)
+        self._count("completion_tokens", completion_tokens)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+        time.sleep(self.latency + completion_tokens / self.tps)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason=finish)],
+            usage=usage,
+        )
+
+    # ---- Batch API ----
+    def _file_create(self, file, purpose: str = "batch"):
+        data = file[1] if isinstance(file, tuple) else (file.read() if hasattr(file, "read") else file)
+        fid = f"file-{next(self._ids)}"
+        self._files[fid] = data if isinstance(data, bytes) else str(data).encode("utf-8")
+        return SimpleNamespace(id=fid, purpose=purpose)
+
+    def _file_content(self, file_id: str):
+        data = self._files[file_id]
+        return SimpleNamespace(content=data, text=data.decode("utf-8"))
+
+    def _batch_line(self, req: Dict) -> Dict:
+        body = req["body"]
+        try:
+            res = self._chat(**body)
+            return {"custom_id": req["custom_id"], "error": None, "response": {
+                "status_code": 200,
+                "body": {
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": res.choices[0].message.content}}],
+                    "usage": vars(res.usage),
+                },
+            }}
+        except Exception as e:
+            return {"custom_id": req["custom_id"], "response": None,
+                    "error": {"code": "server_error", "message": str(e)}}
+
+    def _run_batch(self, b: SimpleNamespace, reqs: List[Dict]):
+        with ThreadPoolExecutor(max_workers=max(1, self.batch_concurrency)) as pool:
+            lines = list(pool.map(self._batch_line, reqs))
+        out = self._file_create(("output.jsonl", "\n".join(json.dumps(l, ensure_ascii=False) for l in lines).encode("utf-8")))
+        b.output_file_id = out.id
+        b.request_counts = SimpleNamespace(total=len(reqs), completed=sum(1 for l in lines if l["response"]),
+                                           failed=sum(1 for l in lines if not l["response"]))
+        b.status = "completed"
+
+    def _batch_create(self, input_file_id: str, endpoint: str, completion_window: str = "24h", **_):
+        reqs = [json.loads(l) for l in self._files[input_file_id].decode("utf-8").splitlines() if l.strip()]
+        b = SimpleNamespace(id=f"batch-{next(self._ids)}", status="in_progress", endpoint=endpoint,
+                            input_file_id=input_file_id, output_file_id=None, error_file_id=None,
+                            request_counts=SimpleNamespace(total=len(reqs), completed=0, failed=0))
+        self._batches[b.id] = b
+        threading.Thread(target=self._run_batch, args=(b, reqs), daemon=True).start()
+        return b
+
+    def _batch_retrieve(self, batch_id: str):
+        return self._batches[batch_id]
+
+class _FakeStream:
+    """Поток chunk'ов chat.completions: по слову, с задержкой по tokens_per_sec; close() обрывает."""
+    def __init__(self, api: FakeOpenAI, messages: List[Dict], text: str, finish: str, include_usage: bool):
+        self.api = api
+        self.messages = messages
+        self.pieces = re.findall(r"\S+\s*|\s+", text)
+        self.finish = finish
+        self.include_usage = include_usage
+        self.closed = False
+
+    @staticmethod
+    def _chunk(content: str | None, finish: str | None = None, usage=None):
+        choices = [] if usage else [SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish)]
+        return SimpleNamespace(choices=choices, usage=usage)
+
+    def __iter__(self):
+        time.sleep(self.api.latency)
+        sent = 0
+        for p in self.pieces:
+            if self.closed:
+                break
+            n = _est_tokens(p)
+            time.sleep(n / self.api.tps)
+            self.api._count("completion_tokens", n)
+            sent += n
+            yield self._chunk(p)
+        if self.closed:
+            return
+        yield self._chunk(None, self.finish)
+        prompt_tokens = sum(_est_tokens(m.get("content") or "") for m in self.messages)
+        self.api._count("prompt_tokens", prompt_tokens)
+        if self.include_usage:
+            yield self._chunk(None, usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=sent,
+                                                          total_tokens=prompt_tokens + sent))
+
+    def close(self):
+        self.closed = True
+
+# ---------- Google Sheets ----------
+def _col_idx(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch.upper()) - 64)
+    return n - 1
+
+def _parse_a1(a1: str):
+    m = re.match(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$", a1)
+    if not m:
+        raise ValueError(f"bad range {a1}")
+    c1, r1, c2, r2 = m.groups()
+    return int(r1) - 1, _col_idx(c1), int(r2 or r1) - 1, _col_idx(c2 or c1)
+
+class FakeWorksheet:
+    def __init__(self, sheet: "FakeSpreadsheet", title: str, header: List[str]):
+        self.sheet = sheet
+        self.title = title
+        self.rows: List[List[str]] = [list(header)]
+
+    def _api(self):
+        self.sheet.api_call()
+
+    def _cell_rows(self) -> List[List[str]]:
+        return [[str(v) for v in r] for r in self.rows]
+
+    def update(self, a1: str, values: List[List]):
+        self._api()
+        r1, c1, _, _ = _parse_a1(a1)
+        for dr, line in enumerate(values):
+            r = r1 + dr
+            while len(self.rows) <= r:
+                self.rows.append([])
+            row = self.rows[r]
+            while len(row) < c1 + len(line):
+                row.append("")
+            for dc, v in enumerate(line):
+                row[c1 + dc] = v
+
+    def append_rows(self, values: List[List], value_input_option: str = "RAW"):
+        self._api()
+        self.rows.extend([list(v) for v in values])
+
+    def col_values(self, n: int) -> List[str]:
+        self._api()
+        return [str(r[n - 1]) if len(r) >= n else "" for r in self.rows]
+
+    def get(self, a1: str) -> List[List[str]]:
+        self._api()
+        r1, c1, r2, c2 = _parse_a1(a1)
+        return [[str(v) for v in r[c1:c2 + 1]] for r in self.rows[r1:r2 + 1]]
+
+    def get_all_values(self) -> List[List[str]]:
+        self._api()
+        return self._cell_rows()
+
+class FakeSpreadsheet:
+    """gspread.Spreadsheet в памяти; каждый вызов API стоит latency_ms."""
+    def __init__(self, tabs: Dict[str, List[str]], latency_ms: float = 150):
+        self.latency = latency_ms / 1000.0
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        self.tabs = {t: FakeWorksheet(self, t, h) for t, h in tabs.items()}
+
+    def api_call(self):
+        with self._lock:
+            self.api_calls += 1
+        time.sleep(self.latency)
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        return self.tabs[title]
+
+    def add_worksheet(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        ws = FakeWorksheet(self, title, [])
+        self.tabs[title] = ws
+        return ws
+
+    def values_batch_get(self, ranges: List[str]) -> Dict:
+        self.api_call()
+        out = []
+        for r in ranges:
+            title = r.strip("'")
+            out.append({"range": r, "values": self.tabs[title]._cell_rows()})
+        return {"valueRanges": out}
+
+# ---------- Drive ----------
+class FakeDrive:
+    """Заменитель gdrive.iter_text: отдаёт текст файла кусками с задержкой на кусок."""
+    def __init__(self, files: Dict[str, str], chunk_bytes: int = 256 * 1024, latency_ms: float = 50):
+        self.files = files
+        self.chunk = chunk_bytes
+        self.latency = latency_ms / 1000.0
+
+    def iter_text(self, file_id: str, chunk_size: int | None = None) -> Iterator[str]:
+        data = self.files[file_id].encode("utf-8")
+        step = chunk_size or self.chunk
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for i in range(0, len(data), step):
+            time.sleep(self.latency)
+            yield decoder.decode(data[i:i + step], final=i + step >= len(data))
+
+# ---------- HTTP-приёмник sendMessage ----------
+class SendSink:
+    """Локальный Bot API: принимает POST /bot<token>/sendMessage и запоминает время приёма."""
+    def __init__(self):
+        self.received: List[Dict] = []
+        self._lock = threading.Lock()
+        sink = self
+
+        class _H(BaseHTTPRequestHandler):
+            def do_POST(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(n) or b"{}")
+                with sink._lock:
+                    sink.received.append({"path": self.path, "body": body, "at": time.time()})
+                payload = b'{"ok":true,"result":{}}'
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _H)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
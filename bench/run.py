@@ -0,0 +1,356 @@
+# bench/run.py
+"""
+Офлайн-бенчмарки пайплайна на локальных заменителях (bench/fakes.py).
+
+    python -m bench.run                          # всё, что можно запустить
+    python -m bench.run --only retriever_scoring,sheets_pull
+    python -m bench.run --out bench_output.json --llm-latency-ms 800
+
+Бенчи с needs_db используют настоящий Postgres из DATABASE_URL (лучше
+отдельную базу) и пишут только под book_id/channel '__bench__', убирая
+за собой. Без DATABASE_URL такие бенчи помечаются как skipped.
+Результат — JSON: {"meta": {...}, "results": [{"name", "params", "metrics"} | {"name", "skipped"}],
+"metrics": снимок app.metrics за прогон}.
+"""
+from __future__ import annotations
+import os, sys, json, time, argparse, platform, statistics, subprocess, traceback
+import datetime as dt
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from app import metrics
+from bench.fakes import FakeOpenAI, FakeSpreadsheet, FakeDrive, SendSink
+
+BENCH_ID = "__bench__"
+EMBED_MODEL = "bench-embed"
+
+# ---------- установка заменителей ----------
+def _install_openai(fake: FakeOpenAI):
+    import app.gpt as gpt
+    setattr(gpt, "__CLIENT", fake)
+
+def _install_sheets(sheet: FakeSpreadsheet):
+    import app.sheets as sheets
+    sheets.SHEET_KEY = "bench"
+    sheets._SH = sheet
+    sheets._WS.clear()
+    sheets.invalidate()
+
+def _new_sheet(latency_ms: float) -> FakeSpreadsheet:
+    from app.sheets import HEADERS, CONTROL_HEADERS, BOOKS_HEADERS
+    return FakeSpreadsheet(
+        {"drafts": HEADERS, "control": CONTROL_HEADERS, "books": BOOKS_HEADERS},
+        latency_ms=latency_ms,
+    )
+
+def _book_text(n_chunks: int) -> str:
+    para = "Маленькие привычки складываются в большие результаты, если повторять их каждый день. "
+    return "\n\n".join(f"Глава {i}. " + para * 12 for i in range(n_chunks))
+
+def _timeit(fn: Callable, reps: int = 1) -> List[float]:
+    out = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+    return out
+
+def _ms(xs: List[float]) -> Dict[str, float]:
+    xs = sorted(xs)
+    return {
+        "median_ms": round(statistics.median(xs) * 1000, 3),
+        "p95_ms": round(xs[min(len(xs) - 1, int(0.95 * len(xs)))] * 1000, 3),
+        "min_ms": round(xs[0] * 1000, 3),
+    }
+
+def _db_cleanup():
+    from app.db import get_conn
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM chunks WHERE book_id IN (%s, %s);", (BENCH_ID, f"__ingest__:{BENCH_ID}"))
+        cur.execute("DELETE FROM bm25_index WHERE book_id=%s;", (BENCH_ID,))
+        cur.execute("DELETE FROM summaries WHERE book_id=%s;", (BENCH_ID,))
+        cur.execute("DELETE FROM outbox WHERE channel=%s;", (BENCH_ID,))
+        cur.execute("DELETE FROM drafts WHERE channel=%s;", (BENCH_ID,))
+        cur.execute("DELETE FROM batch_jobs WHERE plan->'plan'->0->>'book_id'=%s;", (BENCH_ID,))
+        cur.execute("DELETE FROM emb_cache WHERE model=%s;", (EMBED_MODEL,))
+
+def _seed_chunks(n: int, fake: FakeOpenAI):
+    from app.db import get_conn
+    from app.embeddings import _write_chunks, iter_chunks
+    from app.retriever import invalidate_book
+    texts = list(iter_chunks([_book_text(n)]))[:n]
+    embs = [fake.vector(t) for t in texts]
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM chunks WHERE book_id=%s;", (BENCH_ID,))
+        _write_chunks(cur, BENCH_ID, "Бенч", "Автор", 1, texts, embs)
+    invalidate_book(BENCH_ID)
+
+# ---------- бенчи ----------
+_WORDS = ("привычка цель система результат шаг пример кейс цитата автор идея принцип правило "
+          "практика упражнение ошибка время энергия фокус команда клиент продукт рост деньги").split()
+
+def bench_retriever_scoring(ctx) -> List[Dict]:
+    """search_book/search_book_many на индексе в памяти (без БД) по режимам, от числа чанков."""
+    import app.retriever as retriever
+    _install_openai(FakeOpenAI(latency_ms=0, dim=1536))
+    rng = np.random.default_rng(0)
+    out = []
+    for n in ctx.sizes:
+        mat = rng.standard_normal((n, 1536)).astype(np.float32)
+        mat /= np.linalg.norm(mat, axis=1, keepdims=True)
+        texts = [" ".join(rng.choice(_WORDS, 180)) for _ in range(n)]
+        retriever._INDEX[BENCH_ID] = retriever._BookIndex(list(range(1, n + 1)), texts, np.ascontiguousarray(mat))
+        queries = [f"запрос {i}: примеры и цитаты автора" for i in range(6)]
+        row = {}
+        for mode in ("vector", "hybrid", "lexical"):
+            one = _timeit(lambda: retriever.search_book(BENCH_ID, queries[0], top_k=10, mode=mode), reps=ctx.reps)
+            many = _timeit(lambda: retriever.search_book_many(BENCH_ID, queries, top_k=10, mode=mode), reps=ctx.reps)
+            row[mode] = {"search_book": _ms(one), "search_book_many_6": _ms(many)}
+        out.append({"params": {"chunks": n}, "metrics": row})
+    retriever.invalidate_book(BENCH_ID)
+    return out
+
+def bench_retriever_db(ctx) -> List[Dict]:
+    """Холодная загрузка индекса книги из Postgres + тёплый запрос."""
+    import app.retriever as retriever
+    fake = FakeOpenAI(latency_ms=0)
+    _install_openai(fake)
+    out = []
+    for n in ctx.sizes:
+        _seed_chunks(n, fake)
+        cold = _timeit(lambda: (retriever.invalidate_book(BENCH_ID),
+                                retriever.search_book(BENCH_ID, "основная идея", top_k=10)))
+        warm = _timeit(lambda: retriever.search_book(BENCH_ID, "основная идея", top_k=10), reps=ctx.reps)
+        out.append({"params": {"chunks": n}, "metrics": {"cold": _ms(cold), "warm": _ms(warm)}})
+    return out
+
+def bench_upsert_throughput(ctx) -> List[Dict]:
+    """upsert_book_chunks (холодный/тёплый emb_cache) и потоковый ingest_stream из FakeDrive."""
+    from app.db import get_conn
+    from app.embeddings import upsert_book_chunks, ingest_stream, iter_chunks
+    fake = FakeOpenAI(latency_ms=ctx.embed_latency_ms)
+    _install_openai(fake)
+    out = []
+    for n in ctx.sizes:
+        text = _book_text(n)
+        chunks = list(iter_chunks([text]))[:n]
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM emb_cache WHERE model=%s;", (EMBED_MODEL,))
+        calls0 = fake.calls["embeddings"]
+        [cold] = _timeit(lambda: upsert_book_chunks(BENCH_ID, "Бенч", "Автор", chunks))
+        calls_cold = fake.calls["embeddings"] - calls0
+        [warm] = _timeit(lambda: upsert_book_chunks(BENCH_ID, "Бенч", "Автор", chunks))
+
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM emb_cache WHERE model=%s;", (EMBED_MODEL,))
+        drive = FakeDrive({BENCH_ID: text})
+        [stream] = _timeit(lambda: ingest_stream(BENCH_ID, "Бенч", "Автор", drive.iter_text(BENCH_ID)))
+        out.append({"params": {"chunks": len(chunks)}, "metrics": {
+            "cold_chunks_per_sec": round(len(chunks) / cold, 1),
+            "warm_chunks_per_sec": round(len(chunks) / warm, 1),
+            "stream_chunks_per_sec": round(len(chunks) / stream, 1),
+            "embed_requests_cold": calls_cold,
+        }})
+    return out
+
+def bench_sheets_pull(ctx) -> List[Dict]:
+    """pull_all (снапшот) и pull_drafts_for_date на листе с N строками (без БД)."""
+    import app.sheets as sheets
+    out = []
+    for n in ctx.sizes:
+        sheet = _new_sheet(ctx.sheets_latency_ms)
+        base = dt.date(2025, 1, 1)
+        sheet.tabs["drafts"].rows.extend(
+            [str(i + 1), (base + dt.timedelta(days=i // 6)).isoformat(), "09:00", BENCH_ID,
+             f"f{i % 6}", BENCH_ID, "текст " * 50, "approved", "", "", ""]
+            for i in range(n)
+        )
+        _install_sheets(sheet)
+        last_day = (base + dt.timedelta(days=(n - 1) // 6)).isoformat()
+        calls0 = sheet.api_calls
+        full = _timeit(lambda: (sheets.invalidate(), sheets.pull_all()), reps=ctx.reps)
+        calls_full = (sheet.api_calls - calls0) / ctx.reps
+        calls0 = sheet.api_calls
+        day = _timeit(lambda: sheets.pull_drafts_for_date(last_day), reps=ctx.reps)
+        calls_day = (sheet.api_calls - calls0) / ctx.reps
+        out.append({"params": {"rows": n}, "metrics": {
+            "pull_all": _ms(full), "pull_all_api_calls": calls_full,
+            "pull_drafts_for_date": _ms(day), "pull_drafts_for_date_api_calls": calls_day,
+        }})
+    return out
+
+def _run_batch_job(planner):
+    """generate_batch + тики poll_batch_jobs, пока задача не закроется."""
+    from app.db import open_batch_jobs
+    job_id = planner.generate_batch([(BENCH_ID, BENCH_ID)], ["2099-01-01"])
+    poll = float(os.getenv("GEN_BATCH_POLL_SEC", "30"))
+    while any(j["id"] == job_id for j in open_batch_jobs()):
+        time.sleep(poll)
+        planner.poll_batch_jobs()
+
+def bench_generate_day(ctx) -> List[Dict]:
+    """
+    planner.generate_day целиком (конспект + 6 постов + черновики + push в лист)
+    и то же через planner.generate_batch (Batch API на FakeOpenAI).
+    """
+    import app.planner as planner
+    import app.generator as generator
+    from app.sheets import BOOKS_HEADERS
+    fake = FakeOpenAI(latency_ms=ctx.llm_latency_ms, tokens_per_sec=ctx.tokens_per_sec)
+    _install_openai(fake)
+    _seed_chunks(300, fake)
+    slots = [{"format": f, "time": f"{9 + i:02d}:00"}
+             for i, f in enumerate(["announce", "insight", "practice", "case", "quote", "reflect"])]
+    planner._find_channel_slots = lambda alias, name: ("UTC", slots)
+
+    out = []
+    for mode, run in (("sync", "cold_summary"), ("sync", "warm_summary"), ("batch", "cold_summary")):
+        sheet = _new_sheet(ctx.sheets_latency_ms)
+        book = dict.fromkeys(BOOKS_HEADERS, "")
+        book.update({"file_id": BENCH_ID, "title": "Бенч", "author": "Автор", "status": "new"})
+        sheet.tabs["books"].rows.append([book[h] for h in BOOKS_HEADERS])
+        _install_sheets(sheet)
+        if run == "cold_summary":
+            from app.db import get_conn
+            with get_conn() as conn, conn.cursor() as cur:
+                cur.execute("DELETE FROM summaries WHERE book_id=%s;", (BENCH_ID,))
+            generator._SUMMARY_CACHE.clear()
+        calls0 = dict(fake.calls)
+        if mode == "batch":
+            [t] = _timeit(lambda: _run_batch_job(planner))
+        else:
+            [t] = _timeit(lambda: planner.generate_day(BENCH_ID, BENCH_ID, "2099-01-01"))
+        out.append({"params": {"mode": mode, "run": run, "slots": len(slots), "llm_latency_ms": ctx.llm_latency_ms},
+                    "metrics": {
+                        "wall_sec": round(t, 3),
+                        "chat_calls": fake.calls["chat"] - calls0["chat"],
+                        "embed_calls": fake.calls["embeddings"] - calls0["embeddings"],
+                        "prompt_tokens": fake.calls["prompt_tokens"] - calls0["prompt_tokens"],
+                        "completion_tokens": fake.calls["completion_tokens"] - calls0["completion_tokens"],
+                        "sheets_api_calls": sheet.api_calls,
+                    }})
+    return out
+
+def bench_slot_send(ctx) -> List[Dict]:
+    """Слот → staging → outbox → HTTP sendMessage: задержка от планового времени до приёма."""
+    from app.db import get_conn, upsert_draft
+    from app import staging, outbox
+    from app.main import job_send
+    _install_sheets(_new_sheet(ctx.sheets_latency_ms))
+    today = dt.date.today().isoformat()
+    n = 5
+    with SendSink() as sink:
+        os.environ["TELEGRAM_API_BASE"] = sink.base_url
+        ids = []
+        for i in range(n):
+            os.environ[f"BENCH_TOKEN_{i}"] = f"bench{i}"
+            did = upsert_draft(BENCH_ID, f"f{i}", BENCH_ID, f"пост {i}", today, "09:00")
+            ids.append(did)
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("UPDATE drafts SET status='approved' WHERE id = ANY(%s);", (ids,))
+        for i in range(n):
+            staging.stage(BENCH_ID, f"f{i}", today)
+
+        outbox.start_worker()
+        lat = []
+        for i in range(n):
+            due = dt.datetime.now(dt.timezone.utc)
+            t0 = time.time()
+            row = staging.ready_row(BENCH_ID, f"f{i}", today)
+            if not row:
+                continue
+            job_send(alias=f"@bench{i}", token_env=f"BENCH_TOKEN_{i}", text=row[2] or row[1],
+                     draft_id=row[0], channel=BENCH_ID, due_at=due)
+            while len(sink.received) <= i and time.time() - t0 < 30:
+                time.sleep(0.005)
+            if len(sink.received) > i:
+                lat.append(sink.received[i]["at"] - t0)
+    return [{"params": {"slots": n}, "metrics": {"fire_to_send": _ms(lat) if lat else None,
+                                                 "delivered": len(lat)}}]
+
+BENCHES = [
+    # (name, needs_db, fn)
+    ("retriever_scoring", False, bench_retriever_scoring),
+    ("sheets_pull", False, bench_sheets_pull),
+    ("retriever_db", True, bench_retriever_db),
+    ("upsert_throughput", True, bench_upsert_throughput),
+    ("generate_day", True, bench_generate_day),
+    ("slot_send", True, bench_slot_send),
+]
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--only", default="", help="через запятую: " + ",".join(b[0] for b in BENCHES))
+    ap.add_argument("--out", default="", help="куда записать JSON (по умолчанию stdout)")
+    ap.add_argument("--sizes", default="1000,5000")
+    ap.add_argument("--reps", type=int, default=20)
+    ap.add_argument("--llm-latency-ms", type=float, default=300)
+    ap.add_argument("--tokens-per-sec", type=float, default=80)
+    ap.add_argument("--embed-latency-ms", type=float, default=150)
+    ap.add_argument("--sheets-latency-ms", type=float, default=150)
+    args = ap.parse_args()
+
+    os.environ["OPENAI_EMBED_MODEL"] = EMBED_MODEL
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["LLM_CACHE"] = "off"
+    os.environ.setdefault("GEN_BATCH_POLL_SEC", "0.2")
+    ctx = SimpleNamespace(
+        sizes=[int(x) for x in args.sizes.split(",") if x.strip()],
+        reps=args.reps,
+        llm_latency_ms=args.llm_latency_ms,
+        tokens_per_sec=args.tokens_per_sec,
+        embed_latency_ms=args.embed_latency_ms,
+        sheets_latency_ms=args.sheets_latency_ms,
+    )
+    only = {x.strip() for x in args.only.split(",") if x.strip()}
+    have_db = bool(os.getenv("DATABASE_URL"))
+    if have_db:
+        from app.db import init_db
+        init_db()
+
+    results = []
+    try:
+        for name, needs_db, fn in BENCHES:
+            if only and name not in only:
+                continue
+            if needs_db and not have_db:
+                results.append({"name": name, "skipped": "DATABASE_URL is not set"})
+                continue
+            print(f"[BENCH] {name} ...", file=sys.stderr, flush=True)
+            try:
+                for r in fn(ctx):
+                    results.append({"name": name, **r})
+            except Exception as e:
+                traceback.print_exc()
+                results.append({"name": name, "error": str(e)})
+    finally:
+        if have_db:
+            _db_cleanup()
+
+    report = {
+        "meta": {
+            "git_rev": _git_rev(),
+            "at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": results,
+        "metrics": metrics.snapshot(),
+    }
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# tests/test_batch_jobs.py
+from datetime import datetime, timezone
+import app.planner as planner
+
+SLOTS = [{"format": "insight", "time": "09:00"}, {"format": "insight", "time": "18:00"}]
+
+def _setup(monkeypatch):
+    st = {"jobs": [], "submitted": [], "status": [], "drafts": [], "control": [], "results": None}
+    monkeypatch.setattr(planner, "pull_books", lambda: [{"file_id": "b1", "status": "new"}])
+    monkeypatch.setattr(planner, "_find_channel_slots", lambda alias, name: ("UTC", SLOTS))
+    monkeypatch.setattr(planner, "update_book_status", lambda b, s, note="": st["status"].append((b, s)))
+    monkeypatch.setattr(planner, "summary_requests", lambda ids: ({"b1": {"s": 1}}, []))
+    monkeypatch.setattr(planner, "summary_key", lambda book_id: (book_id, "v", "m"))
+    monkeypatch.setattr(planner, "stored_summary", lambda key: {"s": 1})
+    monkeypatch.setattr(planner, "post_requests", lambda items, summaries: [{"custom_id": k} for k, *_ in items])
+    monkeypatch.setattr(planner, "apply_posts",
+                        lambda items, summaries, res: {k: f"text {k}" for k, *_ in items})
+    monkeypatch.setattr(planner.batch, "submit", lambda reqs: st["submitted"].append(reqs) or "batch_1")
+    monkeypatch.setattr(planner.batch, "check", lambda batch_id, ids: st["results"])
+    monkeypatch.setattr(planner, "add_log", lambda m: None)
+
+    def _create(stage, batch_id, plan, control_row=None):
+        st["jobs"].append({"id": 1, "stage": stage, "batch_id": batch_id, "plan": plan,
+                           "control_row": control_row, "created_at": datetime.now(timezone.utc), "state": "open"})
+        return 1
+
+    def _update(job_id, *, stage=None, batch_id=None, state=None, note=None):
+        job = st["jobs"][0]
+        for k, v in (("stage", stage), ("batch_id", batch_id), ("state", state)):
+            if v is not None:
+                job[k] = v
+
+    monkeypatch.setattr(planner, "create_batch_job", _create)
+    monkeypatch.setattr(planner, "update_batch_job", _update)
+    monkeypatch.setattr(planner, "open_batch_jobs", lambda: [j for j in st["jobs"] if j["state"] == "open"])
+    monkeypatch.setattr(planner, "upsert_draft", lambda **kw: st["drafts"].append(kw) or len(st["drafts"]))
+    monkeypatch.setattr(planner, "push_drafts", lambda rows: None)
+    monkeypatch.setattr(planner, "update_control_status", lambda row, s, note="": st["control"].append((row, s)))
+    return st
+
+def test_generate_batch_submits_without_waiting(monkeypatch):
+    st = _setup(monkeypatch)
+
+    job_id = planner.generate_batch([("Chan", "@chan")], ["2026-10-18"], control_row=5)
+
+    assert job_id == 1 and st["jobs"][0]["stage"] == "posts"
+    # один формат в двух слотах — два разных custom_id
+    ids = [r["custom_id"] for r in st["submitted"][0]]
+    assert len(ids) == 2 and len(set(ids)) == 2
+    assert st["drafts"] == [] and st["control"] == []
+
+    planner.poll_batch_jobs()  # пакет ещё не готов — ничего не происходит
+    assert st["jobs"][0]["state"] == "open" and st["drafts"] == []
+
+def test_poll_batch_jobs_finalizes_each_slot(monkeypatch):
+    st = _setup(monkeypatch)
+    planner.generate_batch([("Chan", "@chan")], ["2026-10-18"], control_row=5)
+    st["results"] = {}
+
+    planner.poll_batch_jobs()
+
+    assert [d["t"] for d in st["drafts"]] == ["09:00", "18:00"]
+    assert st["jobs"][0]["state"] == "done"
+    assert st["status"][-1] == ("b1", "used")
+    assert st["control"] == [(5, "done")]
@@ -0,0 +1,57 @@
+# tests/test_context.py
+import numpy as np
+import app.generator as generator
+from app import embeddings, minhash
+
+class _CopyCur:
+    """Курсор, который запоминает строки COPY из _write_chunks."""
+    def __init__(self):
+        self.rows = []
+
+    def execute(self, *a, **kw):
+        pass
+
+    def copy_expert(self, sql, buf):
+        for line in buf.getvalue().splitlines():
+            f = line.split("\t")
+            self.rows.append({"chunk_id": int(f[3]), "text": f[4],
+                              "minhash": np.array([int(x) for x in f[7].strip("{}").split(",")], dtype=np.uint64)})
+
+def _book():
+    paras = [f"Глава {i}. " + " ".join(f"мысль{i}_{j} про привычки и систему" for j in range(40)) for i in range(4)]
+    chunks = [embeddings._normalize_ws(c) for c in embeddings.iter_chunks(["\n\n".join(paras)])]
+    cur = _CopyCur()
+    embeddings._write_chunks(cur, "b", "t", "a", 1, chunks, [[0.0]] * len(chunks))
+    return cur.rows
+
+def _hits(rows):
+    return [[{"chunk_id": r["chunk_id"], "text": r["text"], "score": 1.0, "minhash": r["minhash"]} for r in rows]]
+
+def test_overlapping_neighbours_share_text_once(monkeypatch):
+    rows = _book()[:2]
+    first, second = rows[0]["text"], rows[1]["text"]
+    shared = generator._overlap(first, second)
+    assert 150 <= shared <= 220  # iter_chunks перекрывает на 200 символов
+
+    monkeypatch.setattr(generator, "search_book_many", lambda *a, **kw: _hits(rows))
+    ctx = generator._collect_context("b")
+
+    tail = first[-shared:]
+    assert ctx.count(tail) == 1
+    assert len(ctx) <= len(first) + len(second) - shared + 2
+
+def test_contained_chunk_is_dropped(monkeypatch):
+    rows = _book()[:1]
+    text = rows[0]["text"]
+    part = text[: len(text) // 2]
+    rows.append({"chunk_id": 99, "text": part, "minhash": np.array(minhash.signature(part), dtype=np.uint64)})
+
+    # по Жаккару пара «непохожа», по вложенности — дубликат
+    sig = rows[0]["minhash"]
+    assert minhash.similarity(sig, rows[1]["minhash"][None, :])[0] < 0.7
+    n0, n1 = minhash.size(text), minhash.size(part)
+    assert minhash.containment(sig, n0, rows[1]["minhash"][None, :], np.array([n1]))[0] >= 0.8
+
+    monkeypatch.setattr(generator, "search_book_many", lambda *a, **kw: _hits(rows))
+    ctx = generator._collect_context("b")
+    assert ctx == text
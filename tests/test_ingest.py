@@ -0,0 +1,77 @@
+# tests/test_ingest.py
+import contextlib
+import pytest
+import app.embeddings as embeddings
+
+class _Cur:
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, sql, params=None):
+        self.log.append((" ".join(sql.split()), params))
+
+    def fetchall(self):
+        return []
+
+    def copy_expert(self, sql, buf):
+        self.log.append(("COPY", buf.getvalue().count("\n")))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        pass
+
+class _Conn:
+    def __init__(self, log):
+        self.log = log
+
+    def cursor(self):
+        return _Cur(self.log)
+
+    def commit(self):
+        pass
+
+@pytest.fixture
+def db(monkeypatch):
+    log, invalidated = [], []
+
+    @contextlib.contextmanager
+    def _get_conn():
+        yield _Conn(log)
+
+    monkeypatch.setattr(embeddings, "get_conn", _get_conn)
+    monkeypatch.setattr(embeddings, "embed_texts", lambda texts: [[1.0, 0.0]] * len(texts))
+    monkeypatch.setattr(embeddings, "invalidate_book", invalidated.append)
+    monkeypatch.setattr(embeddings.bm25, "rebuild", lambda cur, book_id: log.append(("BM25", book_id)))
+    monkeypatch.setenv("EMBED_BATCH_SIZE", "2")
+    return log, invalidated
+
+def _pieces(n, fail_at=None):
+    for i in range(n):
+        if i == fail_at:
+            raise IOError("drive stream broke")
+        yield f"Абзац {i}. " + "слово " * 300 + "\n\n"
+
+def test_failed_stream_leaves_old_book_untouched(db):
+    log, invalidated = db
+    with pytest.raises(IOError):
+        embeddings.ingest_stream("book", "t", "a", _pieces(20, fail_at=10))
+
+    stage = embeddings._stage_key("book")
+    assert ("DELETE FROM chunks WHERE book_id=%s;", (stage,)) == log[-1]
+    # старая версия книги не тронута и не подменялась
+    assert not any(p == ("book",) and sql.startswith("DELETE") for sql, p in log)
+    assert not any(sql.startswith("UPDATE chunks SET book_id") for sql, p in log)
+    assert not any(sql == "BM25" for sql, p in log)
+    assert invalidated == ["book"]
+
+def test_successful_stream_swaps_in_new_version(db):
+    log, invalidated = db
+    n = embeddings.ingest_stream("book", "t", "a", _pieces(6))
+
+    stage = embeddings._stage_key("book")
+    assert n > 0
+    assert ("UPDATE chunks SET book_id=%s WHERE book_id=%s;", ("book", stage)) in log
+    assert ("BM25", "book") in log
+    assert invalidated == ["book"]
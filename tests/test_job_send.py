@@ -0,0 +1,37 @@
+# tests/test_job_send.py
+from datetime import datetime, timezone
+import app.main as main
+import app.max_api as max_api
+from app import outbox, staging
+
+def test_enqueue_failure_falls_back_to_direct_send(monkeypatch):
+    sent, logs = [], []
+
+    def _boom(*a, **kw):
+        raise TimeoutError("db checkout timeout")
+
+    monkeypatch.setattr(outbox, "enqueue", _boom)
+    monkeypatch.setattr(max_api, "send_text", lambda **kw: sent.append(kw) or True)
+    monkeypatch.setattr(main, "add_log", logs.append)
+    monkeypatch.setenv("BOT_TOKEN_TEST", "t")
+    late = []
+    monkeypatch.setattr(staging, "record_lateness", lambda name, due: late.append(due) or 1.5)
+    due = datetime(2026, 10, 17, 9, 0, tzinfo=timezone.utc)
+
+    main.job_send(alias="@chan", token_env="BOT_TOKEN_TEST", text="frozen text",
+                  draft_id=7, channel="Chan", due_at=due)
+
+    assert len(sent) == 1
+    assert sent[0]["text"] == "frozen text" and sent[0]["token"] == "t" and not sent[0]["dry_run"]
+    assert any(l.startswith("[OUTBOX-FALLBACK]") for l in logs)
+    assert late == [due]  # опоздание пишется и на прямом пути, как в outbox
+
+def test_enqueue_success_does_not_send_directly(monkeypatch):
+    sent = []
+    monkeypatch.setattr(outbox, "enqueue", lambda *a, **kw: True)
+    monkeypatch.setattr(max_api, "send_text", lambda **kw: sent.append(kw) or True)
+    monkeypatch.setattr(main, "add_log", lambda m: None)
+
+    main.job_send(alias="@chan", token_env="BOT_TOKEN_TEST", text="x", draft_id=7, channel="Chan")
+
+    assert sent == []
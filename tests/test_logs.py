@@ -0,0 +1,34 @@
+# tests/test_logs.py
+import threading
+import app.db as db
+
+def _fresh_writer(monkeypatch, written):
+    monkeypatch.setattr(db, "_LOG_STOP", threading.Event())
+    monkeypatch.setattr(db, "_LOG_THREAD", None)
+    monkeypatch.setattr(db, "_LOG_STATS", {"written": 0, "dropped": 0, "failed": 0})
+    monkeypatch.setattr(db, "_write_logs", lambda batch: written.extend(m for _, m in batch))
+    monkeypatch.setattr(db, "_purge_logs", lambda: None)
+    monkeypatch.setenv("LOG_FLUSH_SEC", "0.05")
+
+def test_add_log_after_flush_writes_synchronously(monkeypatch):
+    written = []
+    _fresh_writer(monkeypatch, written)
+
+    db.add_log("before")
+    db.flush_logs()
+    db.add_log("after")
+
+    assert written == ["before", "after"]
+    assert db.log_stats()["written"] == 2
+
+def test_stats_are_exact_under_concurrency(monkeypatch):
+    written = []
+    _fresh_writer(monkeypatch, written)
+    threads = [threading.Thread(target=lambda: [db.add_log("x") for _ in range(500)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    db.flush_logs()
+
+    assert len(written) == 4000 and db.log_stats()["written"] == 4000
@@ -0,0 +1,34 @@
+# tests/test_post_length.py
+from types import SimpleNamespace
+import app.generator as generator
+
+LONG = "Первое предложение про привычки. " * 20  # ~660 символов
+
+class _Completions:
+    def __init__(self, finish):
+        self.finish = finish
+
+    def create(self, **kw):
+        msg = SimpleNamespace(content=LONG, role="assistant")
+        return SimpleNamespace(choices=[SimpleNamespace(message=msg, finish_reason=self.finish)], usage=None)
+
+def test_fit_len_cuts_stop_answers_longer_than_max_len():
+    out = generator._fit_len(LONG, "stop", 200)
+    assert len(out) <= 200 and out.endswith(".")
+
+def test_fit_len_keeps_short_stop_answers():
+    assert generator._fit_len("Коротко.", "stop", 200) == "Коротко."
+    assert generator._fit_len(LONG, "stop", None) == LONG
+
+def test_non_stream_stop_answer_is_cut(monkeypatch):
+    monkeypatch.setenv("GEN_STREAM", "false")
+    monkeypatch.setenv("LLM_CACHE", "off")
+    client = SimpleNamespace(chat=SimpleNamespace(completions=_Completions("stop")))
+    monkeypatch.setattr(generator, "_client", lambda: client)
+    monkeypatch.setattr(generator, "_max_len", lambda ch, fmt: 200)
+    seen = {}
+    monkeypatch.setattr(generator, "_finish_post", lambda fmt, raw, summary, **kw: seen.setdefault("raw", raw))
+
+    generator._gen_with_prompt("insight", {"about": {"title": "t"}}, book_id="b", channel_name="c")
+
+    assert len(seen["raw"]) <= 200
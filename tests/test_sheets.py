@@ -0,0 +1,46 @@
+# tests/test_sheets.py
+import threading, time
+import app.sheets as sheets
+
+class _SlowSheet:
+    def __init__(self):
+        self.calls = 0
+
+    def values_batch_get(self, ranges):
+        self.calls += 1
+        time.sleep(0.2)
+        return {"valueRanges": [{"values": [[r]]} for r in ranges]}
+
+def _install(monkeypatch, sh):
+    monkeypatch.setattr(sheets, "_SH", sh)
+    monkeypatch.setattr(sheets, "_WS", dict.fromkeys(sheets._TABS, object()))
+    monkeypatch.setattr(sheets, "_SNAP", {})
+    monkeypatch.setattr(sheets, "_INFLIGHT", set())
+    monkeypatch.setattr(sheets, "SHEET_KEY", "k")
+
+def test_concurrent_readers_share_one_batch_get(monkeypatch):
+    sh = _SlowSheet()
+    _install(monkeypatch, sh)
+    out = {}
+    threads = [threading.Thread(target=lambda t=t: out.setdefault(t, sheets._snapshot(t)))
+               for t in ("drafts", "books", "control")]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    assert sh.calls == 1
+    assert out["books"] == [["'books'"]]
+
+def test_lock_is_free_during_fetch(monkeypatch):
+    sh = _SlowSheet()
+    _install(monkeypatch, sh)
+    th = threading.Thread(target=sheets._snapshot, args=("drafts",))
+    th.start()
+    time.sleep(0.05)
+    # пока batchGet идёт, кэш доступен другим потокам
+    assert sheets._LOCK.acquire(timeout=0.05)
+    sheets._LOCK.release()
+    sheets.invalidate("drafts")
+    th.join()
+    assert "drafts" not in sheets._SNAP  # ответ, прочитанный до invalidate, в кэш не попал
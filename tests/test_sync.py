@@ -0,0 +1,23 @@
+# tests/test_sync.py
+import app.sync as sync
+
+def test_duplicate_ids_last_sheet_row_wins(monkeypatch):
+    rows = [
+        {"id": "5", "channel": "A", "date": "2026-10-17", "status": "approved", "edited_text": "old"},
+        {"id": "6", "channel": "A", "date": "2026-10-17", "status": "new"},
+        {"id": "5", "channel": "A", "date": "2026-10-17", "status": "rejected", "edited_text": "new"},
+    ]
+    applied = []
+    monkeypatch.setattr(sync, "pull_all", lambda: rows)
+    monkeypatch.setattr(sync, "apply_sheet_rows", lambda rs: applied.extend(rs) or len(rs))
+    monkeypatch.setattr(sync, "_SEEN", {})
+
+    assert sync.sync_drafts() == 2
+    by_id = {int(r["id"]): r for r in applied}
+    assert len(applied) == 2
+    assert by_id[5]["status"] == "rejected" and by_id[5]["edited_text"] == "new"
+
+    # повторный синк того же листа ничего не шлёт
+    applied.clear()
+    assert sync.sync_drafts() == 0
+    assert applied == []